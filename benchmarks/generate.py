@@ -0,0 +1,154 @@
+"""
+Synthetic genome mapping and processing files.
+Usage: python -m benchmarks.generate mappings FILE [options]
+       python -m benchmarks.generate queries GENOME_MAPPING_FILE FILE [options]
+"""
+import os
+import sys
+import random
+from argparse import ArgumentParser
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+from mappings import parse_cigar
+
+
+def synthetic_cigar(n_operations, seed=0):
+    """
+    Build a cigar string of n_operations alternating matches with insertions and deletions.
+    :param n_operations: int, number of cigar operations (rounded up to an odd number so it ends with a match)
+    :param seed: int, seed of the random generator used for the operation lengths
+    :return: string, cigar string
+    """
+    rng = random.Random(seed)
+    ops = []
+    for i in range(n_operations // 2):
+        ops.append(str(rng.randint(5, 200)) + "M")
+        ops.append(str(rng.randint(1, 10)) + rng.choice("ID"))
+    ops.append(str(rng.randint(5, 200)) + "M")
+    return "".join(ops)
+
+
+def transcript_cigar(rng, n_exons, indel_rate=0.1, exon_length=(50, 300), intron_length=(100, 50000)):
+    """
+    Build the cigar string of a spliced transcript: exons are matches, introns are long deletions, and every exon has
+    a small insertion or deletion with probability indel_rate.
+    :param rng: random.Random object
+    :param n_exons: int, number of exons
+    :param indel_rate: float, probability that an exon has an indel
+    :param exon_length: tuple (min, max) of the exon lengths
+    :param intron_length: tuple (min, max) of the intron lengths, drawn log-uniformly
+    :return: list of (op_length, operation) tuples
+    """
+    ops = []
+    for exon in range(n_exons):
+        if exon > 0:
+            ops.append((int(intron_length[0] * (intron_length[1] / intron_length[0]) ** rng.random()), "D"))
+        length = rng.randint(*exon_length)
+        if length > 2 and rng.random() < indel_rate:
+            split = rng.randint(1, length - 1)
+            ops.extend([(split, "M"), (rng.randint(1, 5), rng.choice("ID")), (length - split, "M")])
+        else:
+            ops.append((length, "M"))
+    return ops
+
+
+def cigar_lengths(ops):
+    """
+    :param ops: list of (op_length, operation) tuples
+    :return: tuple (length of the transcript, length of the alignment on the genome)
+    """
+    transcript_length = sum(op_length for op_length, operation in ops if operation in "MIS=X")
+    genomic_length = sum(op_length for op_length, operation in ops if operation in "MDN=X")
+    return transcript_length, genomic_length
+
+
+def write_genome_mapping_file(genome_mapping_file, n_transcripts, n_exons=8, indel_rate=0.1, minus_strand_rate=0.5,
+                              n_chromosomes=24, chromosome_length=10 ** 8, seed=0):
+    """
+    Write a genome mapping file of spliced transcripts.
+    :param genome_mapping_file: string, name of the file to write
+    :param n_transcripts: int, number of transcripts
+    :param n_exons: int, mean number of exons per transcript (the cigar string has about 2 operations per exon)
+    :param indel_rate: float, probability that an exon has an insertion or deletion
+    :param minus_strand_rate: float, fraction of the transcripts mapped on the minus strand
+    :param n_chromosomes: int, number of chromosomes the transcripts are spread over
+    :param chromosome_length: int, highest alignment position
+    :param seed: int, seed of the random generator
+    :return: void
+    """
+    rng = random.Random(seed)
+    with open(genome_mapping_file, "w") as o_handle:
+        for t in range(n_transcripts):
+            ops = transcript_cigar(rng, max(1, int(rng.expovariate(1.0 / n_exons)) + 1), indel_rate)
+            orientation = "-" if rng.random() < minus_strand_rate else "+"
+            o_handle.write("TR%d\tCHR%d\t%d\t%s\t%s\n" % (t, rng.randint(1, n_chromosomes),
+                                                          rng.randint(1, chromosome_length),
+                                                          "".join(str(op_length) + operation
+                                                                  for op_length, operation in ops), orientation))
+
+
+def write_processing_file(genome_mapping_file, processing_file, n_queries, genomic_rate=0.5, out_of_range_rate=0.01,
+                          seed=0):
+    """
+    Write a processing file of queries on the transcripts of a genome mapping file.
+    :param genome_mapping_file: string, genome mapping file (as written by write_genome_mapping_file)
+    :param processing_file: string, name of the file to write
+    :param n_queries: int, number of queries
+    :param genomic_rate: float, fraction of GENOMIC queries; the others are TRANSCRIPT queries
+    :param out_of_range_rate: float, fraction of queries after the end of the alignment
+    :param seed: int, seed of the random generator
+    :return: void
+    """
+    transcripts = []
+    with open(genome_mapping_file) as in_handle:
+        for line in in_handle:
+            data = line.rstrip().split("\t")
+            operations, op_lengths = parse_cigar(data[3])
+            transcript_length, genomic_length = cigar_lengths(list(zip(op_lengths, map(chr, operations))))
+            transcripts.append((data[0], int(data[2]), transcript_length, genomic_length))
+
+    rng = random.Random(seed)
+    with open(processing_file, "w") as o_handle:
+        for q in range(n_queries):
+            transcript, pos, transcript_length, genomic_length = rng.choice(transcripts)
+            if rng.random() < genomic_rate:
+                position = pos + rng.randrange(genomic_length)
+                if rng.random() < out_of_range_rate:
+                    position += genomic_length
+                o_handle.write("%s\t%d\tGENOMIC\n" % (transcript, position))
+            else:
+                position = rng.randrange(transcript_length)
+                if rng.random() < out_of_range_rate:
+                    position += transcript_length
+                o_handle.write("%s\t%d\n" % (transcript, position))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Write synthetic genome mapping and processing files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    mappings_parser = subparsers.add_parser("mappings", help="Write a genome mapping file")
+    mappings_parser.add_argument("genome_mapping_file")
+    mappings_parser.add_argument("--transcripts", dest="n_transcripts", default=10000, type=int)
+    mappings_parser.add_argument("--exons", dest="n_exons", default=8, type=int,
+                                 help="Mean number of exons per transcript")
+    mappings_parser.add_argument("--indel-rate", dest="indel_rate", default=0.1, type=float,
+                                 help="Probability that an exon has an insertion or deletion")
+    mappings_parser.add_argument("--minus-strand-rate", dest="minus_strand_rate", default=0.5, type=float)
+    mappings_parser.add_argument("--seed", dest="seed", default=0, type=int)
+
+    queries_parser = subparsers.add_parser("queries", help="Write a processing file")
+    queries_parser.add_argument("genome_mapping_file")
+    queries_parser.add_argument("processing_file")
+    queries_parser.add_argument("--queries", dest="n_queries", default=100000, type=int)
+    queries_parser.add_argument("--genomic-rate", dest="genomic_rate", default=0.5, type=float)
+    queries_parser.add_argument("--out-of-range-rate", dest="out_of_range_rate", default=0.01, type=float)
+    queries_parser.add_argument("--seed", dest="seed", default=0, type=int)
+
+    args = parser.parse_args()
+    if args.command == "mappings":
+        write_genome_mapping_file(args.genome_mapping_file, args.n_transcripts, args.n_exons, args.indel_rate,
+                                  args.minus_strand_rate, seed=args.seed)
+    else:
+        write_processing_file(args.genome_mapping_file, args.processing_file, args.n_queries, args.genomic_rate,
+                              args.out_of_range_rate, args.seed)
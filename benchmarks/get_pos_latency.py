@@ -0,0 +1,45 @@
+"""
+Per-query latency of Mappings.transcript_to_genomic_pos and genomic_to_transcript_pos as a function of the number of
+cigar operations.  Usage: python -m benchmarks.get_pos_latency [n_queries]
+"""
+import os
+import sys
+import random
+import timeit
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+from mappings import Mappings
+from benchmarks.generate import synthetic_cigar
+
+
+def time_queries(M, n_queries, seed=0):
+    rng = random.Random(seed)
+    transcript_max = max(r.stop_pos for r in M.query_ranges)
+    genomic_min = min(r.start_pos for r in M.reference_ranges)
+    genomic_max = max(r.stop_pos for r in M.reference_ranges)
+    transcript_positions = [rng.randint(0, transcript_max) for i in range(n_queries)]
+    genomic_positions = [rng.randint(genomic_min, genomic_max) for i in range(n_queries)]
+
+    def to_genomic():
+        for p in transcript_positions:
+            Mappings.transcript_to_genomic_pos(p, M)
+
+    def to_transcript():
+        for p in genomic_positions:
+            Mappings.genomic_to_transcript_pos(p, M)
+
+    return (min(timeit.repeat(to_genomic, number=1, repeat=3)) / n_queries,
+            min(timeit.repeat(to_transcript, number=1, repeat=3)) / n_queries)
+
+
+if __name__ == "__main__":
+    n_queries = 2000
+    if len(sys.argv) > 1:
+        n_queries = int(sys.argv[1])
+
+    print("n_operations\tstrand\ttranscript_to_genomic_us\tgenomic_to_transcript_us")
+    for n_operations in (11, 101, 501, 1001, 5001):
+        for strand in ("+", "-"):
+            M = Mappings(synthetic_cigar(n_operations), "CHR1", 1000, strand)
+            t_to_g, g_to_t = time_queries(M, n_queries)
+            print("%d\t%s\t%.2f\t%.2f" % (n_operations, strand, t_to_g * 1e6, g_to_t * 1e6))
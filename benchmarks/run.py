@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+import time
+import timeit
+from argparse import ArgumentParser
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+from mappings import Mappings, parse_cigar
+from genome_mapping import load_genome_mappings
+from translate_coordinate import build_mappings, translate_coordinates
+from benchmarks.generate import write_genome_mapping_file, write_processing_file
+
+"""
+Benchmarks of Mappings construction, Mappings.get_pos in both directions and end-to-end translate_coordinates on
+synthetic files, saved as JSON to compare commits.
+Usage: python -m benchmarks.run [--output results.json] [--compare baseline.json] [options]
+"""
+
+
+def git_commit():
+    """
+    :return: string, commit of the working tree the benchmarks are run on, None if it is not a git checkout
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timing(timer, n_items, repeat):
+    """
+    :param timer: function without arguments, one run of the benchmark
+    :param n_items: int, number of items (transcripts, queries) processed by one run
+    :param repeat: int, number of runs
+    :return: dict, best time of the runs in seconds, time per item in microseconds and the time of every run
+    """
+    times = timeit.repeat(timer, number=1, repeat=repeat)
+    return {"seconds": min(times), "per_item_us": min(times) / n_items * 1e6, "items": n_items, "runs": times}
+
+
+def benchmark_mappings_init(genome_mappings, repeat):
+    def build_all():
+        # cigar strings are parsed again on every run
+        parse_cigar.cache_clear()
+        for genome_mapping_info in genome_mappings:
+            build_mappings(genome_mapping_info)
+
+    return timing(build_all, len(genome_mappings), repeat)
+
+
+def benchmark_get_pos(genome_mappings, n_queries, repeat, seed):
+    """
+    :return: dict of benchmark name -> timing of Mappings.transcript_to_genomic_pos and genomic_to_transcript_pos on
+    positions spread uniformly over the alignments
+    """
+    rng = random.Random(seed)
+    query_mappings = [build_mappings(genome_mapping_info) for genome_mapping_info in genome_mappings]
+    transcript_queries = []
+    genomic_queries = []
+    for i in range(n_queries):
+        M = rng.choice(query_mappings)
+        transcript_queries.append((rng.randint(0, max(M.query_stops)), M))
+        genomic_queries.append((rng.randint(M.reference_starts[0], M.reference_stops[-1]), M))
+
+    def to_genomic():
+        for position, M in transcript_queries:
+            Mappings.transcript_to_genomic_pos(position, M, True)
+
+    def to_transcript():
+        for position, M in genomic_queries:
+            Mappings.genomic_to_transcript_pos(position, M, True)
+
+    return {"get_pos_transcript_to_genomic": timing(to_genomic, n_queries, repeat),
+            "get_pos_genomic_to_transcript": timing(to_transcript, n_queries, repeat)}
+
+
+def benchmark_translate_coordinates(genome_mapping_file, processing_file, n_queries, repeat, **kwargs):
+    output_file = processing_file + ".out"
+
+    def translate():
+        translate_coordinates(genome_mapping_file, processing_file, output_file, **kwargs)
+
+    return timing(translate, n_queries, repeat)
+
+
+def run_benchmarks(n_transcripts=2000, n_exons=8, n_queries=100000, repeat=3, seed=0):
+    """
+    :return: dict, parameters and environment of the run and the timing of every benchmark
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        genome_mapping_file = os.path.join(directory, "mappings.txt")
+        processing_file = os.path.join(directory, "queries.txt")
+        write_genome_mapping_file(genome_mapping_file, n_transcripts, n_exons, seed=seed)
+        write_processing_file(genome_mapping_file, processing_file, n_queries, seed=seed)
+        genome_mappings = list(load_genome_mappings(genome_mapping_file).values())
+
+        results = {"mappings_init": benchmark_mappings_init(genome_mappings, repeat)}
+        results.update(benchmark_get_pos(genome_mappings, n_queries, repeat, seed))
+        results["translate_coordinates"] = benchmark_translate_coordinates(genome_mapping_file, processing_file,
+                                                                           n_queries, repeat)
+        results["translate_coordinates_grouped"] = benchmark_translate_coordinates(genome_mapping_file,
+                                                                                   processing_file, n_queries, repeat,
+                                                                                   grouped=True)
+    finally:
+        shutil.rmtree(directory)
+
+    return {"commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "parameters": {"transcripts": n_transcripts, "exons": n_exons, "queries": n_queries, "repeat": repeat,
+                           "seed": seed},
+            "results": results}
+
+
+def compare(results, baseline):
+    """
+    :return: string, table of the time of every benchmark in results relative to baseline (lower is faster)
+    """
+    lines = ["benchmark\tbaseline_us\tcurrent_us\tratio"]
+    for name, timing in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        baseline_us = baseline["results"][name]["per_item_us"]
+        lines.append("%s\t%.3f\t%.3f\t%.2f" % (name, baseline_us, timing["per_item_us"],
+                                              timing["per_item_us"] / baseline_us))
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Benchmark mapping construction, position lookups and end-to-end translation")
+    parser.add_argument("--output", dest="output", default=None,
+                        help="JSON file the results are written to.  Default prints them")
+    parser.add_argument("--compare", dest="baseline", default=None,
+                        help="JSON results of an earlier run to compare with")
+    parser.add_argument("--transcripts", dest="n_transcripts", default=2000, type=int)
+    parser.add_argument("--exons", dest="n_exons", default=8, type=int, help="Mean number of exons per transcript")
+    parser.add_argument("--queries", dest="n_queries", default=100000, type=int)
+    parser.add_argument("--repeat", dest="repeat", default=3, type=int)
+    parser.add_argument("--seed", dest="seed", default=0, type=int)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.n_transcripts, args.n_exons, args.n_queries, args.repeat, args.seed)
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w") as o_handle:
+            json.dump(results, o_handle, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as in_handle:
+            sys.stdout.write(compare(results, json.load(in_handle)))
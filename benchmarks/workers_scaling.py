@@ -0,0 +1,50 @@
+"""
+Wall time of translate_coordinates for 1, 2, 4, 8 and 16 workers on a synthetic workload.
+Usage: python -m benchmarks.workers_scaling [n_transcripts] [n_queries]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+from benchmarks.generate import write_genome_mapping_file, write_processing_file
+from translate_coordinate import translate_coordinates
+
+
+def write_synthetic_workload(directory, n_transcripts, n_queries, seed=0):
+    """
+    Write a genome mapping file and a processing file with queries spread uniformly over the transcripts.
+    :return: tuple (genome mapping file name, processing file name)
+    """
+    genome_mapping_file = os.path.join(directory, "mappings.txt")
+    processing_file = os.path.join(directory, "queries.txt")
+    write_genome_mapping_file(genome_mapping_file, n_transcripts, seed=seed)
+    write_processing_file(genome_mapping_file, processing_file, n_queries, seed=seed)
+    return genome_mapping_file, processing_file
+
+
+if __name__ == "__main__":
+    n_transcripts = 2000
+    n_queries = 1000000
+    if len(sys.argv) > 2:
+        n_transcripts = int(sys.argv[1])
+        n_queries = int(sys.argv[2])
+
+    directory = tempfile.mkdtemp()
+    try:
+        genome_mapping_file, processing_file = write_synthetic_workload(directory, n_transcripts, n_queries)
+        output_file = os.path.join(directory, "output.txt")
+
+        print("workers\tseconds\tspeedup")
+        baseline = None
+        for workers in (1, 2, 4, 8, 16):
+            start = time.time()
+            translate_coordinates(genome_mapping_file, processing_file, output_file, workers=workers)
+            elapsed = time.time() - start
+            if baseline is None:
+                baseline = elapsed
+            print("%d\t%.2f\t%.2f" % (workers, elapsed, baseline / elapsed))
+    finally:
+        shutil.rmtree(directory)
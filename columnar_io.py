@@ -0,0 +1,173 @@
+from itertools import repeat
+from file_io import STDIO
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# first bytes of Arrow IPC files and Parquet files
+ARROW_MAGIC = b"ARROW1"
+PARQUET_MAGIC = b"PAR1"
+# names of output files written as Arrow IPC files, or Parquet files
+ARROW_EXTENSIONS = (".arrow", ".feather", ".ipc")
+PARQUET_EXTENSIONS = (".parquet",)
+
+# columns of a columnar processing file: transcript and position are required.  A row with an end is the interval
+# position-end; a row without direction (or with a null direction) is a TRANSCRIPT query.
+QUERY_COLUMNS = ("transcript", "position", "end", "direction")
+
+# columns of a columnar output file, see translate_coordinate.output_record.  Positions which could not be translated
+# are null, and status is the error code of the translation (OK if it succeeded).  blocks is the text of the translated
+# blocks of an interval (null for a position), whose coordinates span the start and end of the translated side.
+OUTPUT_COLUMNS = ("transcript", "transcript_start", "transcript_end", "chromosome", "genomic_start", "genomic_end",
+                  "blocks", "status")
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required for Arrow and Parquet files.")
+
+
+def output_schema():
+    """
+    :return: pyarrow.Schema of the OUTPUT_COLUMNS
+    """
+    require_pyarrow()
+    return pa.schema([("transcript", pa.string()), ("transcript_start", pa.int64()), ("transcript_end", pa.int64()),
+                      ("chromosome", pa.string()), ("genomic_start", pa.int64()), ("genomic_end", pa.int64()),
+                      ("blocks", pa.string()), ("status", pa.string())])
+
+
+def is_columnar_file(file_name):
+    """
+    :param file_name: string, name of an input file
+    :return: boolean, True if the file starts with the magic bytes of an Arrow IPC file or a Parquet file.  False for
+    STDIO, which is always read as text.
+    """
+    if file_name == STDIO:
+        return False
+    with open(file_name, "rb") as in_handle:
+        magic = in_handle.read(len(ARROW_MAGIC))
+    return magic == ARROW_MAGIC or magic[:len(PARQUET_MAGIC)] == PARQUET_MAGIC
+
+
+def columnar_output_format(file_name):
+    """
+    :param file_name: string, name of an output file
+    :return: string, "arrow" or "parquet" if the name ends with one of ARROW_EXTENSIONS or PARQUET_EXTENSIONS, None for
+    a text file
+    """
+    if file_name.lower().endswith(ARROW_EXTENSIONS):
+        return "arrow"
+    if file_name.lower().endswith(PARQUET_EXTENSIONS):
+        return "parquet"
+    return None
+
+
+class ColumnarQueryReader:
+    """
+    Read the queries of an Arrow IPC or Parquet processing file one record batch at a time.  Iterating gives a tuple
+    (transcript, position, direction) per row, which parse_processing_line takes in place of a text line: the position
+    is an int, or a tuple (start, end) for an interval, and is only parsed if the column holds text.
+    :param file_name: string, name of the file, see is_columnar_file
+    """
+
+    def __init__(self, file_name):
+        require_pyarrow()
+        self.file_name = file_name
+        with open(file_name, "rb") as in_handle:
+            self.is_parquet = in_handle.read(len(PARQUET_MAGIC)) == PARQUET_MAGIC
+        if self.is_parquet:
+            self._file = pq.ParquetFile(file_name)
+            names = self._file.schema_arrow.names
+        else:
+            self._file = pa.ipc.open_file(pa.memory_map(file_name))
+            names = self._file.schema.names
+        missing = [name for name in QUERY_COLUMNS[:2] if name not in names]
+        if missing:
+            raise ValueError("Processing file " + file_name + " has no column " + ", ".join(missing))
+        self.columns = [name for name in QUERY_COLUMNS if name in names]
+        self._queries = self.queries()
+
+    def record_batches(self):
+        if self.is_parquet:
+            return self._file.iter_batches(columns=self.columns)
+        return (self._file.get_batch(i) for i in range(self._file.num_record_batches))
+
+    def queries(self):
+        """
+        :return: generator of tuples (transcript, position, direction), one per row
+        """
+        for batch in self.record_batches():
+            columns = {name: batch.column(i).to_pylist() for i, name in enumerate(batch.schema.names)}
+            ends = columns.get("end", repeat(None))
+            directions = columns.get("direction", repeat(None))
+            for transcript, position, end, direction in zip(columns["transcript"], columns["position"], ends,
+                                                            directions):
+                if end is not None and position is not None:
+                    position = (position, end)
+                yield transcript or "", position, direction or "TRANSCRIPT"
+
+    def __iter__(self):
+        # an iterator like an open text file, so it can be read a chunk at a time
+        return self
+
+    def __next__(self):
+        return next(self._queries)
+
+    def close(self):
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ColumnarWriter:
+    """
+    Buffer output records (see translate_coordinate.output_record) and write them as record batches of an Arrow IPC
+    file or a Parquet file with the OUTPUT_COLUMNS, so the output is read into dataframes without parsing text.  Has
+    the interface of OutputWriter, and is closed in place of the output file.
+    :param file_name: string, name of the file
+    :param output_format: string, "arrow" or "parquet", see columnar_output_format
+    :param buffer_size: int, number of records per record batch (Parquet row group)
+    """
+
+    def __init__(self, file_name, output_format, buffer_size=10000):
+        require_pyarrow()
+        self.schema = output_schema()
+        self.buffer_size = buffer_size
+        self.records = []
+        if output_format == "parquet":
+            self._writer = pq.ParquetWriter(file_name, self.schema)
+        else:
+            self._writer = pa.ipc.new_file(file_name, self.schema)
+
+    def write(self, record):
+        """
+        :param record: tuple of the OUTPUT_COLUMNS
+        """
+        self.records.append(record)
+        if len(self.records) >= self.buffer_size:
+            self.flush()
+
+    def write_lines(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if not self.records:
+            return
+        columns = zip(*self.records)
+        self._writer.write_batch(pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in
+                                                             zip(columns, self.schema)], schema=self.schema))
+        self.records = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
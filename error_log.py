@@ -0,0 +1,84 @@
+import sys
+
+# sources of the error records: the file whose line could not be used
+GENOME_MAPPING_FILE = "GENOME_MAPPING"
+PROCESSING_FILE = "PROCESSING"
+
+
+class ErrorLog:
+    """
+    Structured record of the lines which could not be used, as (source, line number, transcript, error code) tuples,
+    with a count per error code.  Records are buffered and written to a tab separated side file, instead of reporting
+    every line to stderr.
+    :param error_file: string, name of the file records are written to.  None only keeps the counts.
+    :param buffer_size: int, number of records kept before they are written.  None keeps every record until
+    take_records is called.
+    """
+
+    HEADER = "#SOURCE\tLINE\tTRANSCRIPT\tERROR\n"
+
+    def __init__(self, error_file=None, buffer_size=10000):
+        self.error_file = error_file
+        self.buffer_size = buffer_size
+        self.records = []
+        self.counts = {}
+        self._handle = None
+
+    def add(self, source, line_number, transcript, error_code):
+        """
+        :param source: string, GENOME_MAPPING_FILE or PROCESSING_FILE
+        :param line_number: int, line number in the source file (starting at 1), None if not known
+        :param transcript: string, transcript (or chromosome) named by the line
+        :param error_code: string, e.g. UNKNOWN_TRANSCRIPT or one of mappings.POS_ERROR_CODES
+        """
+        self.counts[error_code] = self.counts.get(error_code, 0) + 1
+        self.records.append((source, line_number, transcript, error_code))
+        if self.buffer_size is not None and len(self.records) >= self.buffer_size:
+            self.flush()
+
+    def extend(self, records):
+        for record in records:
+            self.add(*record)
+
+    def take_records(self):
+        """
+        :return: list of the records added since the last call, which are removed from the log
+        """
+        records = self.records
+        self.records = []
+        return records
+
+    def flush(self):
+        if self.error_file is not None:
+            if self._handle is None:
+                self._handle = open(self.error_file, "w")
+                self._handle.write(self.HEADER)
+            self._handle.write("".join(source + "\t" + ("." if line_number is None else str(line_number)) + "\t" +
+                                       transcript + "\t" + error_code + "\n"
+                                       for source, line_number, transcript, error_code in self.records))
+        self.records = []
+
+    def close(self):
+        self.flush()
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def summary(self):
+        """
+        :return: string, number of errors of every code, empty if there was none
+        """
+        if not self.counts:
+            return ""
+        return "Errors: " + ", ".join(str(self.counts[error_code]) + " " + error_code
+                                      for error_code in sorted(self.counts)) + "\n"
+
+
+def report_error(error_log, source, line_number, transcript, error_code, message):
+    """
+    Add an error record to error_log, or write message to stderr if there is no error log.
+    """
+    if error_log is None:
+        sys.stderr.write(message)
+    else:
+        error_log.add(source, line_number, transcript, error_code)
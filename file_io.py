@@ -0,0 +1,86 @@
+import io
+import os
+import sys
+import gzip
+
+# file name standing for stdin (input files) or stdout (output files)
+STDIO = "-"
+# first bytes of gzip files, bgzip (BGZF) files included
+GZIP_MAGIC = b"\x1f\x8b"
+# names of output files which are gzip compressed
+GZIP_EXTENSIONS = (".gz", ".bgz")
+GZIP_COMPRESS_LEVEL = 6
+
+
+def open_binary_input(file_name):
+    """
+    :param file_name: string, name of the file, or STDIO
+    :return: buffered binary file.  Closing it does not close stdin.
+    """
+    if file_name == STDIO:
+        return open(sys.stdin.fileno(), "rb", closefd=False)
+    return open(file_name, "rb")
+
+
+def is_gzip_stream(in_handle):
+    """
+    :param in_handle: buffered binary file, see open_binary_input
+    :return: boolean, True if the next bytes of the file are the gzip magic bytes.  Nothing is consumed.
+    """
+    return in_handle.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC
+
+
+def is_compressed(file_name):
+    """
+    :param file_name: string, name of a file
+    :return: boolean, True if the file starts with the gzip magic bytes.  False for STDIO, which cannot be read twice.
+    """
+    if file_name == STDIO:
+        return False
+    with open(file_name, "rb") as in_handle:
+        return in_handle.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def open_input(file_name):
+    """
+    Open an input file as text, decompressing gzip and bgzip files on the fly.  Compression is detected by the magic
+    bytes of the file, not its name.
+    :param file_name: string, name of the file, or STDIO to read stdin
+    :return: text file
+    """
+    in_handle = open_binary_input(file_name)
+    if not is_gzip_stream(in_handle):
+        return io.TextIOWrapper(in_handle)
+    if file_name == STDIO:
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=in_handle, mode="rb"))
+    # gzip.open closes the file it opens, a GzipFile does not close the file it is given
+    in_handle.close()
+    return gzip.open(file_name, "rt")
+
+
+def open_output(file_name):
+    """
+    Open an output file as text, gzip compressed if its name ends with one of GZIP_EXTENSIONS.
+    :param file_name: string, name of the file, or STDIO to write to stdout
+    :return: text file.  Closing it does not close stdout.
+    """
+    if file_name == STDIO:
+        sys.stdout.flush()
+        return open(sys.stdout.fileno(), "w", closefd=False)
+    if file_name.lower().endswith(GZIP_EXTENSIONS):
+        return gzip.open(file_name, "wt", compresslevel=GZIP_COMPRESS_LEVEL)
+    return open(file_name, "w")
+
+
+def input_exists(file_name):
+    """
+    :return: boolean, True if file_name is STDIO or an existing file
+    """
+    return file_name == STDIO or os.path.isfile(file_name)
+
+
+def output_directory_exists(file_name):
+    """
+    :return: boolean, True if file_name is STDIO or the directory the file would be written to exists
+    """
+    return file_name == STDIO or os.path.isdir(os.path.dirname(os.path.abspath(file_name)))
@@ -0,0 +1,455 @@
+import io
+import os
+import sys
+import hashlib
+from functools import partial
+from itertools import chain
+from multiprocessing import Pool
+from mappings import parse_cigar
+from error_log import ErrorLog, GENOME_MAPPING_FILE, report_error
+from file_io import STDIO, is_compressed, open_input
+from run_stats import RunStats
+
+# bits of the FLAG column of SAM records
+SAM_UNMAPPED = 0x4
+SAM_REVERSE = 0x10
+SAM_SECONDARY = 0x100
+SAM_SUPPLEMENTARY = 0x800
+# records with any of these bits set are skipped by default, so only primary alignments are used
+SAM_SKIP_FLAGS = SAM_UNMAPPED | SAM_SECONDARY | SAM_SUPPLEMENTARY
+SAM_MANDATORY_COLUMNS = 11
+
+# genome mapping files smaller than this are loaded by one process, whatever the number of workers
+PARALLEL_LOAD_MIN_BYTES = 8 * 2 ** 20
+# byte ranges a genome mapping file is split into per worker, so workers finishing early take more
+PARALLEL_LOAD_CHUNKS_PER_WORKER = 4
+
+
+class GenomicMapping:
+    """
+    Class to hold the input information about the mappings (contents from inputfile1.txt)
+    :param transcriptName: string, transcript name
+    :param: chromosome: string, genomic chromsome
+    :param: pos: int, genomic mapping position (presumably from the sam/bam file). According to spec, this represents the
+                position of the first match.
+    :param: cigar: string, cigar string of alignment of transcript to genome.
+    :param: orientation: string (+/-) which represents if transcript maps 5'->3' or 3'->5'
+    """
+
+    def __init__(self, transcript_name, chromosome, pos, cigar, orientation):
+        self.transcript_name = transcript_name
+        self.chromosome = chromosome
+
+        try:
+            self.pos = int(pos)
+        except:
+            raise ValueError("Invalid alignment position for "+transcript_name+" "+chromosome+" "+pos+"\n")
+
+        if self.pos < 0:
+            raise ValueError("Alignment position is negative for "+transcript_name+" "+chromosome+" "+pos+"\n")
+
+        self.cigar_string = cigar
+        if orientation != "+" and orientation != "-":
+            raise ValueError("Invalid alignment orientation " + str(orientation))
+        self.orientation = orientation
+
+    def fingerprint(self):
+        """
+        :return: string, hex digest of the alignment (cigar string, chromosome, position and orientation).  Equal for
+        the rows of two files which translate the transcript the same way.
+        """
+        alignment = "\t".join((self.cigar_string, self.chromosome, str(self.pos), self.orientation))
+        return hashlib.blake2b(alignment.encode(), digest_size=16).hexdigest()
+
+
+
+def is_valid_cigar(cigar_string, error_log=None, line_number=None, transcript=None, stats=None):
+    """
+    :param cigar_string, string: Input cigar string
+    :param error_log: ErrorLog object an invalid cigar string is recorded in, as an INVALID_CIGAR error of the genome
+    mapping file.  Default reports the reason it is not valid to stderr.
+    :param line_number: int, number of the line of the genome mapping file the cigar string was read from, for the
+    error record
+    :param transcript: string, transcript whose mapping has the cigar string, for the error record
+    :param stats: RunStats object the time of the validation is added to
+    :return: boolean if valid or not
+    """
+
+    try:
+        if stats is None:
+            parse_cigar(cigar_string)
+        else:
+            with stats.phase("cigar_validation"):
+                parse_cigar(cigar_string)
+    except ValueError as e:
+        message = str(e) + "\n"
+        if transcript is not None:
+            message += "Input cigar string is not valid. Skipping " + transcript + " " + cigar_string
+        report_error(error_log, GENOME_MAPPING_FILE, line_number, transcript, "INVALID_CIGAR", message)
+        return False
+    return True
+
+
+def parse_genome_mapping_line(line, error_log=None, line_number=None, stats=None):
+    """
+    Parse one line of the genome mapping file.  Invalid lines are reported to error_log, or to stderr if there is none.
+    :param line, string: line of the genome mapping file
+    :param error_log: ErrorLog object
+    :param line_number: int, number of the line in the genome mapping file, for the error records
+    :param stats: RunStats object the time of the cigar validation is added to
+    :return: GenomicMapping object, None if the line is skipped
+    """
+    data = line.rstrip().split("\t")
+
+    if len(data) < 4:
+        report_error(error_log, GENOME_MAPPING_FILE, line_number, data[0], "TOO_FEW_COLUMNS",
+                     "Line in genome mapping file does have atleast 4 columns. Skipping.\n" + line)
+        return None
+
+    # if not specified in the input file, assume the mapping orientation is 5'=>3'
+
+    mapping_orientation = "+"
+    if len(data) == 5:
+        mapping_orientation = data[4]
+
+    return genomic_mapping_from_fields(data[0], data[1], data[2], data[3], mapping_orientation, error_log, line_number,
+                                       stats)
+
+
+def parse_sam_line(line, error_log=None, line_number=None, stats=None, skip_flags=SAM_SKIP_FLAGS):
+    """
+    Parse one line of a SAM file: the alignment of transcript QNAME on chromosome RNAME at POS, on the reverse strand
+    if the FLAG has the SAM_REVERSE bit.  The 1-based POS is converted to the 0-based position of the genome mapping
+    file.  Only the mandatory columns are split off the line, not the optional fields.  See parse_genome_mapping_line.
+    :param skip_flags: int, records whose FLAG has any of these bits set are skipped (counted as sam_records_skipped
+    in stats, not reported)
+    :return: GenomicMapping object, None if the line is a header line or the record is skipped
+    """
+    if line.startswith("@"):
+        return None
+
+    data = line.split("\t", SAM_MANDATORY_COLUMNS - 1)
+    if len(data) < SAM_MANDATORY_COLUMNS:
+        report_error(error_log, GENOME_MAPPING_FILE, line_number, data[0], "TOO_FEW_COLUMNS",
+                     "Record in SAM file does not have the " + str(SAM_MANDATORY_COLUMNS) +
+                     " mandatory columns. Skipping.\n" + line)
+        return None
+
+    try:
+        flag = int(data[1])
+    except ValueError:
+        report_error(error_log, GENOME_MAPPING_FILE, line_number, data[0], "INVALID_MAPPING",
+                     "Excluding: " + data[0] + " from analysis - invalid FLAG " + data[1] + ".\n")
+        return None
+    if flag & skip_flags:
+        if stats is not None:
+            stats.count("sam_records_skipped")
+        return None
+
+    # POS is 1-based, the position of the genome mapping file 0-based.  POS 0 is only for unmapped records.
+    try:
+        pos = int(data[3]) - 1
+    except ValueError:
+        pos = -1
+    if pos < 0:
+        report_error(error_log, GENOME_MAPPING_FILE, line_number, data[0], "INVALID_MAPPING",
+                     "Excluding: " + data[0] + " from analysis - invalid POS " + data[3] + ".\n")
+        return None
+
+    mapping_orientation = "-" if flag & SAM_REVERSE else "+"
+    return genomic_mapping_from_fields(data[0], data[2], pos, data[5], mapping_orientation, error_log, line_number,
+                                       stats)
+
+
+def genomic_mapping_from_fields(transcript, chromosome, pos, cigar, orientation, error_log=None, line_number=None,
+                                stats=None):
+    """
+    Validate the fields of a mapping read from a line of the genome mapping file.  See parse_genome_mapping_line.
+    :return: GenomicMapping object, None if the fields are not valid
+    """
+    if not is_valid_cigar(cigar, error_log, line_number, transcript, stats):
+        return None
+
+    try:
+        GM = GenomicMapping(transcript, chromosome, pos, cigar, orientation)
+    except:
+        report_error(error_log, GENOME_MAPPING_FILE, line_number, transcript, "INVALID_MAPPING",
+                     "Excluding: "+transcript+" from analysis - invalid input data.\n")
+        return None
+    return GM
+
+
+def is_sam_file(genome_mapping_file, first_line=None):
+    """
+    :param genome_mapping_file, string: Name of a genome mapping file
+    :param first_line: string, first line of the file if it has already been read (e.g. from stdin)
+    :return: boolean, True if it is a SAM file: its name ends with .sam (or .sam.gz), or its first line is a SAM header
+    line or has the mandatory SAM columns
+    """
+    if genome_mapping_file.lower().endswith((".sam", ".sam.gz")):
+        return True
+    if first_line is None:
+        with open_input(genome_mapping_file) as in_handle:
+            first_line = in_handle.readline()
+    return first_line.startswith("@") or first_line.count("\t") >= SAM_MANDATORY_COLUMNS - 1
+
+
+def genome_mapping_parser(genome_mapping_file, sam_skip_flags=SAM_SKIP_FLAGS, first_line=None):
+    """
+    :param genome_mapping_file, string: Name of a genome mapping file, or of a SAM file (see is_sam_file)
+    :param sam_skip_flags: int, FLAG bits of the SAM records which are skipped, see parse_sam_line
+    :param first_line: string, see is_sam_file
+    :return: function parsing one of its lines, with the parameters of parse_genome_mapping_line
+    """
+    if is_sam_file(genome_mapping_file, first_line):
+        return partial(parse_sam_line, skip_flags=sam_skip_flags)
+    return parse_genome_mapping_line
+
+
+def load_genome_mappings(genome_mapping_file, error_log=None, stats=None, sam_skip_flags=SAM_SKIP_FLAGS, workers=1):
+    """
+    Read the genome mapping file, or a SAM file, one line at a time.  Invalid lines are reported (see
+    parse_genome_mapping_line) and skipped.
+    :param genome_mapping_file, string: Name of file specifying alignment of transcript to genome, possibly gzip or
+    bgzip compressed.  STDIO reads stdin.
+    :param error_log: ErrorLog object invalid lines are recorded in.  Default reports them to stderr.
+    :param stats: RunStats object the number of lines read and the cigar validation time are added to
+    :param sam_skip_flags: int, FLAG bits of the SAM records which are skipped, see parse_sam_line
+    :param workers: int, number of processes parsing an uncompressed file of at least PARALLEL_LOAD_MIN_BYTES, see
+    load_genome_mappings_parallel
+    :return: dict of transcript name -> GenomicMapping object
+    """
+    if workers > 1 and genome_mapping_file != STDIO and not is_compressed(genome_mapping_file) and \
+            os.path.getsize(genome_mapping_file) >= PARALLEL_LOAD_MIN_BYTES:
+        return load_genome_mappings_parallel(genome_mapping_file, workers, error_log, stats, sam_skip_flags)
+
+    mappings = {}
+    line_number = 0
+    with open_input(genome_mapping_file) as in_handle:
+        # the format is told from the first line, which cannot be read again from stdin
+        first_line = in_handle.readline()
+        parse_line = genome_mapping_parser(genome_mapping_file, sam_skip_flags, first_line)
+        for line_number, line in enumerate(chain([first_line], in_handle) if first_line else in_handle, 1):
+            GM = parse_line(line, error_log, line_number, stats)
+            if GM is not None:
+                mappings[GM.transcript_name] = GM
+    if stats is not None:
+        stats.count("mapping_lines_read", line_number)
+    return mappings
+
+
+def line_aligned_offsets(file_name, n_chunks):
+    """
+    Split a file in byte ranges of whole lines.
+    :param file_name: string, name of an uncompressed file
+    :param n_chunks: int, number of ranges of about the same size
+    :return: list of the offsets the ranges start at, followed by the size of the file.  Every offset but the last is
+    the start of a line.  Fewer than n_chunks ranges if lines are longer than the ranges.
+    """
+    size = os.path.getsize(file_name)
+    offsets = [0]
+    with open(file_name, "rb") as in_handle:
+        for i in range(1, n_chunks):
+            offset = size * i // n_chunks
+            if offset <= offsets[-1]:
+                continue
+            # the range ends after the line the offset is in; a range ending at the end of a line is kept as is
+            in_handle.seek(offset - 1)
+            in_handle.readline()
+            offset = in_handle.tell()
+            if offsets[-1] < offset < size:
+                offsets.append(offset)
+    offsets.append(size)
+    return offsets
+
+
+def load_genome_mapping_chunk(chunk):
+    """
+    Parse the lines of a byte range of a genome mapping file in a worker process.
+    :param chunk: tuple (name of the file, start offset, stop offset, function parsing a line (see
+    genome_mapping_parser), boolean: record errors (instead of reporting them to stderr), boolean: collect stats)
+    :return: tuple (dict of transcript name -> GenomicMapping object of the range, last line wins, number of lines of
+    the range, list of error records with line numbers counted from the start of the range, stats as returned by
+    RunStats.as_dict or None)
+    """
+    genome_mapping_file, start, stop, parse_line, record_errors, collect_stats = chunk
+    error_log = ErrorLog(buffer_size=None) if record_errors else None
+    stats = RunStats() if collect_stats else None
+    with open(genome_mapping_file, "rb") as in_handle:
+        in_handle.seek(start)
+        data = in_handle.read(stop - start)
+
+    mappings = {}
+    line_number = 0
+    # lines are split as when the file is read as text by open_input
+    for line_number, line in enumerate(io.TextIOWrapper(io.BytesIO(data)), 1):
+        GM = parse_line(line, error_log, line_number, stats)
+        if GM is not None:
+            mappings[GM.transcript_name] = GM
+    return (mappings, line_number, error_log.take_records() if record_errors else [],
+            stats.as_dict() if collect_stats else None)
+
+
+def load_genome_mappings_parallel(genome_mapping_file, workers, error_log=None, stats=None,
+                                  sam_skip_flags=SAM_SKIP_FLAGS, n_chunks=None):
+    """
+    load_genome_mappings with the lines parsed and validated by a pool of processes: the file is split in byte ranges
+    of whole lines (see line_aligned_offsets), and the tables of the ranges are merged in file order, so the last valid
+    line of a transcript wins as when the file is read by one process.  Error records have the same line numbers and
+    order.  See load_genome_mappings for the other parameters.
+    :param genome_mapping_file: string, name of an uncompressed genome mapping file or SAM file
+    :param workers: int, number of processes
+    :param n_chunks: int, number of byte ranges.  Default is PARALLEL_LOAD_CHUNKS_PER_WORKER per worker.
+    :return: dict of transcript name -> GenomicMapping object
+    """
+    if n_chunks is None:
+        n_chunks = workers * PARALLEL_LOAD_CHUNKS_PER_WORKER
+    parse_line = genome_mapping_parser(genome_mapping_file, sam_skip_flags)
+    offsets = line_aligned_offsets(genome_mapping_file, n_chunks)
+    chunks = [(genome_mapping_file, start, stop, parse_line, error_log is not None, stats is not None)
+              for start, stop in zip(offsets, offsets[1:])]
+
+    mappings = {}
+    n_lines = 0
+    pool = Pool(workers)
+    try:
+        # imap returns the ranges in file order
+        for chunk_mappings, chunk_lines, error_records, chunk_stats in pool.imap(load_genome_mapping_chunk, chunks):
+            mappings.update(chunk_mappings)
+            for source, line_number, transcript, error_code in error_records:
+                error_log.add(source, n_lines + line_number, transcript, error_code)
+            if stats is not None:
+                stats.merge(chunk_stats)
+            n_lines += chunk_lines
+    finally:
+        pool.terminate()
+        pool.join()
+    if stats is not None:
+        stats.count("mapping_lines_read", n_lines)
+    return mappings
+
+
+class GenomeMappingIndex:
+    """
+    Lazy, read-only dict of transcript name -> GenomicMapping over a genome mapping file.  A sidecar index of the byte
+    offset of every line is built once and reused while the size and modification time of the genome mapping file
+    match those it was built from.  Lines are only read and validated when their transcript is looked up.
+    :param genome_mapping_file, string: Name of file specifying alignment of transcript to genome.  Lines are read at
+    their offset, so it cannot be compressed or STDIO.
+    :param index_file, string: Name of the sidecar index.  Default is the genome mapping file name with .idx appended.
+    :param error_log: ErrorLog object invalid lines are recorded in when they are read, with no line number.  Default
+    reports them to stderr.
+    :param sam_skip_flags: int, FLAG bits of the records which are skipped if the file is a SAM file
+    """
+
+    def __init__(self, genome_mapping_file, index_file=None, error_log=None, sam_skip_flags=SAM_SKIP_FLAGS):
+        self.genome_mapping_file = genome_mapping_file
+        self.index_file = index_file
+        self.error_log = error_log
+        if genome_mapping_file == STDIO or is_compressed(genome_mapping_file):
+            raise ValueError("Genome mapping index needs an uncompressed genome mapping file: " + genome_mapping_file)
+        self.is_sam = is_sam_file(genome_mapping_file)
+        self.parse_line = genome_mapping_parser(genome_mapping_file, sam_skip_flags)
+        if self.index_file is None:
+            self.index_file = genome_mapping_file + ".idx"
+
+        self.offsets = None  # transcript name -> list of byte offsets of its lines, in file order
+        self._parsed = {}  # transcript name -> GenomicMapping object (None if none of its lines is valid)
+        self._handle = None
+
+        file_stat = os.stat(genome_mapping_file)
+        self.file_signature = str(file_stat.st_size) + "\t" + str(file_stat.st_mtime_ns)
+        self.offsets = self.read_index()
+        if self.offsets is None:
+            self.offsets = self.build_index()
+            self.write_index()
+
+    def read_index(self):
+        """
+        :return: dict of transcript name -> list of offsets from the sidecar index, None if it is missing or stale
+        """
+        if not os.path.isfile(self.index_file):
+            return None
+
+        offsets = {}
+        with open(self.index_file) as in_handle:
+            if in_handle.readline().rstrip("\n") != "#" + self.file_signature:
+                return None
+            for line in in_handle:
+                transcript, offset = line.rstrip("\n").split("\t")
+                offsets.setdefault(transcript, []).append(int(offset))
+        return offsets
+
+    def build_index(self):
+        """
+        :return: dict of transcript name -> list of offsets of the lines of the genome mapping file
+        """
+        offsets = {}
+        offset = 0
+        with open(self.genome_mapping_file, "rb") as in_handle:
+            for line in in_handle:
+                if self.is_sam and line.startswith(b"@"):
+                    # header line
+                    offset += len(line)
+                    continue
+                transcript = line.split(b"\t", 1)[0].decode()
+                offsets.setdefault(transcript, []).append(offset)
+                offset += len(line)
+        return offsets
+
+    def write_index(self):
+        try:
+            with open(self.index_file, "w") as o_handle:
+                o_handle.write("#" + self.file_signature + "\n")
+                for transcript, transcript_offsets in self.offsets.items():
+                    for offset in transcript_offsets:
+                        o_handle.write(transcript + "\t" + str(offset) + "\n")
+        except (IOError, OSError):
+            sys.stderr.write("Could not write genome mapping index " + self.index_file + ". Index is kept in memory.\n")
+
+    def read_line(self, offset):
+        if self._handle is None:
+            self._handle = open(self.genome_mapping_file, "rb")
+        self._handle.seek(offset)
+        return self._handle.readline().decode()
+
+    def get(self, transcript, default=None):
+        if transcript not in self._parsed:
+            GM = None
+            # as when the whole file is loaded, the last valid line of a transcript wins
+            for offset in reversed(self.offsets.get(transcript, [])):
+                GM = self.parse_line(self.read_line(offset), self.error_log)
+                if GM is not None and GM.transcript_name == transcript:
+                    break
+                GM = None
+            self._parsed[transcript] = GM
+
+        GM = self._parsed[transcript]
+        if GM is None:
+            return default
+        return GM
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __contains__(self, transcript):
+        return self.get(transcript) is not None
+
+    def __getitem__(self, transcript):
+        GM = self.get(transcript)
+        if GM is None:
+            raise KeyError(transcript)
+        return GM
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __getstate__(self):
+        # open file handles cannot be sent to worker processes; they reopen the file on first lookup.  Workers
+        # record errors in their own error log.
+        state = self.__dict__.copy()
+        state["_handle"] = None
+        state["error_log"] = None
+        return state
@@ -0,0 +1,110 @@
+from bisect import bisect_left
+
+
+class NestedContainmentList:
+    """
+    Nested containment list over closed intervals: intervals contained in another one are moved to a sublist of it,
+    so in every list both starts and stops are sorted and the intervals overlapping a position are found with one
+    binary search per list visited, O(log n + k).
+    :param intervals: list of (start, stop, value) tuples
+    """
+
+    def __init__(self, intervals):
+        self.starts = []
+        self.stops = []
+        self.values = []
+
+        # list index -> indices of the intervals in the list; list 0 is the top level list, the sublist of
+        # interval i is list i + 1
+        members = {0: []}
+
+        # sorting by start, longest first, puts every interval after all the intervals containing it
+        order = sorted(range(len(intervals)), key=lambda i: (intervals[i][0], -intervals[i][1]))
+        stack = []
+        for i in order:
+            start, stop, value = intervals[i]
+            while stack and self.stops[stack[-1]] < stop:
+                stack.pop()
+            parent_list = 0
+            if stack:
+                parent_list = stack[-1] + 1
+
+            interval_index = len(self.starts)
+            self.starts.append(start)
+            self.stops.append(stop)
+            self.values.append(value)
+            members.setdefault(parent_list, []).append(interval_index)
+            stack.append(interval_index)
+
+        # list index -> (interval indices, their stops) for the lists which are not empty
+        self.lists = {}
+        for list_index, interval_indices in members.items():
+            self.lists[list_index] = (interval_indices, [self.stops[i] for i in interval_indices])
+
+    def find(self, position):
+        """
+        :param position: int
+        :return: list of the values of the intervals containing position, ordered by start
+        """
+        found = []
+        pending = [0]
+        while pending:
+            list_index = pending.pop()
+            if list_index not in self.lists:
+                continue
+            interval_indices, stops = self.lists[list_index]
+
+            # first interval of the list whose stop is not lower than the position
+            j = bisect_left(stops, position)
+            while j < len(interval_indices) and self.starts[interval_indices[j]] <= position:
+                i = interval_indices[j]
+                found.append(i)
+                pending.append(i + 1)
+                j += 1
+
+        found.sort()
+        return [self.values[i] for i in found]
+
+
+class GenomicIntervalIndex:
+    """
+    Index of the genomic span of every loaded mapping, one nested containment list per chromosome, to find all the
+    transcripts overlapping a genomic position without naming them.
+    :param genome_mappings: iterable of (GenomicMapping, Mappings) tuples
+    """
+
+    def __init__(self, genome_mappings):
+        intervals = {}
+        for genome_mapping_info, query_mapping in genome_mappings:
+            # span of the alignment, known without expanding its ranges
+            start = query_mapping.genomic_mapping_pos
+            stop = start + query_mapping.genomic_length - 1
+            intervals.setdefault(genome_mapping_info.chromosome, []).append(
+                (start, stop, (genome_mapping_info, query_mapping)))
+
+        self.chromosomes = {}
+        for chromosome, chromosome_intervals in intervals.items():
+            self.chromosomes[chromosome] = NestedContainmentList(chromosome_intervals)
+
+    def find(self, chromosome, position):
+        """
+        :param chromosome: string
+        :param position: int, genomic position
+        :return: list of (GenomicMapping, Mappings) tuples of the mappings whose alignment spans the position, ordered
+        by the genomic start of the alignment
+        """
+        if chromosome not in self.chromosomes:
+            return []
+        return self.chromosomes[chromosome].find(position)
+
+    def genomic_to_transcript_pos(self, chromosome, position, with_status=False):
+        """
+        Translate a genomic position on every transcript overlapping it.
+        :param chromosome: string
+        :param position: int, genomic position
+        :param with_status: boolean, return the POS_* code of every translation, see Mappings.get_pos_status
+        :return: list of (GenomicMapping, (min_pos, max_pos)) tuples, see Mappings.get_pos.  With with_status, list of
+        (GenomicMapping, ((min_pos, max_pos), status)) tuples.
+        """
+        return [(genome_mapping_info, query_mapping.genomic_to_transcript_pos(position, query_mapping, with_status))
+                for genome_mapping_info, query_mapping in self.find(chromosome, position)]
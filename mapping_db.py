@@ -0,0 +1,230 @@
+import mmap
+import struct
+from array import array
+from mappings import Mappings
+from genome_mapping import GenomicMapping, SAM_SKIP_FLAGS, load_genome_mappings
+from error_log import GENOME_MAPPING_FILE, report_error
+from file_io import STDIO
+
+# Compiled genome mapping database.  Layout (native byte order, every section aligned to 8 bytes):
+#
+#     header     MAGIC, then int64 byte order mark, number of transcripts, number of cigar operations, size of strings
+#     entries    ENTRY_FIELDS int64 per transcript, sorted by transcript name
+#     operations uint8 per cigar operation
+#     op_lengths, query_starts, query_stops, reference_starts, reference_stops
+#                int64 per cigar operation
+#     strings    transcript names, chromosomes and cigar strings (utf-8)
+#
+# The cigar operations of a transcript are the slice [OP_START, OP_START + OP_COUNT) of the operation arrays.  A
+# transcript whose Mappings could not be built is stored with no operations.
+
+MAGIC = b"TCMAPDB1"
+HEADER = struct.Struct("=8sqqqq")
+BYTE_ORDER_MARK = 1
+
+# fields of an entry
+ENTRY_FIELDS = 10
+(NAME_OFFSET, NAME_LENGTH, CHROMOSOME_OFFSET, CHROMOSOME_LENGTH, CIGAR_OFFSET, CIGAR_LENGTH, POS, ORIENTATION,
+ OP_START, OP_COUNT) = range(ENTRY_FIELDS)
+
+
+def is_mapping_database(file_name):
+    """
+    :param file_name, string: Name of a file
+    :return: boolean, True if the file starts like a compiled genome mapping database.  False for STDIO.
+    """
+    if file_name == STDIO:
+        return False
+    with open(file_name, "rb") as in_handle:
+        return in_handle.read(len(MAGIC)) == MAGIC
+
+
+def padding(size):
+    return (-size) % 8
+
+
+def compile_mapping_database(genome_mapping_file, database_file, error_log=None, sam_skip_flags=SAM_SKIP_FLAGS):
+    """
+    Validate a genome mapping file, build the ranges of every transcript and write them to a database file.
+    :param genome_mapping_file, string: Name of file specifying alignment of transcript to genome, or of a SAM file.
+    :param database_file, string: Name of the database file to write.
+    :param error_log: ErrorLog object invalid lines and mappings are recorded in.  Default reports them to stderr.
+    :param sam_skip_flags: int, FLAG bits of the SAM records which are skipped, see parse_sam_line
+    :return: int, number of transcripts written
+    """
+    genome_mappings = load_genome_mappings(genome_mapping_file, error_log, sam_skip_flags=sam_skip_flags)
+
+    entries = array('q')
+    strings = bytearray()
+    operations = array('B')
+    columns = [array('q') for i in range(5)]  # op_lengths, query_starts, query_stops, reference_starts, ..._stops
+
+    def add_string(value):
+        encoded = value.encode()
+        strings.extend(encoded)
+        return len(strings) - len(encoded), len(encoded)
+
+    for transcript in sorted(genome_mappings, key=lambda name: name.encode()):
+        GM = genome_mappings[transcript]
+        op_start = len(operations)
+        op_count = 0
+        try:
+            M = Mappings(GM.cigar_string, GM.chromosome, GM.pos, GM.orientation)
+        except:
+            report_error(error_log, GENOME_MAPPING_FILE, None, transcript, "MAPPING_FAILED",
+                         "Could not process this mapping.  Storing "+transcript+" without alignment.\n")
+        else:
+            operations.extend(M.operations)
+            for column, values in zip(columns, (M.op_lengths, M.query_starts, M.query_stops, M.reference_starts,
+                                                M.reference_stops)):
+                column.extend(values)
+            op_count = len(M.operations)
+
+        entries.extend(add_string(transcript))
+        entries.extend(add_string(GM.chromosome))
+        entries.extend(add_string(GM.cigar_string))
+        entries.extend((GM.pos, ord(GM.orientation), op_start, op_count))
+
+    with open(database_file, "wb") as o_handle:
+        o_handle.write(HEADER.pack(MAGIC, BYTE_ORDER_MARK, len(genome_mappings), len(operations), len(strings)))
+        o_handle.write(entries.tobytes())
+        o_handle.write(operations.tobytes() + b"\0" * padding(len(operations)))
+        for column in columns:
+            o_handle.write(column.tobytes())
+        o_handle.write(bytes(strings))
+
+    return len(genome_mappings)
+
+
+class MappingDatabase:
+    """
+    Read-only, dict-like view of a compiled genome mapping database (transcript name -> GenomicMapping), memory-mapped
+    so processes on the same host share its pages.  Mappings objects are built directly over the mapped range
+    arrays by get_mappings.
+    :param database_file, string: Name of the database file written by compile_mapping_database.
+    """
+
+    def __init__(self, database_file):
+        self.database_file = database_file
+        self._parsed = {}  # transcript name -> (GenomicMapping, entry index); None if not in the database
+        self.open()
+
+    def open(self):
+        with open(self.database_file, "rb") as in_handle:
+            self._mmap = mmap.mmap(in_handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, byte_order_mark, self.n_transcripts, n_operations, strings_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError("Not a genome mapping database: " + self.database_file)
+        if byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError("Genome mapping database was compiled on a machine with a different byte order: " +
+                             self.database_file)
+
+        view = memoryview(self._mmap)
+        offset = HEADER.size + padding(HEADER.size)
+
+        sections = []
+        for size, format in ((self.n_transcripts * ENTRY_FIELDS * 8, 'q'), (n_operations, 'B'),
+                             (n_operations * 8, 'q'), (n_operations * 8, 'q'), (n_operations * 8, 'q'),
+                             (n_operations * 8, 'q'), (n_operations * 8, 'q'), (strings_size, 'B')):
+            sections.append(view[offset:offset + size].cast(format))
+            offset += size + padding(size)
+        view.release()
+
+        (self.entries, self.operations, self.op_lengths, self.query_starts, self.query_stops, self.reference_starts,
+         self.reference_stops, self.strings) = sections
+
+    def entry(self, i, field):
+        return self.entries[i * ENTRY_FIELDS + field]
+
+    def string(self, i, field):
+        offset = self.entry(i, field)
+        return bytes(self.strings[offset:offset + self.entry(i, field + 1)]).decode()
+
+    def find(self, transcript):
+        """
+        Binary search the entries for a transcript name.
+        :return: int, entry index; None if the transcript is not in the database
+        """
+        name = transcript.encode()
+        low = 0
+        high = self.n_transcripts
+        while low < high:
+            middle = (low + high) // 2
+            offset = self.entry(middle, NAME_OFFSET)
+            if bytes(self.strings[offset:offset + self.entry(middle, NAME_LENGTH)]) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.n_transcripts and self.string(low, NAME_OFFSET) == transcript:
+            return low
+        return None
+
+    def get(self, transcript, default=None):
+        if transcript not in self._parsed:
+            i = self.find(transcript)
+            if i is None:
+                self._parsed[transcript] = None
+            else:
+                GM = GenomicMapping(transcript, self.string(i, CHROMOSOME_OFFSET), self.entry(i, POS),
+                                    self.string(i, CIGAR_OFFSET), chr(self.entry(i, ORIENTATION)))
+                self._parsed[transcript] = (GM, i)
+
+        if self._parsed[transcript] is None:
+            return default
+        return self._parsed[transcript][0]
+
+    def __iter__(self):
+        for i in range(self.n_transcripts):
+            yield self.string(i, NAME_OFFSET)
+
+    def __contains__(self, transcript):
+        return self.get(transcript) is not None
+
+    def __getitem__(self, transcript):
+        GM = self.get(transcript)
+        if GM is None:
+            raise KeyError(transcript)
+        return GM
+
+    def get_mappings(self, genome_mapping_info):
+        """
+        Build the Mappings object of a transcript over the mapped range arrays.
+        :param genome_mapping_info: GenomicMapping object returned by this database
+        :return: Mappings object.  Raises ValueError if the mapping could not be built at compile time.
+        """
+        if self.get(genome_mapping_info.transcript_name) is None:
+            raise KeyError(genome_mapping_info.transcript_name)
+        i = self._parsed[genome_mapping_info.transcript_name][1]
+
+        op_start = self.entry(i, OP_START)
+        op_stop = op_start + self.entry(i, OP_COUNT)
+        if op_stop == op_start:
+            raise ValueError("No alignment stored for " + genome_mapping_info.transcript_name)
+
+        return Mappings.from_arrays(genome_mapping_info.cigar_string, genome_mapping_info.chromosome,
+                                    genome_mapping_info.pos, genome_mapping_info.orientation,
+                                    self.operations[op_start:op_stop], self.op_lengths[op_start:op_stop],
+                                    self.query_starts[op_start:op_stop], self.query_stops[op_start:op_stop],
+                                    self.reference_starts[op_start:op_stop], self.reference_stops[op_start:op_stop])
+
+    def close(self):
+        # views of the mapping must be released before it can be closed
+        for name in ("entries", "operations", "op_lengths", "query_starts", "query_stops", "reference_starts",
+                     "reference_stops", "strings"):
+            getattr(self, name).release()
+        self._parsed = {}
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Mappings objects built by get_mappings still use the mapping; it is unmapped once they are released
+            pass
+
+    def __getstate__(self):
+        # worker processes map the database themselves
+        return {"database_file": self.database_file}
+
+    def __setstate__(self, state):
+        self.database_file = state["database_file"]
+        self._parsed = {}
+        self.open()
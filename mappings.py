@@ -1,6 +1,192 @@
 import os
 import sys
 import re
+import weakref
+from array import array
+from itertools import compress
+from bisect import bisect_left
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# status codes of a queried position, returned by the get_pos_status and batch translation methods
+POS_OK = 0
+POS_NEGATIVE = 1  # query position is negative
+POS_AFTER_END = 2  # query position is greater than the last coordinate of the alignment
+POS_BEFORE_START = 3  # query position is lower than the first coordinate of the alignment
+POS_NOT_FOUND = 4  # query position could not be located in the alignment
+POS_BOTH_REVERSE = 5  # query and reference ranges are both on the reverse strand
+POS_INVALID_INTERVAL = 6  # start of a queried interval is greater than its end
+
+# message reported to stderr, and error code of the structured error records, of every failure status
+POS_MESSAGES = {
+    POS_NEGATIVE: "Query position is negative.  Cannot process. Skipping\n",
+    POS_AFTER_END: "Requested position is greater than the length of the alignment of query on ref.\n",
+    POS_BEFORE_START: "Requested position is lower than the first coordinate annotated.\n",
+    POS_NOT_FOUND: "Could not locate position in query sequence\n",
+    POS_BOTH_REVERSE: "Query and reference mappings cannot both be on reverse strand. Skipping\n",
+    POS_INVALID_INTERVAL: "Start of the requested interval is greater than its end. Skipping\n",
+}
+POS_ERROR_CODES = {
+    POS_NEGATIVE: "NEGATIVE_POSITION",
+    POS_AFTER_END: "POSITION_AFTER_END",
+    POS_BEFORE_START: "POSITION_BEFORE_START",
+    POS_NOT_FOUND: "POSITION_NOT_FOUND",
+    POS_BOTH_REVERSE: "BOTH_STRANDS_REVERSE",
+    POS_INVALID_INTERVAL: "INVALID_INTERVAL",
+}
+
+# codes of the cigar operations as stored in Mappings.operations
+CIGAR_MATCH = ord("M")
+CIGAR_INSERTION = ord("I")
+CIGAR_DELETION = ord("D")
+CIGAR_SKIP = ord("N")
+CIGAR_SOFT_CLIP = ord("S")
+CIGAR_HARD_CLIP = ord("H")
+CIGAR_PADDING = ord("P")
+CIGAR_SEQUENCE_MATCH = ord("=")
+CIGAR_SEQUENCE_MISMATCH = ord("X")
+
+SUPPORTED_CIGAR_OPERATIONS = "MIDNSHP=X"
+# operations with bases aligned in both sequences, with bases only in the transcript (query), and with bases only in
+# the reference.  Hard clips and padding have bases in neither: they are validated but have no range and are not stored
+ALIGNED_OPERATIONS = frozenset(map(ord, "M=X"))
+QUERY_ONLY_OPERATIONS = frozenset(map(ord, "IS"))
+REFERENCE_ONLY_OPERATIONS = frozenset(map(ord, "DN"))
+UNSTORED_OPERATIONS = "HP"
+CIGAR_CACHE_SIZE = 65536  # number of distinct cigar strings whose parsed operations are kept by parse_cigar
+RANGE_CHUNK_SIZE = 256  # number of operations whose ranges are expanded at a time, see Mappings.expand_ranges
+# 1 for the codes of the operations with bases in the transcript and with bases in the reference, to sum their lengths
+# with bytes.translate and itertools.compress instead of a loop over the operations
+QUERY_OPERATION_MASK = bytes(1 if code in ALIGNED_OPERATIONS | QUERY_ONLY_OPERATIONS else 0 for code in range(256))
+REFERENCE_OPERATION_MASK = bytes(1 if code in ALIGNED_OPERATIONS | REFERENCE_ONLY_OPERATIONS else 0
+                                 for code in range(256))
+
+DENSE_TABLE_MAX_SPAN = 10000  # longest transcript or genomic span a dense lookup table is built for by default
+DENSE_TABLE_BUDGET = 256 * 2 ** 20  # default bytes of dense lookup tables, across all Mappings objects
+DENSE_TABLE_MIN_HITS = 32  # lookups of a transcript in a MappingsCache before its dense lookup tables are built
+
+CIGAR_TOKEN = re.compile(r'(\d+)([A-Z=])')
+# hard clips can only be the first and last operations, and only hard clips can be between soft clips and the ends
+CIGAR_CLIPPING = re.compile(r'H?S?[^HS]*S?H?$')
+
+
+def cigar_error(cigar_string, position):
+    """
+    Describe why a cigar string cannot be tokenized at a position.
+    :return: string, error message
+    """
+    length_end = position
+    while length_end < len(cigar_string) and cigar_string[length_end].isdigit():
+        length_end += 1
+
+    if length_end == len(cigar_string):
+        return "Cigar length without an operation at position " + str(position) + " of cigar " + cigar_string + "."
+    if length_end == position and ("A" <= cigar_string[position] <= "Z" or cigar_string[position] == "="):
+        return "Cigar operation " + cigar_string[position] + " without a length at position " + str(position) + \
+               " of cigar " + cigar_string + "."
+    return "Unexpected character " + repr(cigar_string[length_end]) + " at position " + str(length_end) + \
+           " of cigar " + cigar_string + "."
+
+
+@lru_cache(maxsize=CIGAR_CACHE_SIZE)
+def parse_cigar(cigar_string):
+    """
+    Validate and tokenize a cigar string in a single pass.  Results are memoized by cigar string, so they are shared by
+    every mapping with the same cigar and must not be modified.
+    :param cigar_string, string: Input cigar string
+    :return: tuple (operations, op_lengths): array of cigar operation codes (e.g. CIGAR_MATCH) and array of lengths.
+    Hard clips and padding are not stored, see UNSTORED_OPERATIONS.  Raises ValueError describing the first invalid
+    element if the cigar string is not valid.
+    """
+    if not cigar_string:
+        raise ValueError("Cigar string is empty.")
+
+    operations = array('B')
+    op_lengths = array('q')
+    operation_letters = []
+    position = 0
+    for match in CIGAR_TOKEN.finditer(cigar_string):
+        if match.start() != position:
+            break
+        operation = match.group(2)
+        if operation not in SUPPORTED_CIGAR_OPERATIONS:
+            raise ValueError("Invalid cigar operation: " + operation + " at position " + str(match.start(2)) +
+                             " of cigar " + cigar_string + ".")
+        operation_letters.append(operation)
+        position = match.end()
+        if operation in UNSTORED_OPERATIONS:
+            continue
+        operations.append(ord(operation))
+        op_lengths.append(int(match.group(1)))
+
+    if position != len(cigar_string):
+        raise ValueError(cigar_error(cigar_string, position))
+    if not CIGAR_CLIPPING.match("".join(operation_letters)):
+        raise ValueError("Clipping operations H and S can only be at the ends of cigar " + cigar_string + ".")
+    if not operations:
+        raise ValueError("Cigar " + cigar_string + " has no operation with bases in the transcript or the reference.")
+    return operations, op_lengths
+
+
+def operations_length(operations, op_lengths, operation_mask):
+    """
+    :param operations: array of cigar operation codes
+    :param op_lengths: array of the lengths of the operations
+    :param operation_mask: bytes, 1 for the codes of the operations counted, e.g. QUERY_OPERATION_MASK
+    :return: int, sum of the lengths of the operations counted
+    """
+    return sum(compress(op_lengths, bytes(operations).translate(operation_mask)))
+
+
+def expanded_ranges_property(name, doc):
+    """
+    :return: property returning the range array name of a Mappings object, after expanding every range
+    """
+    def get_ranges(self):
+        if not self.ranges_expanded:
+            self.expand_ranges()
+        return getattr(self, name)
+    return property(get_ranges, doc=doc)
+
+
+class DenseTableBudget:
+    """
+    Memory budget of the dense lookup tables of Mappings objects (see Mappings.build_dense_tables).  The bytes of the
+    tables of a Mappings object are released when it is garbage collected, e.g. evicted from a MappingsCache.
+    :param max_span: int, tables are only built for transcripts, and genomic spans, of at most max_span positions
+    :param max_bytes: int, total size of the tables built and not yet released
+    """
+
+    def __init__(self, max_span=DENSE_TABLE_MAX_SPAN, max_bytes=DENSE_TABLE_BUDGET):
+        self.max_span = max_span
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.tables_built = 0
+        self.tables_refused = 0  # tables short enough but over the budget
+
+    def reserve(self, n_bytes):
+        """
+        :return: boolean, True if n_bytes fit in the budget, and are then counted as used
+        """
+        if self.used_bytes + n_bytes > self.max_bytes:
+            self.tables_refused += 1
+            return False
+        self.used_bytes += n_bytes
+        self.tables_built += 1
+        return True
+
+    def release(self, n_bytes):
+        self.used_bytes -= n_bytes
+
+    def __getstate__(self):
+        # a copy sent to another process has its own budget, none of which is used yet
+        state = self.__dict__.copy()
+        state["used_bytes"] = 0
+        return state
 
 
 class Mappings:
@@ -18,50 +204,255 @@ class Mappings:
         self.genomic_chr = genomic_chr
         self.genomic_mapping_pos = genomic_mapping_pos
 
-        self.reference_ranges = []  # array of SequenceRange objects representing ranges in the reference,
-
-        # one SequenceRange for each cigar operation
-        self.query_ranges = []  # same as reference_ranges but for ranges in the transcript
-        self.cigar_operations = []  # array of CigarOperations objects for every cigar operation
+        # one entry for every cigar operation in each of the arrays below
+        self.operations = None  # cigar operation code, e.g. CIGAR_MATCH.  Shared with mappings with the same cigar
+        self.op_lengths = None  # length of the cigar operation.  Shared with mappings with the same cigar
+        # ranges of the operations, expanded in cigar order as far as lookups need them, see expand_ranges.  The
+        # query_starts, query_stops, reference_starts, reference_stops and query_scan_stops properties expand them all
+        self._reference_starts = array('q')  # start/stop of the range of the operation in the reference
+        self._reference_stops = array('q')
+        self._query_starts = array('q')  # same as reference_starts/stops but for ranges in the transcript
+        self._query_stops = array('q')
+        self._query_scan_stops = self._query_stops
+        # on the reverse strand: query_stops in 5'->3' order, filled from its end as the ranges are expanded
+        self._query_scan_buffer = None
+        self.ranges_expanded = False  # True once the ranges of every operation are expanded
+        # start of the ranges of the next operation to expand, in the transcript 5'->3' if it mapped on the forward
+        # strand, and in the reference
+        self._next_query_start = 0
+        self._next_reference_start = genomic_mapping_pos
 
         self.is_transcript_forward = True
 
+        # dense lookup tables, see build_dense_tables
+        self.transcript_table = None
+        self.genomic_table = None
+        self.genomic_table_start = None
+
         if alignment_orientation == "-":
             self.is_transcript_forward = False
 
         if not cigar_string:
             raise ValueError("Cigar string not available - cannot process.")
 
-        # populate arrays
         self.populate_cigar_operations()
-        self.populate_ranges()
+        # lengths of the alignment in the transcript and in the reference, without expanding the ranges
+        self.transcript_length = operations_length(self.operations, self.op_lengths, QUERY_OPERATION_MASK)
+        self.genomic_length = operations_length(self.operations, self.op_lengths, REFERENCE_OPERATION_MASK)
+        if 0 in self.op_lengths:
+            # operations of length 0 are only valid for deletions and skipped regions: checked by expanding the ranges
+            self.populate_ranges()
 
 
-    def populate_cigar_operations(self):
+    @classmethod
+    def from_arrays(cls, cigar_string, genomic_chr, genomic_mapping_pos, alignment_orientation, operations, op_lengths,
+                    query_starts, query_stops, reference_starts, reference_stops):
         """
-        Parses the input cigar string and generates a CigarOperation object for every operation.
-        :return: void.  
+        Build a Mappings object from operation and range arrays already populated, e.g. by a compiled mapping
+        database, without parsing the cigar string again.  The arrays (array.array or memoryview objects) are used as
+        they are, not copied.
+        :return: Mappings object
+        """
+        M = cls.__new__(cls)
+        M.cigar_string = cigar_string
+        M.genomic_chr = genomic_chr
+        M.genomic_mapping_pos = genomic_mapping_pos
+        M.is_transcript_forward = alignment_orientation != "-"
+        M.operations = operations
+        M.op_lengths = op_lengths
+        M._query_starts = query_starts
+        M._query_stops = query_stops
+        M._reference_starts = reference_starts
+        M._reference_stops = reference_stops
+        M._query_scan_buffer = None
+        M.ranges_expanded = True
+        M.transcript_table = None
+        M.genomic_table = None
+        M.genomic_table_start = None
+
+        M._query_scan_stops = M._query_stops
+        if not M.is_transcript_forward:
+            M._query_scan_stops = M._query_stops[::-1]
+        M.transcript_length = M._query_scan_stops[-1] + 1
+        M.genomic_length = M._reference_stops[-1] - genomic_mapping_pos + 1
+        return M
+
+
+    @classmethod
+    def compose(cls, first, second):
+        """
+        Compose two mappings into one whose ranges are the merged segments of both, so a two hop translation (e.g.
+        transcript to an assembly, then that assembly to another one) is a single lookup.  The genomic positions of
+        first are the transcript positions of second.  In the composed alignment of the transcript of first to the
+        genome of second, transcript bases aligned through both mappings are aligned, the other transcript bases are
+        insertions (soft clips stay soft clips), and bases of the genome of second which are deleted or skipped in
+        either mapping are deletions or skipped regions.  Positions translated through the composed mapping are the
+        positions translated through first, then second.
+        :param first: Mappings object
+        :param second: Mappings object
+        :return: Mappings object on the chromosome of second.  Raises ValueError if the genomic span of first is not
+        within the transcript of second, or if no transcript base is aligned through both mappings.
+        """
+        # both alignments as steps in increasing order of the shared coordinates: genome of first, transcript of second
+        first_steps = [(chr(operation), op_length) for operation, op_length in zip(first.operations, first.op_lengths)
+                       if op_length]
+        second_operations = [chr(operation) for operation, op_length in zip(second.operations, second.op_lengths)
+                             if op_length]
+        second_lengths = [op_length for op_length in second.op_lengths if op_length]
+        if not second.is_transcript_forward:
+            second_operations.reverse()
+            second_lengths.reverse()
+        not_covered = ("Genomic span of the mapping on " + str(first.genomic_chr) + " is not within the transcript of "
+                       "the mapping on " + str(second.genomic_chr) + ".")
+
+        # walk second up to the first genomic position of first.  second_offset counts the genomic bases of second
+        # walked, second_lengths[j] the bases of its operation j not walked yet
+        j = 0
+        shared = 0
+        second_offset = 0
+        while shared < first.genomic_mapping_pos:
+            if j == len(second_operations):
+                raise ValueError(not_covered)
+            second_operation = second_operations[j]
+            n = second_lengths[j]
+            if second_operation not in "DN":
+                n = min(n, first.genomic_mapping_pos - shared)
+                shared += n
+            if second_operation not in "IS":
+                second_offset += n
+            second_lengths[j] -= n
+            if not second_lengths[j]:
+                j += 1
+
+        steps = []  # (operation, length, genomic offset in second of the first base, None for transcript only bases)
+        for operation, n in first_steps:
+            if operation in "IS":
+                steps.append((operation, n, None))
+                continue
+            while n:
+                while j < len(second_operations) and second_operations[j] in "DN":
+                    steps.append((second_operations[j], second_lengths[j], second_offset))
+                    second_offset += second_lengths[j]
+                    j += 1
+                if j == len(second_operations):
+                    raise ValueError(not_covered)
+                second_operation = second_operations[j]
+                k = min(n, second_lengths[j])
+                if operation in "M=X" and second_operation in "M=X":
+                    steps.append((cls.compose_operation(operation, second_operation), k, second_offset))
+                elif operation in "M=X":
+                    steps.append(("I", k, None))
+                elif second_operation in "M=X":
+                    steps.append((operation, k, second_offset))
+                if second_operation in "M=X":
+                    second_offset += k
+                n -= k
+                second_lengths[j] -= k
+                if not second_lengths[j]:
+                    j += 1
+
+        aligned = [i for i, step in enumerate(steps) if step[0] in "M=X"]
+        if not aligned:
+            raise ValueError("No transcript base of the mapping on " + str(first.genomic_chr) +
+                             " is aligned through the mapping on " + str(second.genomic_chr) + ".")
+        # deletions before the first and after the last aligned base are not part of the alignment
+        steps = [step for i, step in enumerate(steps) if aligned[0] <= i <= aligned[-1] or step[0] in "IS"]
+        operations = []
+        for operation, n, offset in steps:
+            if operations and operations[-1][0] == operation:
+                operations[-1][1] += n
+            else:
+                operations.append([operation, n])
+
+        # genomic span of the composed alignment, as offsets in the walk of second
+        genomic_steps = [(offset, n) for operation, n, offset in steps if offset is not None]
+        if second.is_transcript_forward:
+            genomic_mapping_pos = second.genomic_mapping_pos + genomic_steps[0][0]
+        else:
+            # second is walked from the end of its genomic span
+            genomic_mapping_pos = second.genomic_mapping_pos + second.genomic_length - sum(genomic_steps[-1])
+            operations.reverse()
+        cigar_string = "".join(str(n) + operation for operation, n in operations)
+        alignment_orientation = "+" if first.is_transcript_forward == second.is_transcript_forward else "-"
+        return cls(cigar_string, second.genomic_chr, genomic_mapping_pos, alignment_orientation)
+
+
+    @staticmethod
+    def compose_operation(first_operation, second_operation):
+        """
+        :return: string, operation of bases aligned by both operations: a sequence match (=) if both are matches, a
+        mismatch (X) if one is a mismatch and the other a match, otherwise M (two mismatches may be a match)
+        """
+        if first_operation == "=":
+            return second_operation
+        if second_operation == "=":
+            return first_operation
+        return "M"
+
+
+    def __getstate__(self):
+        # memoryviews (e.g. over a memory-mapped database) cannot be pickled; pickle copies of them instead.  Dense
+        # tables are not sent: they count against the budget of the process which built them.
+        state = self.__dict__.copy()
+        state["transcript_table"] = None
+        state["genomic_table"] = None
+        state["genomic_table_start"] = None
+        for name, value in state.items():
+            if isinstance(value, memoryview):
+                state[name] = array(value.format, value.tolist())
+        return state
+
+
+    query_starts = expanded_ranges_property("_query_starts", "Start of the range of every operation in the transcript")
+    query_stops = expanded_ranges_property("_query_stops", "Stop of the range of every operation in the transcript")
+    reference_starts = expanded_ranges_property("_reference_starts",
+                                                "Start of the range of every operation in the reference")
+    reference_stops = expanded_ranges_property("_reference_stops",
+                                               "Stop of the range of every operation in the reference")
+    query_scan_stops = expanded_ranges_property("_query_scan_stops", "query_stops in 5'->3' order of the transcript, "
+                                                "used to binary search the range containing a position")
+
+
+    @property
+    def cigar_operations(self):
+        """
+        Read-only view of the cigar operations as CigarOperation objects
+        """
+        return CigarOperationView(self.operations, self.op_lengths)
+
+
+    @property
+    def query_ranges(self):
         """
+        Read-only view of the ranges in the transcript as SequenceRange objects, one for each cigar operation
+        """
+        return SequenceRangeView(self.query_starts, self.query_stops, self.operations, self.op_lengths)
+
+
+    @property
+    def reference_ranges(self):
+        """
+        Read-only view of the ranges in the reference as SequenceRange objects, one for each cigar operation
+        """
+        return SequenceRangeView(self.reference_starts, self.reference_stops, self.operations, self.op_lengths)
 
-        matches = re.findall(r'(\d+)([A-Z]{1})', self.cigar_string)
 
-        for m in matches:
-            operation = m[1]
-            try:
-                op_len = int(m[0])
-            except:
-                raise ValueError("Cigar length is not an int: " + m[0])
+    def populate_cigar_operations(self):
+        """
+        Parses the input cigar string and stores the code and length of every operation.  See parse_cigar.
+        :return: void.  
+        """
 
-            CO = CigarOperation(op_len, operation)
-            self.cigar_operations.append(CO)
+        self.operations, self.op_lengths = parse_cigar(self.cigar_string)
 
 
-    def increment_indices(self, cigar_operation, query_start, reference_start):
+    def increment_indices(self, operation, op_length, query_start, reference_start):
         """
         Given a cigar string and integers representing the start of a new range, find stop coordinate for 
         the range.   
     
-        :param cigar_operatio, CigarOperations object
+        :param operation: string, the type of cigar operation (e.g. MDI).  Hard clips and padding are not stored.
+        :param op_length: int, the length of the cigar operation
         :param query_start: Start position of the next range for query.  
         :param reference_start: Start position of the next range for reference.
         :return:  integers representing start/stop positions for query/reference range
@@ -74,69 +465,217 @@ class Mappings:
         query_end = None
         reference_end = None
 
-        if cigar_operation.operation in 'M':
-            query_end = query_start + cigar_operation.op_length - 1
-            reference_end = reference_start + cigar_operation.op_length - 1
-        elif cigar_operation.operation == 'I':
+        if operation in 'M=X':
+            query_end = query_start + op_length - 1
+            reference_end = reference_start + op_length - 1
+        elif operation in 'IS':
             reference_start -= 1
-            query_end = query_start + cigar_operation.op_length - 1
+            query_end = query_start + op_length - 1
             reference_end = reference_start
-        elif cigar_operation.operation in "D":
+        elif operation in "DN":
             query_start -= 1
             query_end = query_start
-            reference_end = reference_start + cigar_operation.op_length - 1
+            reference_end = reference_start + op_length - 1
         else:
-            raise Exception("Cigar operation not supported: " + cigar_operation.operation + "\n")
+            raise Exception("Cigar operation not supported: " + operation + "\n")
 
         return query_start, query_end, reference_start, reference_end
 
 
     def populate_ranges(self):
         """
-        Based on CIGAR operations delineate the corresponding SequenceRanges for query and reference 
+        Based on CIGAR operations delineate the corresponding SequenceRanges for query and reference.  See
+        expand_ranges.
         :return: void
         """
+        self.expand_ranges()
 
-        assert len(self.cigar_operations) > 0
 
-        current_query_start = 0
-        current_reference_start = self.genomic_mapping_pos
+    def expand_ranges(self, n_operations=None):
+        """
+        Expand the ranges of the operations in cigar order, from the first operation not expanded yet up to operation
+        n_operations.  Expanded ranges are kept, so every range is expanded at most once.  Transcript coordinates of a
+        mapping on the reverse strand are computed from the transcript length as the ranges are expanded.
+        :param n_operations: int, number of operations whose ranges are expanded once done.  Default expands them all.
+        :return: void
+        """
+
+        assert len(self.operations) > 0
+
+        first = len(self._query_starts)
+        last = len(self.operations)
+        if n_operations is not None:
+            last = min(n_operations, last)
+        if last <= first:
+            return
+
+        current_query_start = self._next_query_start
+        current_reference_start = self._next_reference_start
+        # last transcript position, to turn the 5'->3' coordinates of a mapping on the reverse strand around
+        last_query_position = self.transcript_length - 1
 
         # when we have a match or mismatch (M), both query and ref position indices are moved up by the cigar len
         # For an insertion is relative to the reference.  Query index is incremented but reference index remains the
         # same
         # For a deletion, we increment the reference index but keep the query index the same
+        # Soft clips are handled as insertions, and skipped regions (introns) as deletions: whatever their length, every
+        # operation is a single range
 
-        for i in self.cigar_operations:
+        operations = self.operations
+        op_lengths = self.op_lengths
+        is_transcript_forward = self.is_transcript_forward
+        genomic_mapping_pos = self.genomic_mapping_pos
+        query_starts_append = self._query_starts.append
+        query_stops_append = self._query_stops.append
+        reference_starts_append = self._reference_starts.append
+        reference_stops_append = self._reference_stops.append
+        for i in range(first, last):
+            operation = operations[i]
             current_query_start, current_query_end, current_reference_start, current_reference_end = self.increment_indices(
-            i, current_query_start, current_reference_start)
-            QR = SequenceRange(current_query_start, current_query_end, i)
-            RR = SequenceRange(current_reference_start, current_reference_end, i)
+            chr(operation), op_lengths[i], current_query_start, current_reference_start)
+            if current_reference_end < genomic_mapping_pos:
+                # insertions and soft clips before the first reference base have no reference position before them.
+                # Their reference range is left empty (stop = start - 1) so no position is located in it.
+                current_reference_start = genomic_mapping_pos
+            assert current_query_end >= current_query_start and current_reference_end >= current_reference_start - 1
+            reference_starts_append(current_reference_start)
+            reference_stops_append(current_reference_end)
 
             # assume the next range starts in the next base over.  If not, adjust in increment_indices
             current_reference_start = current_reference_end + 1
-            current_query_start = current_query_end + 1
-            self.query_ranges.append(QR)
-            self.reference_ranges.append(RR)
+            next_query_start = current_query_end + 1
+
+            if not is_transcript_forward:
+                # mapping is 3'->5': the range is the same, counted from the other end of the transcript
+                if operation in REFERENCE_ONLY_OPERATIONS:
+                    # no transcript bases: collapsed onto the last position of the previous range 5'->3', i.e. the
+                    # first position of the next operation.  Ranges of other operations are never collapsed, even if
+                    # they have a single base (e.g. 1X)
+                    current_query_start = current_query_end = last_query_position - current_query_start - 1
+                else:
+                    current_query_start, current_query_end = (last_query_position - current_query_end,
+                                                              last_query_position - current_query_start)
+            query_starts_append(current_query_start)
+            query_stops_append(current_query_end)
+            current_query_start = next_query_start
 
-        # adjust the coordinates if the mapping is on the reverse strand
+        self._next_query_start = current_query_start
+        self._next_reference_start = current_reference_start
+        self.ranges_expanded = len(self._query_starts) == len(self.operations)
         if not self.is_transcript_forward:
-            # mapping is 3'->5'
-            # mapping ranges stay the same, but the actual coordinates are modified
+            # stop positions of the ranges in 5'->3' order, used to binary search the range containing a position.
+            # Ranges are expanded 3'->5', so their stops are written from the end of the buffer, and the expanded ranges
+            # are its tail, seen without copying the stops already written
+            n_ranges = len(self.operations)
+            if self._query_scan_buffer is None:
+                self._query_scan_buffer = array('q', bytes(8 * n_ranges))
+            self._query_scan_buffer[n_ranges - last:n_ranges - first] = self._query_stops[first:last][::-1]
+            if self.ranges_expanded:
+                self._query_scan_stops = self._query_scan_buffer
+            else:
+                self._query_scan_stops = memoryview(self._query_scan_buffer)[n_ranges - last:]
+
+
+    def expanded_range_count(self):
+        """
+        :return: int, number of operations whose ranges are expanded so far, see expand_ranges
+        """
+        return len(self._query_starts)
+
+
+    def expand_through(self, position, in_transcript):
+        """
+        Expand ranges, RANGE_CHUNK_SIZE operations at a time, until every range the lookup of a position needs is
+        expanded: the ranges up to the first one whose stop is not lower than the position, in cigar order.  On the
+        reverse strand transcript positions decrease in cigar order, so the ranges are expanded until one stops before
+        the position.
+        :param position: int, transcript or genomic position
+        :param in_transcript: boolean, True for a transcript position
+        :return: void
+        """
+        stops = self._query_stops if in_transcript else self._reference_stops
+        if in_transcript and not self.is_transcript_forward:
+            while not self.ranges_expanded and (not stops or stops[-1] >= position):
+                self.expand_ranges(len(stops) + RANGE_CHUNK_SIZE)
+        else:
+            while not self.ranges_expanded and (not stops or stops[-1] < position):
+                self.expand_ranges(len(stops) + RANGE_CHUNK_SIZE)
+
+
+    def build_dense_tables(self, budget):
+        """
+        Build the dense lookup tables of the mapping: transcript_table holds the translation of every transcript
+        position, genomic_table that of every position of the genomic span, starting at genomic_table_start, so a
+        position is translated by indexing instead of a range search.  Aligned positions hold their translated
+        position; the other positions, whose translation is the pair of positions around them (see pos_in_range),
+        hold the sentinel -(first position) - 2.  Each table is only built if its span is not longer than
+        budget.max_span and it fits in the budget.
+        :param budget: DenseTableBudget object
+        :return: void
+        """
+        n_bytes = 0
+        transcript_length = self.transcript_length
+        if 0 < transcript_length <= budget.max_span:
+            table = self.dense_table(self.query_starts, self.query_stops, self.reference_starts, self.reference_stops,
+                                     REFERENCE_ONLY_OPERATIONS, 0, transcript_length, self.is_transcript_forward,
+                                     True, self.reference_stops[-1] + 1)
+            if budget.reserve(len(table) * table.itemsize):
+                self.transcript_table = table
+                n_bytes += len(table) * table.itemsize
+
+        genomic_start = self.reference_starts[0]
+        genomic_length = self.reference_stops[-1] - genomic_start + 1
+        if 0 < genomic_length <= budget.max_span:
+            table = self.dense_table(self.reference_starts, self.reference_stops, self.query_starts, self.query_stops,
+                                     QUERY_ONLY_OPERATIONS, genomic_start, genomic_length, True,
+                                     self.is_transcript_forward, transcript_length)
+            if budget.reserve(len(table) * table.itemsize):
+                self.genomic_table = table
+                self.genomic_table_start = genomic_start
+                n_bytes += len(table) * table.itemsize
 
-            current_pos = 0
-            for i in reversed(self.query_ranges):
-                range_len = i.stop_pos - i.start_pos
-                if range_len == 0:
-                    current_pos -= 1
-                current_end = current_pos + range_len
-                i.start_pos = current_pos
-                i.stop_pos = current_end
-                # assume the next range will start adjacent to the end
-                current_pos = current_pos + range_len + 1
+        if n_bytes:
+            weakref.finalize(self, budget.release, n_bytes)
 
-            # something amiss here if this is not true
-            assert self.query_ranges[-1].start_pos == 0
+
+    def dense_table(self, SR1_starts, SR1_stops, SR2_starts, SR2_stops, SR2_only_operations, table_start,
+                    table_length, is_forward_SR1, is_forward_SR2, max_value):
+        """
+        :return: array, translation of positions table_start..table_start + table_length - 1 of SR1, see
+        build_dense_tables.  Filled one range at a time.
+        """
+        typecode = 'i' if max_value < 2 ** 31 - 2 else 'q'
+        table = array(typecode, bytes(array(typecode).itemsize * table_length))
+        for i in range(len(self.operations)):
+            operation = self.operations[i]
+            if operation in SR2_only_operations:
+                continue
+            first = SR1_starts[i] - table_start
+            n = SR1_stops[i] - SR1_starts[i] + 1
+            if operation in ALIGNED_OPERATIONS:
+                if is_forward_SR1 == is_forward_SR2:
+                    table[first:first + n] = array(typecode, range(SR2_starts[i], SR2_starts[i] + n))
+                else:
+                    table[first:first + n] = array(typecode, range(SR2_stops[i], SR2_stops[i] - n, -1))
+            else:
+                table[first:first + n] = array(typecode, [-SR2_stops[i] - 2]) * n
+        return table
+
+
+    @staticmethod
+    def dense_lookup(table, table_start, query_coordinate):
+        """
+        :param table: array, dense lookup table, see build_dense_tables
+        :param table_start: int, position of the first entry of the table
+        :return: tuple (min_pos,max_pos) as returned by get_pos, None if the position is not in the table
+        """
+        index = query_coordinate - table_start
+        if index < 0 or index >= len(table):
+            return None
+        value = table[index]
+        if value >= 0:
+            return (value, value)
+        return (-value - 2, -value - 1)
 
 
     @staticmethod
@@ -153,87 +692,493 @@ class Mappings:
         is the coordinate in SR2 immediately after the insertion.  
         """
 
-	#TODO: change variable names SR1 and SR2 to imply a list
+        #TODO: change variable names SR1 and SR2 to imply a list
+        return Mappings.get_pos_arrays([r.start_pos for r in SR1], [r.stop_pos for r in SR1],
+                                       [r.start_pos for r in SR2], [r.stop_pos for r in SR2],
+                                       [ord(r.cigar_operation.operation) for r in SR1], query_coordinate,
+                                       is_forward_SR1, is_forward_SR2)
+
+
+    @staticmethod
+    def get_pos_arrays(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations, query_coordinate, is_forward_SR1,
+                       is_forward_SR2, SR1_scan_stops=None):
+        """
+        get_pos over ranges given as arrays indexed like the SequenceRange lists.  Positions which cannot be translated
+        are reported to stderr.
+        :param SR1_starts, SR1_stops: int arrays of the ranges in which the query_coordinate is located
+        :param SR2_starts, SR2_stops: int arrays of the 'other' ranges in which the coordinate is to be translated
+        :param operations: int array, cigar operation codes of the ranges
+        :param query_coordinate: int representing the position to query
+        :param is_forward_SR1: boolean.  Are the SR1 ranges mapping 5'->3'
+        :param is_forward_SR2: boolean.  Are the SR2 ranges mapping 5'->3'
+        :param SR1_scan_stops: int array, SR1_stops in 5'->3' order.  Ranges of insertions and deletions are collapsed
+        onto the last position of the previous range, so starts and stops are both non-decreasing in this order and
+        the first range containing a position is the first one whose stop is not lower than it.  Computed from
+        SR1_stops if not provided.
+        :return: tuple (min_pos,max_pos), see get_pos
+        """
+        matching_positions, status = Mappings.get_pos_status(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations,
+                                                             query_coordinate, is_forward_SR1, is_forward_SR2,
+                                                             SR1_scan_stops)
+        if status != POS_OK:
+            sys.stderr.write(POS_MESSAGES[status])
+        return matching_positions
+
+
+    @staticmethod
+    def get_pos_status(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations, query_coordinate, is_forward_SR1,
+                       is_forward_SR2, SR1_scan_stops=None):
+        """
+        get_pos_arrays without reporting: the reason a position cannot be translated is returned instead.
+        :return: tuple (matching_positions, status).  matching_positions is (min_pos,max_pos) as returned by get_pos,
+        None if the position could not be translated; status is the POS_* code telling why.
+        """
+
         if not is_forward_SR1 and not is_forward_SR2:
-            sys.stderr.write("Query and reference mappings cannot both be on reverse strand. Skipping\n")
-            return None
+            return None, POS_BOTH_REVERSE
+
+        status = Mappings.bounds_status(SR1_starts, SR1_stops, query_coordinate, is_forward_SR1)
+        if status != POS_OK:
+            return None, status
+
+        if SR1_scan_stops is None:
+            SR1_scan_stops = SR1_stops
+            if not is_forward_SR1:
+                SR1_scan_stops = SR1_stops[::-1]
+
+        # binary search for the first range 5'->3' whose stop is not lower than the query position
+        range_index = bisect_left(SR1_scan_stops, query_coordinate)
+        i = range_index
+        if not is_forward_SR1:
+            i = len(SR1_stops) - 1 - range_index
+
+        matching_positions = Mappings.pos_in_range(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations, i,
+                                                   query_coordinate, is_forward_SR1, is_forward_SR2)
+
+        if matching_positions is None:
+            return None, POS_NOT_FOUND
+        return matching_positions, POS_OK
+
+
+    @staticmethod
+    def get_pos_sweep(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations, query_coordinates, is_forward_SR1,
+                      is_forward_SR2, SR1_scan_stops=None):
+        """
+        get_pos_arrays for many positions at once, resolved with a single merge of the sorted positions against the
+        ranges in 5'->3' order instead of one binary search per position.
+        :param query_coordinates: list of ints, positions to query sorted in ascending order
+        See get_pos_arrays for the other parameters.
+        :return: list of (min_pos,max_pos) tuples, or None for positions that could not be translated, in the order of
+        query_coordinates
+        """
+
+        if not is_forward_SR1 and not is_forward_SR2:
+            sys.stderr.write(POS_MESSAGES[POS_BOTH_REVERSE])
+            return [None] * len(query_coordinates)
+
+        all_matching_positions, statuses = Mappings.get_pos_sweep_status(SR1_starts, SR1_stops, SR2_starts, SR2_stops,
+                                                                         operations, query_coordinates, is_forward_SR1,
+                                                                         is_forward_SR2, SR1_scan_stops)
+        for status in statuses:
+            if status != POS_OK:
+                sys.stderr.write(POS_MESSAGES[status])
+        return all_matching_positions
+
+
+    @staticmethod
+    def get_pos_sweep_status(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations, query_coordinates,
+                             is_forward_SR1, is_forward_SR2, SR1_scan_stops=None):
+        """
+        get_pos_sweep without reporting, see get_pos_status.
+        :return: tuple (list of (min_pos,max_pos) tuples or None, list of POS_* codes), in the order of
+        query_coordinates
+        """
+
+        if not is_forward_SR1 and not is_forward_SR2:
+            return [None] * len(query_coordinates), [POS_BOTH_REVERSE] * len(query_coordinates)
+
+        if SR1_scan_stops is None:
+            SR1_scan_stops = SR1_stops
+            if not is_forward_SR1:
+                SR1_scan_stops = SR1_stops[::-1]
+
+        n_ranges = len(SR1_stops)
+        all_matching_positions = []
+        statuses = []
+        range_index = 0
+
+        for query_coordinate in query_coordinates:
+            status = Mappings.bounds_status(SR1_starts, SR1_stops, query_coordinate, is_forward_SR1)
+            if status != POS_OK:
+                all_matching_positions.append(None)
+                statuses.append(status)
+                continue
+
+            # positions are sorted, so the first range whose stop is not lower than the position only moves forward
+            while SR1_scan_stops[range_index] < query_coordinate:
+                range_index += 1
+            i = range_index
+            if not is_forward_SR1:
+                i = n_ranges - 1 - range_index
 
+            matching_positions = Mappings.pos_in_range(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations, i,
+                                                       query_coordinate, is_forward_SR1, is_forward_SR2)
+            all_matching_positions.append(matching_positions)
+            statuses.append(POS_OK if matching_positions is not None else POS_NOT_FOUND)
+
+        return all_matching_positions, statuses
+
+
+    @staticmethod
+    def is_pos_in_bounds(SR1_starts, SR1_stops, query_coordinate, is_forward_SR1):
+        """
+        Check that a position is within the first and last coordinates of the ranges, reporting to stderr if not.
+        :return: boolean
+        """
+        status = Mappings.bounds_status(SR1_starts, SR1_stops, query_coordinate, is_forward_SR1)
+        if status != POS_OK:
+            sys.stderr.write(POS_MESSAGES[status])
+            return False
+        return True
+
+
+    @staticmethod
+    def bounds_status(SR1_starts, SR1_stops, query_coordinate, is_forward_SR1):
+        """
+        Check that a position is within the first and last coordinates of the ranges.
+        :return: int, POS_OK or the POS_* code of the bound the position is out of
+        """
         if query_coordinate < 0:
-            sys.stderr.write("Query position is negative.  Cannot process. Skipping\n")
-            return None
+            return POS_NEGATIVE
 
         # get the last coordinate of SR1 to make sure that the queried coordinate is within range
         final_index = -1
-	first_index = 0
+        first_index = 0
         if not is_forward_SR1:
             final_index = 0
-	    first_index = -1
+            first_index = -1
 
-        if query_coordinate > SR1[final_index].stop_pos:
-            sys.stderr.write("Requested position is greater than the length of the alignment of query on ref.\n")
-            return None
+        if query_coordinate > SR1_stops[final_index]:
+            return POS_AFTER_END
+
+        if query_coordinate < SR1_starts[first_index]:
+            return POS_BEFORE_START
+
+        return POS_OK
 
-        if query_coordinate < SR1[first_index].start_pos:
-            sys.stderr.write("Requested position is lower than the first coordinate annotated.\n")
-            return None
 
+    @staticmethod
+    def get_interval_arrays(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations, SR2_only_operations, start, end,
+                            is_forward_SR1, is_forward_SR2, SR1_scan_stops=None):
+        """
+        Translate the interval [start, end] of SR1 to the blocks of SR2 it is aligned with.  Intervals which cannot be
+        translated are reported to stderr; see get_interval_status.
+        :param SR2_only_operations: frozenset, codes of the cigar operations whose ranges only have bases in SR2
+        (REFERENCE_ONLY_OPERATIONS when SR1 is the transcript, QUERY_ONLY_OPERATIONS when SR1 is the reference).  Their
+        ranges in SR1 are collapsed onto the position before the gap.
+        :param start, end: ints, first and last position of the interval to query
+        See get_pos_arrays for the other parameters.
+        :return: list of blocks, see get_interval_status.  None if the interval could not be translated.
+        """
+        blocks, status = Mappings.get_interval_status(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations,
+                                                      SR2_only_operations, start, end, is_forward_SR1, is_forward_SR2,
+                                                      SR1_scan_stops)
+        if status != POS_OK:
+            sys.stderr.write(POS_MESSAGES[status])
+        return blocks
+
+
+    @staticmethod
+    def get_interval_status(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations, SR2_only_operations, start, end,
+                            is_forward_SR1, is_forward_SR2, SR1_scan_stops=None):
+        """
+        get_interval_arrays without reporting.  The range containing start is found by binary search, then the ranges
+        are walked 5'->3' until end, so the time is linear in the number of cigar operations the interval covers.
+        :return: tuple (blocks, status).  blocks is a list of tuples (operation, start, stop, other_start, other_stop)
+        ordered by SR1 position, one per cigar operation covered by the interval, operation being the cigar operation
+        letter:
+            M: positions start..stop of SR1 are aligned with other_start..other_stop of SR2
+            SR1 only operation: positions start..stop of SR1 have no counterpart; other_start and other_stop are the
+               positions of SR2 immediately before and after them (see get_pos)
+            SR2 only operation: positions other_start..other_stop of SR2 have no counterpart; they lie between
+               positions start and stop (= start + 1) of SR1
+        None if the interval could not be translated; status is the POS_* code telling why.
+        """
+        if not is_forward_SR1 and not is_forward_SR2:
+            return None, POS_BOTH_REVERSE
+        if start > end:
+            return None, POS_INVALID_INTERVAL
+        for query_coordinate in (start, end):
+            status = Mappings.bounds_status(SR1_starts, SR1_stops, query_coordinate, is_forward_SR1)
+            if status != POS_OK:
+                return None, status
+
+        if SR1_scan_stops is None:
+            SR1_scan_stops = SR1_stops
+            if not is_forward_SR1:
+                SR1_scan_stops = SR1_stops[::-1]
+
+        n_ranges = len(SR1_stops)
+        blocks = []
+        range_index = bisect_left(SR1_scan_stops, start)
+        while range_index < n_ranges:
+            i = range_index
+            if not is_forward_SR1:
+                i = n_ranges - 1 - range_index
+            range_index += 1
+
+            operation = operations[i]
+            if operation in SR2_only_operations:
+                # gap between positions gap_start and gap_start + 1 of SR1
+                gap_start = SR1_stops[i]
+                if gap_start >= end:
+                    break
+                if gap_start >= start:
+                    blocks.append((chr(operation), gap_start, gap_start + 1, SR2_starts[i], SR2_stops[i]))
+                continue
+
+            range_start = SR1_starts[i]
+            if range_start > end:
+                break
+            block_start = max(start, range_start)
+            block_stop = min(end, SR1_stops[i])
+
+            if operation in ALIGNED_OPERATIONS:
+                if is_forward_SR1 == is_forward_SR2:
+                    other_start = SR2_starts[i] + block_start - range_start
+                    other_stop = SR2_starts[i] + block_stop - range_start
+                else:
+                    other_start = SR2_stops[i] - (block_stop - range_start)
+                    other_stop = SR2_stops[i] - (block_start - range_start)
+            else:
+                # coordinates immediately before and after the bases, as in pos_in_range
+                other_start = SR2_stops[i]
+                other_stop = other_start + 1
+            blocks.append((chr(operation), block_start, block_stop, other_start, other_stop))
+
+        return blocks, POS_OK
 
+
+    @staticmethod
+    def pos_in_range(SR1_starts, SR1_stops, SR2_starts, SR2_stops, operations, i, query_coordinate, is_forward_SR1,
+                     is_forward_SR2):
+        """
+        Translate a position using range i, the range get_pos found for it.
+        :return: tuple (min_pos,max_pos), see get_pos.  None if range i does not contain the position.
+        """
         genomic_pos = None
         matching_positions = None
 
-        # iterate over SR1 5'->3'
-        range_indices = range(0, len(SR1))
-        if not is_forward_SR1:
-            range_indices = reversed(range_indices)
-
-        for i in range_indices:
-            sequence_range = SR1[i]
-
-            # check if this range contains the query position
-            if query_coordinate >= sequence_range.start_pos and query_coordinate <= sequence_range.stop_pos:
-                # what's the offset of the position in the range
-                offset = query_coordinate - sequence_range.start_pos
-
-                # check that we've gotten the right offset and range
-                t_pos = sequence_range.start_pos + offset
-                assert t_pos == query_coordinate
-
-                # now find the position in SR2.  The translated position will be in the same range as i
-                if sequence_range.cigar_operation.operation == "M":
-                    genomic_pos = SR2[i].start_pos + offset
-                    if is_forward_SR1 != is_forward_SR2:
-                        genomic_pos = SR2[i].stop_pos - offset
-                    matching_positions = (genomic_pos, genomic_pos)
-                else:
-                    # Insertion. Find the coordinates immediately before and after insertion
-		    #TODO: improve exception handling here
-                    prev_bin = i - 1  # assume that this bin is atleast 2 since we don't start with indel cigar ops
-                    next_bin = i + 1
-                    prev_coord = SR2[prev_bin].stop_pos
-                    next_coord = SR2[next_bin].start_pos
-                    if not is_forward_SR2:
-                        next_coord = SR2[prev_bin].start_pos
-                        prev_coord = SR2[next_bin].stop_pos
-                    matching_positions = (prev_coord, next_coord)
-
-                if matching_positions is not None:
-                    break
+        start_pos = SR1_starts[i]
+
+        # check if this range contains the query position
+        if query_coordinate >= start_pos and query_coordinate <= SR1_stops[i]:
+            # what's the offset of the position in the range
+            offset = query_coordinate - start_pos
+
+            # now find the position in SR2.  The translated position will be in the same range as i
+            if operations[i] in ALIGNED_OPERATIONS:
+                genomic_pos = SR2_starts[i] + offset
+                if is_forward_SR1 != is_forward_SR2:
+                    genomic_pos = SR2_stops[i] - offset
+                matching_positions = (genomic_pos, genomic_pos)
+            else:
+                # Insertion (or deletion, skipped region, soft clip). Its range in SR2 is collapsed onto the coordinate
+                # immediately before the insertion; the one immediately after is the next
+                prev_coord = SR2_stops[i]
+                matching_positions = (prev_coord, prev_coord + 1)
 
-        if matching_positions is None:
-            sys.stderr.write("Could not locate position in query sequence\n")
         return matching_positions
 
 
     @staticmethod
-    def transcript_to_genomic_pos(input_position, M):
-        genomic_pos = M.get_pos(M.query_ranges, M.reference_ranges, input_position, M.is_transcript_forward, True)
-        return genomic_pos
+    def transcript_to_genomic_pos(input_position, M, with_status=False):
+        """
+        Translate a transcript position to a genomic position.  See get_pos_arrays, or get_pos_status if with_status.
+        Positions in the dense lookup table, if it was built, are translated from it.
+        """
+        if M.transcript_table is not None:
+            matching_positions = M.dense_lookup(M.transcript_table, 0, input_position)
+            if matching_positions is not None:
+                return (matching_positions, POS_OK) if with_status else matching_positions
+        if not M.ranges_expanded:
+            M.expand_through(input_position, True)
+        get_pos = M.get_pos_status if with_status else M.get_pos_arrays
+        return get_pos(M._query_starts, M._query_stops, M._reference_starts, M._reference_stops, M.operations,
+                       input_position, M.is_transcript_forward, True, M._query_scan_stops)
+
+
+    @staticmethod
+    def genomic_to_transcript_pos(input_position, M, with_status=False):
+        """
+        Translate a genomic position to a transcript position.  See get_pos_arrays, or get_pos_status if with_status.
+        Positions in the dense lookup table, if it was built, are translated from it.
+        """
+        if M.genomic_table is not None:
+            matching_positions = M.dense_lookup(M.genomic_table, M.genomic_table_start, input_position)
+            if matching_positions is not None:
+                return (matching_positions, POS_OK) if with_status else matching_positions
+        if not M.ranges_expanded:
+            M.expand_through(input_position, False)
+        get_pos = M.get_pos_status if with_status else M.get_pos_arrays
+        return get_pos(M._reference_starts, M._reference_stops, M._query_starts, M._query_stops, M.operations,
+                       input_position, True, M.is_transcript_forward, M._reference_stops)
+
+
+    @staticmethod
+    def transcript_to_genomic_sweep(input_positions, M, with_status=False):
+        """
+        Translate transcript positions, sorted in ascending order, to genomic positions.  See get_pos_sweep, or
+        get_pos_sweep_status if with_status.  With a dense lookup table, every position is looked up in it instead.
+        """
+        if M.transcript_table is not None:
+            return M.dense_sweep(input_positions, M.transcript_to_genomic_pos, M, with_status)
+        if not M.ranges_expanded and input_positions:
+            M.expand_through(input_positions[0], True)
+            M.expand_through(input_positions[-1], True)
+        get_pos = M.get_pos_sweep_status if with_status else M.get_pos_sweep
+        return get_pos(M._query_starts, M._query_stops, M._reference_starts, M._reference_stops, M.operations,
+                       input_positions, M.is_transcript_forward, True, M._query_scan_stops)
+
+
+    @staticmethod
+    def genomic_to_transcript_sweep(input_positions, M, with_status=False):
+        """
+        Translate genomic positions, sorted in ascending order, to transcript positions.  See get_pos_sweep, or
+        get_pos_sweep_status if with_status.  With a dense lookup table, every position is looked up in it instead.
+        """
+        if M.genomic_table is not None:
+            return M.dense_sweep(input_positions, M.genomic_to_transcript_pos, M, with_status)
+        if not M.ranges_expanded and input_positions:
+            M.expand_through(input_positions[-1], False)
+        get_pos = M.get_pos_sweep_status if with_status else M.get_pos_sweep
+        return get_pos(M._reference_starts, M._reference_stops, M._query_starts, M._query_stops, M.operations,
+                       input_positions, True, M.is_transcript_forward, M._reference_stops)
+
+
+    @staticmethod
+    def dense_sweep(input_positions, get_pos, M, with_status=False):
+        """
+        Sweep translation of positions through a dense lookup table: one lookup per position.
+        :param get_pos: function translating one position, e.g. Mappings.transcript_to_genomic_pos
+        :return: see get_pos_sweep, or get_pos_sweep_status if with_status
+        """
+        if not with_status:
+            return [get_pos(input_position, M) for input_position in input_positions]
+        results = [get_pos(input_position, M, True) for input_position in input_positions]
+        return [result[0] for result in results], [result[1] for result in results]
+
+
+    @staticmethod
+    def transcript_interval_to_genomic(start, end, M, with_status=False):
+        """
+        Translate the transcript interval [start, end] to the genomic blocks it is aligned with.  See
+        get_interval_arrays, or get_interval_status if with_status.  Deletions are gaps between two transcript
+        positions, insertions transcript positions with no genomic counterpart.
+        """
+        get_interval = M.get_interval_status if with_status else M.get_interval_arrays
+        return get_interval(M.query_starts, M.query_stops, M.reference_starts, M.reference_stops, M.operations,
+                            REFERENCE_ONLY_OPERATIONS, start, end, M.is_transcript_forward, True, M.query_scan_stops)
+
+
+    @staticmethod
+    def genomic_interval_to_transcript(start, end, M, with_status=False):
+        """
+        Translate the genomic interval [start, end] to the transcript blocks it is aligned with.  See
+        get_interval_arrays, or get_interval_status if with_status.  Insertions are gaps between two genomic
+        positions, deletions genomic positions with no transcript counterpart.
+        """
+        get_interval = M.get_interval_status if with_status else M.get_interval_arrays
+        return get_interval(M.reference_starts, M.reference_stops, M.query_starts, M.query_stops, M.operations,
+                            QUERY_ONLY_OPERATIONS, start, end, True, M.is_transcript_forward, M.reference_stops)
+
+
+    def range_arrays(self):
+        """
+        NumPy views of the query and reference range arrays (no copy).
+        :return: tuple (query_starts, query_stops, reference_starts, reference_stops, is_match), int64 arrays
+        indexed like query_ranges/reference_ranges, is_match a boolean array of the aligned (M, =, X) operations.
+        """
+        if np is None:
+            raise ImportError("NumPy is required for batch translation.")
+
+        return (np.frombuffer(self.query_starts, dtype=np.int64), np.frombuffer(self.query_stops, dtype=np.int64),
+                np.frombuffer(self.reference_starts, dtype=np.int64),
+                np.frombuffer(self.reference_stops, dtype=np.int64),
+                np.isin(np.frombuffer(self.operations, dtype=np.uint8), list(ALIGNED_OPERATIONS)))
+
+
+    @staticmethod
+    def get_pos_many(SR1_starts, SR1_stops, SR2_starts, SR2_stops, is_match, query_coordinates, is_forward_SR1,
+                     is_forward_SR2):
+        """
+        Vectorized get_pos: translate an array of positions with no per-position Python loop.  Ranges are given as
+        arrays indexed like the SequenceRange lists.
+        :param SR1_starts, SR1_stops: int arrays of the ranges in which the query_coordinates are located
+        :param SR2_starts, SR2_stops: int arrays of the 'other' ranges in which the coordinates are to be translated
+        :param is_match: boolean array, True for the ranges of aligned operations
+        :param query_coordinates: array-like of ints representing the positions to query
+        :param is_forward_SR1: boolean.  Are the SR1 ranges mapping 5'->3'
+        :param is_forward_SR2: boolean.  Are the SR2 ranges mapping 5'->3'
+        :return: tuple (coordinates, status).  coordinates is an (n, 2) int64 array of (min_pos, max_pos) as returned
+        by get_pos, -1 where the position could not be translated.  status is an int8 array of POS_* codes.
+        """
+        query_coordinates = np.asarray(query_coordinates, dtype=np.int64)
+        n_ranges = len(SR1_starts)
+
+        # ranges in the order get_pos scans them (5'->3'); starts and stops are non-decreasing in this order
+        scan_order = np.arange(n_ranges)
+        if not is_forward_SR1:
+            scan_order = scan_order[::-1]
+
+        range_index = np.searchsorted(SR1_stops[scan_order], query_coordinates, side="left")
+        i = scan_order[np.minimum(range_index, n_ranges - 1)]
+        offset = query_coordinates - SR1_starts[i]
+
+        if is_forward_SR1 == is_forward_SR2:
+            match_pos = SR2_starts[i] + offset
+        else:
+            match_pos = SR2_stops[i] - offset
+
+        # insertions: coordinates immediately before and after the insertion, as in get_pos
+        prev_coord = SR2_stops[i]
+        next_coord = prev_coord + 1
+
+        range_is_match = is_match[i]
+        coordinates = np.empty((len(query_coordinates), 2), dtype=np.int64)
+        coordinates[:, 0] = np.where(range_is_match, match_pos, prev_coord)
+        coordinates[:, 1] = np.where(range_is_match, match_pos, next_coord)
+
+        # same checks, in the same order of precedence, as get_pos
+        status = np.full(len(query_coordinates), POS_OK, dtype=np.int8)
+        is_located = (SR1_starts[i] <= query_coordinates) & (query_coordinates <= SR1_stops[i])
+        status[~is_located] = POS_NOT_FOUND
+        status[query_coordinates < SR1_starts[scan_order[0]]] = POS_BEFORE_START
+        status[query_coordinates > SR1_stops[scan_order[-1]]] = POS_AFTER_END
+        status[query_coordinates < 0] = POS_NEGATIVE
+        coordinates[status != POS_OK] = -1
+
+        return coordinates, status
 
 
     @staticmethod
-    def genomic_to_transcript_pos(input_position, M):
-        transcript_pos = M.get_pos(M.reference_ranges, M.query_ranges, input_position, True, M.is_transcript_forward)
-        return transcript_pos
+    def transcript_to_genomic_many(input_positions, M):
+        """
+        Translate an array of transcript positions to genomic positions.  See get_pos_many.
+        """
+        query_starts, query_stops, reference_starts, reference_stops, is_match = M.range_arrays()
+        return M.get_pos_many(query_starts, query_stops, reference_starts, reference_stops, is_match, input_positions,
+                              M.is_transcript_forward, True)
+
+
+    @staticmethod
+    def genomic_to_transcript_many(input_positions, M):
+        """
+        Translate an array of genomic positions to transcript positions.  See get_pos_many.
+        """
+        query_starts, query_stops, reference_starts, reference_stops, is_match = M.range_arrays()
+        return M.get_pos_many(reference_starts, reference_stops, query_starts, query_stops, is_match, input_positions,
+                              True, M.is_transcript_forward)
 
 class CigarOperation:
     """
@@ -242,6 +1187,8 @@ class CigarOperation:
     :param: operation, string.  The type of cigar operation (e.g. MDI)
     """
 
+    __slots__ = ("op_length", "operation")
+
     def __init__(self, op_length, operation):
         # assume that the input is well formed
         self.op_length = op_length
@@ -252,12 +1199,58 @@ class SequenceRange:
     """
      Class which represents one contiguous segment of sequence(query or reference) which matches the cigar string
     :param: start_pos, int.  The starting position of this range.  Start is lower than stop, regardless of mapping orientation
-    :param: stop_pos, int.  The last position in this range. 
+    :param: stop_pos, int.  The last position in this range.  start_pos - 1 for an empty range, e.g. the reference
+            range of a leading soft clip or insertion (see Mappings.expand_ranges)
     :param: cigar_operation, CigarOperation object.  Represents the cigar operation which corresponds to this range. 
     """
+    __slots__ = ("start_pos", "stop_pos", "cigar_operation")
+
     def __init__(self, start_pos, stop_pos, cigar_operation):
-        assert stop_pos >= start_pos
+        assert stop_pos >= start_pos - 1
         self.start_pos = start_pos
         self.stop_pos = stop_pos
         self.cigar_operation = cigar_operation
 
+
+
+class CigarOperationView:
+    """
+    Read-only sequence of CigarOperation objects over the operation arrays of a Mappings object.  Objects are built
+    on access; changing them does not change the mapping.
+    :param: operations, array of ints.  Cigar operation codes
+    :param: op_lengths, array of ints.  Cigar operation lengths
+    """
+    def __init__(self, operations, op_lengths):
+        self.operations = operations
+        self.op_lengths = op_lengths
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return CigarOperation(self.op_lengths[i], chr(self.operations[i]))
+
+
+class SequenceRangeView:
+    """
+    Read-only sequence of SequenceRange objects over the range arrays of a Mappings object.  Objects are built on
+    access; changing them does not change the mapping.
+    :param: starts, array of ints.  Start positions of the ranges
+    :param: stops, array of ints.  Stop positions of the ranges
+    :param: operations, array of ints.  Cigar operation codes of the ranges
+    :param: op_lengths, array of ints.  Cigar operation lengths of the ranges
+    """
+    def __init__(self, starts, stops, operations, op_lengths):
+        self.starts = starts
+        self.stops = stops
+        self.cigar_operations = CigarOperationView(operations, op_lengths)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return SequenceRange(self.starts[i], self.stops[i], self.cigar_operations[i])
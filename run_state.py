@@ -0,0 +1,161 @@
+import os
+import hashlib
+
+# fingerprint of a transcript which has no mapping
+MISSING_MAPPING = "-"
+
+
+def state_file_name(output_file):
+    """
+    :param output_file: string, name of the output file of a translation run
+    :return: string, name of the sidecar file its RunState is kept in
+    """
+    return output_file + ".state"
+
+
+def file_signature(file_name):
+    """
+    :return: string, size and modification time of the file, which change when it is written
+    """
+    file_stat = os.stat(file_name)
+    return str(file_stat.st_size) + "\t" + str(file_stat.st_mtime_ns)
+
+
+def chunk_digest(lines):
+    """
+    :param lines: list of lines of the processing file
+    :return: string, hex digest of the lines
+    """
+    return hashlib.blake2b("".join(lines).encode(), digest_size=16).hexdigest()
+
+
+def mapping_fingerprint(genome_mapping_info):
+    """
+    :param genome_mapping_info: GenomicMapping object, None if the transcript has no mapping
+    :return: string, see GenomicMapping.fingerprint
+    """
+    if genome_mapping_info is None:
+        return MISSING_MAPPING
+    return genome_mapping_info.fingerprint()
+
+
+class RunState:
+    """
+    Record of a translation run kept next to its output file, so that a later run only translates again the lines
+    whose query may translate differently.  The processing file is described by chunks of chunk_size lines: the
+    digest of the lines, the number of output lines written for every line, the codes of the errors reported for its
+    lines and the lines which are CHROMOSOME queries.  For every transcript named by the processing file: the
+    fingerprint of its mapping (see GenomicMapping.fingerprint).
+
+    The state file is tab separated: a header line, one line per chunk (digest, comma separated numbers of output
+    lines, comma separated line offset:error code pairs, comma separated offsets of CHROMOSOME queries, with "." for
+    empty lists), one line per transcript ("@" transcript, fingerprint) and the signature of the output file the state
+    belongs to.
+    :param state_file: string, name of the state file, see state_file_name
+    """
+
+    HEADER = "#RUN_STATE\t1"
+    OUTPUT_TAG = "#OUTPUT\t"
+    TRANSCRIPT_TAG = "@"
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.error_column = False
+        self.chunk_size = None
+        self.output_signature = None
+        self.fingerprints = {}  # transcript -> fingerprint of its mapping in the run
+
+    @classmethod
+    def read(cls, state_file, output_file, error_column=False, chunk_size=10000):
+        """
+        :param state_file: string, name of the state file
+        :param output_file: string, name of the output file of the run
+        :param error_column, boolean: if the run to compare with the state appends the error column to output lines
+        :param chunk_size: int, number of lines of the chunks of the run to compare with the state
+        :return: RunState object with the fingerprints of the previous run, None if there is no state file, or it
+        does not describe the output file (written since, with a different error column or chunk size)
+        """
+        if not os.path.isfile(state_file) or not os.path.isfile(output_file):
+            return None
+
+        run_state = cls(state_file)
+        with open(state_file) as in_handle:
+            header = in_handle.readline().rstrip("\n").split("\t")
+            if "\t".join(header[:2]) != cls.HEADER or len(header) != 4:
+                return None
+            run_state.error_column = header[2] == "1"
+            run_state.chunk_size = int(header[3])
+            for line in in_handle:
+                if line.startswith(cls.TRANSCRIPT_TAG):
+                    transcript, fingerprint = line[1:].rstrip("\n").split("\t")
+                    run_state.fingerprints[transcript] = fingerprint
+                elif line.startswith(cls.OUTPUT_TAG):
+                    run_state.output_signature = line[len(cls.OUTPUT_TAG):].rstrip("\n")
+
+        if run_state.error_column != error_column or run_state.chunk_size != chunk_size or \
+                run_state.output_signature != file_signature(output_file):
+            return None
+        return run_state
+
+    def chunk_records(self):
+        """
+        :return: generator of tuples (digest, list of the number of output lines of every line, list of (line offset,
+        error code), list of the offsets of CHROMOSOME queries), one per chunk of the processing file of the run
+        """
+        with open(self.state_file) as in_handle:
+            in_handle.readline()
+            for line in in_handle:
+                if line.startswith(self.TRANSCRIPT_TAG) or line.startswith("#"):
+                    return
+                digest, output_line_counts, errors, chromosome_offsets = line.rstrip("\n").split("\t")
+                yield (digest, [int(n) for n in output_line_counts.split(",")],
+                       [] if errors == "." else [(int(offset), error_code) for offset, error_code in
+                                                 (error.split(":") for error in errors.split(","))],
+                       [] if chromosome_offsets == "." else [int(offset) for offset in chromosome_offsets.split(",")])
+
+
+class RunStateWriter:
+    """
+    Write the RunState of a run as its chunks are translated.  The state file is only replaced by close, once the
+    output file is complete.
+    :param state_file: string, name of the state file
+    :param error_column, boolean: if the output lines of the run have the error column
+    :param chunk_size: int, number of lines of the chunks
+    """
+
+    def __init__(self, state_file, error_column=False, chunk_size=10000):
+        self.state_file = state_file
+        self.fingerprints = {}  # transcript -> fingerprint of its mapping
+        self.lines_carried_over = 0
+        self.lines_translated = 0
+        self._temporary_file = state_file + ".tmp"
+        self._handle = open(self._temporary_file, "w")
+        self._handle.write(RunState.HEADER + "\t" + ("1" if error_column else "0") + "\t" + str(chunk_size) + "\n")
+
+    def add_chunk(self, digest, output_line_counts, errors, chromosome_offsets, lines_carried_over=0):
+        """
+        :param digest: string, see chunk_digest
+        :param output_line_counts: list of the number of output lines written for every line of the chunk
+        :param errors: list of tuples (line offset in the chunk, error code) of the errors reported for its lines
+        :param chromosome_offsets: list of the offsets of the lines which are CHROMOSOME queries
+        :param lines_carried_over: int, number of lines whose output lines were taken from the previous run
+        """
+        self.lines_carried_over += lines_carried_over
+        self.lines_translated += len(output_line_counts) - lines_carried_over
+        self._handle.write(digest + "\t" + ",".join(map(str, output_line_counts)) + "\t" +
+                           (",".join(str(offset) + ":" + error_code for offset, error_code in errors) or ".") + "\t" +
+                           (",".join(map(str, chromosome_offsets)) or ".") + "\n")
+
+    def close(self, output_file):
+        """
+        :param output_file: string, name of the output file of the run, once written and closed
+        """
+        for transcript, fingerprint in self.fingerprints.items():
+            self._handle.write(RunState.TRANSCRIPT_TAG + transcript + "\t" + fingerprint + "\n")
+        self._handle.write(RunState.OUTPUT_TAG + file_signature(output_file) + "\n")
+        self._handle.close()
+        os.replace(self._temporary_file, self.state_file)
+
+    def summary(self):
+        return "Incremental run: %d lines carried over, %d translated\n" % (self.lines_carried_over,
+                                                                          self.lines_translated)
@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+from time import perf_counter
+
+# phases of a run, in the order they are reported.  cigar_validation is part of parse_mappings, and
+# mappings_construction part of translation.
+PHASES = ("parse_mappings", "cigar_validation", "interval_index", "translation", "mappings_construction", "output",
+          "total")
+
+
+class RunStats:
+    """
+    Wall time of the phases of a translation run and counters of what it processed.  Passed to translate_coordinates
+    (and the functions it calls) to instrument a run; nothing is measured where it is None.
+    """
+
+    def __init__(self):
+        self.phases = {}  # phase -> seconds
+        self.counters = {}  # counter -> int
+
+    @contextmanager
+    def phase(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, name, function):
+        """
+        :return: function calling function and adding the time it takes to phase name
+        """
+        def timed_function(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(name, perf_counter() - start)
+        return timed_function
+
+    def as_dict(self):
+        """
+        :return: dict with "phases" (phase -> seconds) and "counters" (counter -> int)
+        """
+        return {"phases": dict(self.phases), "counters": dict(self.counters)}
+
+    def take(self):
+        """
+        :return: as_dict of the stats since the last call, which are reset
+        """
+        stats = self.as_dict()
+        self.phases = {}
+        self.counters = {}
+        return stats
+
+    def merge(self, stats):
+        """
+        Add the times and counters of another run, e.g. of a worker process.
+        :param stats: dict as returned by as_dict
+        """
+        for name, seconds in stats["phases"].items():
+            self.add_time(name, seconds)
+        for name, n in stats["counters"].items():
+            self.count(name, n)
+
+    def summary(self):
+        """
+        :return: string, one line per phase and counter
+        """
+        lines = []
+        for name in sorted(self.phases, key=lambda name: PHASES.index(name) if name in PHASES else len(PHASES)):
+            lines.append("%-32s%12.3f s" % (name, self.phases[name]))
+        for name in sorted(self.counters):
+            lines.append("%-32s%12d" % (name, self.counters[name]))
+        lookups = self.counters.get("lookups", 0) + self.counters.get("interval_lookups", 0)
+        if lookups:
+            # an estimate, see translate_coordinate.estimated_range_probes
+            lines.append("%-32s%12.2f" % ("estimated_range_probes_per_lookup",
+                                          self.counters.get("estimated_range_probes", 0) / float(lookups)))
+        result_cache_lookups = self.counters.get("result_cache_hits", 0) + self.counters.get("result_cache_misses", 0)
+        if result_cache_lookups:
+            lines.append("%-32s%12.2f" % ("result_cache_hit_rate", self.counters["result_cache_hits"] /
+                                          float(result_cache_lookups)))
+        return "".join(line + "\n" for line in lines)
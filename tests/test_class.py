@@ -1,10 +1,18 @@
 import os
 import sys
+import shutil
+import tempfile
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
 
 from nose import with_setup
 from nose.tools import nottest
-from translate_coordinate import Mappings
+from translate_coordinate import Mappings, MappingsCache, GenomicMapping, GenomeMappingIndex, ResultCache, \
+    translate_coordinates, load_genome_mappings
+from genome_mapping import load_genome_mappings_parallel
+from error_log import ErrorLog
+from mapping_db import MappingDatabase, compile_mapping_database
+from translation_server import TranslationBatcher, run_server
+from run_stats import RunStats
 
 class TestTranscriptToGenomicInvitaeInput:
     mappings={}
@@ -336,6 +344,814 @@ class TestIndelsGenomicToTranscript:
         assert coord13 == (6,7)
 
 
+class TestMappingsCache:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        self.GM1 = GenomicMapping('TR1', 'CHR1', '3', '8M7D6M2I2M11D7M', '+')
+        self.GM2 = GenomicMapping('TR2', 'CHR2', '10', '20M', '+')
+
+    def test(self):
+        cache = MappingsCache(1)
+        M1 = cache.get(self.GM1)
+        assert cache.get(self.GM1) is M1
+        assert Mappings.transcript_to_genomic_pos(4, M1) == (7,7)
+        cache.get(self.GM2)  # evicts TR1
+        assert cache.get(self.GM1) is not M1
+        assert cache.hits == 1
+        assert cache.misses == 3
+
+
+class TestResultCache:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def test(self):
+        for policy, kept in (('lru', ('TR1', '4', 'TRANSCRIPT')), ('fifo', ('TR2', '0', 'TRANSCRIPT'))):
+            cache = ResultCache(2, policy)
+            cache.put(('TR1', '4', 'TRANSCRIPT'), ('TR1\t4\tCHR1\t7', 0))
+            cache.put(('TR2', '0', 'TRANSCRIPT'), ('TR2\t0\tCHR2\t10', 0))
+            assert cache.get(('TR1', '4', 'TRANSCRIPT')) == ('TR1\t4\tCHR1\t7', 0)
+            # evicts TR2 (least recently used) or TR1 (first cached)
+            cache.put(('TR1', '13', 'TRANSCRIPT'), ('TR1\t13\tCHR1\t23', 0))
+            assert cache.get(kept) is not None, policy
+            assert (cache.hits, cache.misses, cache.evictions) == (2, 0, 1)
+            assert cache.get(('TR1', '7', 'GENOMIC')) is None
+            assert cache.summary() == 'Result cache: 2 hits, 1 misses (66.7% hit rate), 1 evictions\n'
+
+
+class TestBatchTranslation:
+    mappings={}
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        cigar = '8M7D6M2I2M11D7M'
+        chr = 'CHR1'
+        genomic_pos = 3
+        self.mappings['TR1'] = Mappings(cigar, chr, genomic_pos, '+')
+        self.mappings['TR3'] = Mappings(cigar, chr, genomic_pos, '-')
+
+    def test(self):
+        from mappings import POS_OK, POS_NEGATIVE, POS_AFTER_END, POS_BEFORE_START
+
+        coords, status = Mappings.transcript_to_genomic_many([4, 13, 15, -1, 25], self.mappings['TR1'])
+        assert coords[:3].tolist() == [[7,7], [23,23], [23,24]]
+        assert status.tolist() == [POS_OK, POS_OK, POS_OK, POS_NEGATIVE, POS_AFTER_END]
+        assert coords[3:].tolist() == [[-1,-1], [-1,-1]]
+
+        coords, status = Mappings.genomic_to_transcript_many([43, 3, 15, 30, 2], self.mappings['TR3'])
+        assert coords[:4].tolist() == [[0,0], [24,24], [16,17], [6,7]]
+        assert status.tolist() == [POS_OK, POS_OK, POS_OK, POS_OK, POS_BEFORE_START]
+
+
+class TestRangeStorage:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        self.TR3 = Mappings('8M7D6M2I2M11D7M', 'CHR1', 3, '-')
+
+    def test(self):
+        import pickle
+
+        ranges = [(r.start_pos, r.stop_pos, r.cigar_operation.operation) for r in self.TR3.query_ranges]
+        assert ranges == [(17,24,'M'), (16,16,'D'), (11,16,'M'), (9,10,'I'), (7,8,'M'), (6,6,'D'), (0,6,'M')]
+        assert [(o.op_length, o.operation) for o in self.TR3.cigar_operations[:2]] == [(8,'M'), (7,'D')]
+
+        # views are read-only: changing a returned range does not change the mapping
+        self.TR3.reference_ranges[0].start_pos = 100
+        assert self.TR3.reference_ranges[0].start_pos == 3
+
+        # list API still works on the views
+        assert Mappings.get_pos(self.TR3.query_ranges, self.TR3.reference_ranges, 4, False, True) == (39,39)
+
+        TR3 = pickle.loads(pickle.dumps(self.TR3))
+        assert Mappings.transcript_to_genomic_pos(13, TR3) == (21,21)
+
+    def test_leading_clip(self):
+        # the reference range of a leading soft clip or insertion is empty (stop = start - 1), on both strands
+        for cigar in ('3S10M', '3I10M'):
+            operation = cigar[1]
+            for orientation, clip_range, match_range in (('+', (0,2), (3,12)), ('-', (10,12), (0,9))):
+                M = Mappings(cigar, 'CHR1', 5, orientation)
+                assert [(r.start_pos, r.stop_pos, r.cigar_operation.operation) for r in M.query_ranges] == \
+                    [clip_range + (operation,), match_range + ('M',)]
+                assert [(r.start_pos, r.stop_pos, r.cigar_operation.operation) for r in M.reference_ranges] == \
+                    [(5,4,operation), (5,14,'M')]
+                is_forward = orientation == '+'
+                for position in (1, 5):
+                    assert Mappings.get_pos(M.query_ranges, M.reference_ranges, position, is_forward, True) == \
+                        Mappings.transcript_to_genomic_pos(position, M)
+                    assert Mappings.get_pos(M.reference_ranges, M.query_ranges, position + 5, True, is_forward) == \
+                        Mappings.genomic_to_transcript_pos(position + 5, M)
+
+
+class TestLazyRanges:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        # 1001 exons of 10 bases separated by 90 base introns
+        self.cigar = '10M90N' * 1000 + '10M'
+
+    def test(self):
+        import pickle
+        from mappings import RANGE_CHUNK_SIZE
+
+        TR1 = Mappings(self.cigar, 'CHR1', 100, '+')
+        assert not TR1.ranges_expanded
+        assert (TR1.transcript_length, TR1.genomic_length) == (10010, 100010)
+        assert Mappings.transcript_to_genomic_pos(15, TR1) == (205,205)
+        assert Mappings.genomic_to_transcript_pos(150, TR1) == (9,10)
+        assert not TR1.ranges_expanded and len(TR1.cigar_operations) == 2001
+
+        # the 5' end of a transcript on the reverse strand is at the end of the cigar
+        TR3 = Mappings(self.cigar, 'CHR1', 100, '-')
+        assert Mappings.transcript_to_genomic_pos(10000, TR3) == (109,109)
+        assert not TR3.ranges_expanded
+        # the stops of the ranges expanded so far, in 5'->3' order, are found while the others are not expanded
+        assert list(TR3._query_scan_stops) == sorted(TR3._query_stops)
+        assert Mappings.transcript_to_genomic_pos(9000, TR3) == (10109,10109)
+        assert not TR3.ranges_expanded and list(TR3._query_scan_stops) == sorted(TR3._query_stops)
+        TR3 = pickle.loads(pickle.dumps(TR3))
+        assert Mappings.transcript_to_genomic_pos(5000, TR3) == (50109,50109)
+        assert Mappings.transcript_to_genomic_pos(0, TR3) == (100109,100109)
+        assert TR3.ranges_expanded
+
+        # the range arrays are expanded as a whole when they are read
+        assert len(TR1.query_starts) == 2001 and TR1.ranges_expanded
+        assert TR1.query_stops[-1] == 10009 and TR3.query_scan_stops[-1] == 10009
+        assert RANGE_CHUNK_SIZE < 2001
+
+
+class TestSweepTranslation:
+    mappings={}
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        cigar = '8M7D6M2I2M11D7M'
+        chr = 'CHR1'
+        genomic_pos = 3
+        self.mappings['TR1'] = Mappings(cigar, chr, genomic_pos, '+')
+        self.mappings['TR3'] = Mappings(cigar, chr, genomic_pos, '-')
+
+    def test(self):
+        coords = Mappings.transcript_to_genomic_sweep([-1, 4, 13, 15, 17, 25], self.mappings['TR1'])
+        assert coords == [None, (7,7), (23,23), (23,24), (25,25), None]
+
+        coords = Mappings.genomic_to_transcript_sweep([3, 6, 15, 23, 24, 30, 43], self.mappings['TR3'])
+        assert coords == [(24,24), (21,21), (16,17), (11,11), (8,8), (6,7), (0,0)]
+
+
+class TestDenseTables:
+    mappings={}
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        cigar = '8M7D6M2I2M11D7M'
+        chr = 'CHR1'
+        genomic_pos = 3
+        self.mappings['TR1'] = Mappings(cigar, chr, genomic_pos, '+')
+        self.mappings['TR3'] = Mappings(cigar, chr, genomic_pos, '-')
+
+    def test(self):
+        import gc
+        from mappings import DenseTableBudget, DENSE_TABLE_MIN_HITS
+
+        for name, M in self.mappings.items():
+            transcript_positions = list(range(-1, 27))
+            genomic_positions = list(range(1, 46))
+            expected = ([Mappings.transcript_to_genomic_pos(p, M) for p in transcript_positions],
+                        [Mappings.genomic_to_transcript_pos(p, M) for p in genomic_positions])
+            budget = DenseTableBudget(max_span=100)
+            M.build_dense_tables(budget)
+            assert M.transcript_table is not None and M.genomic_table is not None
+            assert budget.tables_built == 2 and budget.used_bytes > 0
+            assert [Mappings.transcript_to_genomic_pos(p, M) for p in transcript_positions] == expected[0], name
+            assert [Mappings.genomic_to_transcript_pos(p, M) for p in genomic_positions] == expected[1], name
+            assert Mappings.transcript_to_genomic_sweep(transcript_positions, M) == expected[0], name
+            assert Mappings.genomic_to_transcript_sweep(genomic_positions, M) == expected[1], name
+
+        # the genomic span (41 positions) is too long, the transcript table does not fit
+        budget = DenseTableBudget(max_span=30, max_bytes=10)
+        M = Mappings('8M7D6M2I2M11D7M', 'CHR1', 3, '+')
+        M.build_dense_tables(budget)
+        assert M.transcript_table is None and M.genomic_table is None
+        assert budget.tables_refused == 1 and budget.used_bytes == 0
+
+        # tables are built after DENSE_TABLE_MIN_HITS cache hits, their bytes released when the mapping is evicted
+        budget = DenseTableBudget()
+        cache = MappingsCache(1, dense_tables=budget)
+        GM1 = GenomicMapping('TR1', 'CHR1', '3', '8M7D6M2I2M11D7M', '+')
+        for i in range(DENSE_TABLE_MIN_HITS):
+            assert cache.get(GM1).transcript_table is None
+        assert cache.get(GM1).transcript_table is not None
+        assert budget.used_bytes > 0
+        cache.get(GenomicMapping('TR2', 'CHR2', '10', '20M', '+'))
+        gc.collect()
+        assert budget.used_bytes == 0
+
+
+class TestChainedMappings:
+    mappings={}
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        cigar = '8M7D6M2I2M11D7M'
+        chr = 'CHR1'
+        genomic_pos = 3
+        self.mappings['TR1'] = Mappings(cigar, chr, genomic_pos, '+')
+        self.mappings['TR3'] = Mappings(cigar, chr, genomic_pos, '-')
+        # CHR1 on another assembly: 5 bases missing at the start, 3 bases inserted after CHR1 position 24
+        self.mappings['CHR1'] = Mappings('5I20M3D30M', 'CHR1_B', 100, '+')
+        self.mappings['CHR1_REVERSE'] = Mappings('5I20M3D30M', 'CHR1_B', 100, '-')
+
+    def test(self):
+        TR1 = Mappings.compose(self.mappings['TR1'], self.mappings['CHR1'])
+        assert (TR1.cigar_string, TR1.genomic_chr, TR1.genomic_mapping_pos) == ('2I6M7D6M2I1M3D1M11D7M', 'CHR1_B', 100)
+        assert TR1.is_transcript_forward
+        assert Mappings.transcript_to_genomic_pos(4, TR1) == (102,102)
+        assert Mappings.transcript_to_genomic_pos(15, TR1) == (118,119)
+        assert Mappings.genomic_to_transcript_pos(137, TR1) == (20,20)
+        # transcript positions on CHR1 positions missing from CHR1_B are insertions
+        assert Mappings.transcript_to_genomic_pos(0, TR1) == (99,100)
+
+        TR3 = Mappings.compose(self.mappings['TR3'], self.mappings['CHR1_REVERSE'])
+        assert TR3.is_transcript_forward
+        for position in (0, 4, 13, 24):
+            two_hops = Mappings.transcript_to_genomic_pos(position, self.mappings['TR3'])
+            two_hops = Mappings.transcript_to_genomic_pos(two_hops[0], self.mappings['CHR1_REVERSE'])
+            assert Mappings.transcript_to_genomic_pos(position, TR3) == two_hops
+
+        try:
+            Mappings.compose(self.mappings['TR1'], Mappings('10M', 'CHR1_B', 100, '+'))
+            assert False
+        except ValueError as e:
+            assert 'is not within the transcript' in str(e)
+
+
+class TestIntervalTranslation:
+    mappings={}
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        cigar = '8M7D6M2I2M11D7M'
+        chr = 'CHR1'
+        genomic_pos = 3
+        self.mappings['TR1'] = Mappings(cigar, chr, genomic_pos, '+')
+        self.mappings['TR3'] = Mappings(cigar, chr, genomic_pos, '-')
+
+    def test(self):
+        from mappings import POS_OK, POS_INVALID_INTERVAL
+        blocks = Mappings.transcript_interval_to_genomic(4, 15, self.mappings['TR1'])
+        assert blocks == [('M', 4, 7, 7, 10), ('D', 7, 8, 11, 17), ('M', 8, 13, 18, 23), ('I', 14, 15, 23, 24)], blocks
+
+        blocks = Mappings.genomic_interval_to_transcript(20, 27, self.mappings['TR1'])
+        assert blocks == [('M', 20, 23, 10, 13), ('I', 23, 24, 14, 15), ('M', 24, 25, 16, 17),
+                          ('D', 26, 27, 17, 18)], blocks
+
+        blocks, status = Mappings.transcript_interval_to_genomic(0, 0, self.mappings['TR3'], True)
+        assert status == POS_OK and blocks == [('M', 0, 0, 43, 43)], blocks
+
+        blocks, status = Mappings.transcript_interval_to_genomic(5, 3, self.mappings['TR1'], True)
+        assert blocks is None and status == POS_INVALID_INTERVAL
+
+class TestTranslateCoordinates:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        test_dir = os.path.dirname(os.path.realpath(__file__))
+        self.genome_mapping_file = os.path.join(test_dir, 'file1.txt')
+        self.processing_file = os.path.join(test_dir, 'file2.txt')
+        with open(os.path.join(test_dir, 'output.txt')) as in_handle:
+            self.expected = in_handle.read()
+        self.output_dir = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.output_dir, 'output.txt')
+
+    def teardown(self):
+        shutil.rmtree(self.output_dir)
+
+    def translate(self, **kwargs):
+        translate_coordinates(self.genome_mapping_file, self.processing_file, self.output_file, **kwargs)
+        with open(self.output_file) as in_handle:
+            return in_handle.read()
+
+    def test(self):
+        assert self.translate() == self.expected
+        assert self.translate(grouped=True) == self.expected
+        assert self.translate(workers=2, chunk_size=3) == self.expected
+        for kwargs in ({'workers': 2, 'chunk_size': 0}, {'incremental': True, 'chunk_size': 0}, {'chunk_size': -1}):
+            try:
+                self.translate(**kwargs)
+                assert False, kwargs
+            except ValueError as e:
+                assert str(e).startswith('Chunk size must be at least 1'), str(e)
+
+    def test_database(self):
+        import pickle
+
+        database_file = os.path.join(self.output_dir, 'mappings.db')
+        assert compile_mapping_database(self.genome_mapping_file, database_file) == 3
+
+        database = MappingDatabase(database_file)
+        assert 'TR4' not in database
+        TR3 = database.get_mappings(database['TR3'])
+        assert Mappings.transcript_to_genomic_pos(13, TR3) == (21,21)
+        assert Mappings.genomic_to_transcript_pos(15, TR3) == (16,17)
+        TR3 = pickle.loads(pickle.dumps(TR3))
+        assert Mappings.transcript_to_genomic_pos(4, TR3) == (39,39)
+        database.close()
+
+        self.genome_mapping_file = database_file
+        assert self.translate() == self.expected
+        assert self.translate(workers=2, chunk_size=3) == self.expected
+
+    def test_sam(self):
+        self.genome_mapping_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'file1.sam')
+        assert self.translate() == self.expected
+        assert self.translate(grouped=True) == self.expected
+
+        # header lines are ignored, the reverse strand comes from the FLAG, and the secondary alignment of TR2 is only
+        # used (as its last record) when secondary records are not skipped
+        mappings = load_genome_mappings(self.genome_mapping_file)
+        assert sorted(mappings) == ['TR1', 'TR2', 'TR3']
+        assert mappings['TR2'].pos == 10 and mappings['TR3'].orientation == '-'
+        mappings = load_genome_mappings(self.genome_mapping_file, sam_skip_flags=0x4)
+        assert mappings['TR2'].pos == 499 and 'TR4' not in mappings  # POS is 1-based
+        error_log = ErrorLog(buffer_size=None)
+        load_genome_mappings(self.genome_mapping_file, error_log, sam_skip_flags=0)
+        assert ('GENOME_MAPPING', 8, 'TR4', 'INVALID_MAPPING') in error_log.records
+
+        # records need the 11 mandatory columns
+        sam_file = os.path.join(self.output_dir, 'short.sam')
+        with open(sam_file, 'w') as o_handle:
+            o_handle.write('@HD\tVN:1.6\n')
+            o_handle.write('TR1\t0\tCHR1\t4\t60\t8M7D6M2I2M11D7M\t*\t0\t0\t*\n')
+        error_log = ErrorLog(buffer_size=None)
+        assert load_genome_mappings(sam_file, error_log) == {}
+        assert error_log.records == [('GENOME_MAPPING', 2, 'TR1', 'TOO_FEW_COLUMNS')]
+
+    def test_compressed(self):
+        import gzip
+
+        for name in ('genome_mapping_file', 'processing_file'):
+            compressed_file = os.path.join(self.output_dir, os.path.basename(getattr(self, name)) + '.gz')
+            with open(getattr(self, name), 'rb') as in_handle, gzip.open(compressed_file, 'wb') as o_handle:
+                o_handle.write(in_handle.read())
+            setattr(self, name, compressed_file)
+        self.output_file = os.path.join(self.output_dir, 'output.txt.gz')
+
+        translate_coordinates(self.genome_mapping_file, self.processing_file, self.output_file, workers=2,
+                              chunk_size=3)
+        with gzip.open(self.output_file, 'rt') as in_handle:
+            assert in_handle.read() == self.expected
+
+    def test_chain(self):
+        genome_mapping_file = os.path.join(self.output_dir, 'mappings.txt')
+        with open(self.genome_mapping_file) as in_handle, open(genome_mapping_file, 'w') as o_handle:
+            o_handle.write(in_handle.read())
+            o_handle.write('CHR1\tCHR1_B\t100\t5I20M3D30M\t+\n')
+        self.genome_mapping_file = genome_mapping_file
+        processing_file = os.path.join(self.output_dir, 'processing.txt')
+        with open(processing_file, 'w') as o_handle:
+            o_handle.write('TR1>CHR1\t4\n')
+            o_handle.write('TR1>CHR1\t137\tGENOMIC\n')
+            o_handle.write('TR3>CHR1\t13\n')
+            o_handle.write('TR2>CHR1\t4\n')  # TR2 is on CHR2
+            o_handle.write('TR1>CHR9\t4\n')  # unknown mapping
+        self.processing_file = processing_file
+        error_file = os.path.join(self.output_dir, 'errors.txt')
+
+        expected = 'TR1>CHR1\t4\tCHR1_B\t102\nTR1>CHR1\t20\tCHR1_B\t137\nTR3>CHR1\t13\tCHR1_B\t116\n'
+        expected_records = ['#SOURCE\tLINE\tTRANSCRIPT\tERROR\n',
+                            'PROCESSING\t4\tTR2>CHR1\tINVALID_CHAIN\n',
+                            'PROCESSING\t5\tTR1>CHR9\tUNKNOWN_TRANSCRIPT\n']
+        for kwargs in ({}, {'grouped': True}, {'workers': 2, 'chunk_size': 2}):
+            assert self.translate(error_file=error_file, **kwargs) == expected
+            with open(error_file) as in_handle:
+                assert in_handle.readlines() == expected_records
+
+    def test_result_cache(self):
+        processing_file = os.path.join(self.output_dir, 'processing.txt')
+        with open(self.processing_file) as in_handle, open(processing_file, 'w') as o_handle:
+            lines = in_handle.readlines()
+            # every query three times, with a failed translation and an unknown transcript
+            o_handle.writelines((lines + ['TR1\t1000\n', 'TR9\t3\n']) * 3)
+        error_file = os.path.join(self.output_dir, 'errors.txt')
+        self.processing_file = processing_file
+
+        expected = self.translate(error_file=error_file, error_column=True)
+        with open(error_file) as in_handle:
+            expected_records = sorted(in_handle)
+        assert expected.count('\tPOSITION_AFTER_END') == 3 and len(expected_records) == 7
+
+        for kwargs in ({'result_cache_size': 100}, {'result_cache_size': 2, 'result_cache_policy': 'fifo'},
+                       {'result_cache_size': 100, 'grouped': True}, {'result_cache_size': 100, 'workers': 2,
+                                                                     'chunk_size': 13}):
+            stats = RunStats()
+            assert self.translate(error_file=error_file, error_column=True, stats=stats, **kwargs) == expected
+            with open(error_file) as in_handle:
+                # grouped translation reports the errors per transcript
+                assert sorted(in_handle) == expected_records
+            counters = stats.as_dict()['counters']
+            assert counters['result_cache_hits'] + counters['result_cache_misses'] == 39
+            if kwargs['result_cache_size'] == 100 and 'workers' not in kwargs:
+                # the queries are only translated the first time, every worker has its own cache
+                assert counters['result_cache_hits'] == 24 and counters['lookups'] == 12, kwargs
+
+    def test_incremental(self):
+        genome_mapping_file = os.path.join(self.output_dir, 'mappings.txt')
+        shutil.copy(self.genome_mapping_file, genome_mapping_file)
+        self.genome_mapping_file = genome_mapping_file
+        error_file = os.path.join(self.output_dir, 'errors.txt')
+
+        def carried_over(**kwargs):
+            stats = RunStats()
+            output = self.translate(incremental=True, chunk_size=4, error_file=error_file, stats=stats, **kwargs)
+            with open(error_file) as in_handle:
+                return output, in_handle.read(), stats.as_dict()['counters']['lines_carried_over']
+
+        output, records, n_carried = carried_over()
+        assert output == self.expected and n_carried == 0
+        assert os.path.isfile(self.output_file + '.state')
+        assert carried_over() == (self.expected, records, 11)
+
+        # TR2 is moved: only its 4 queries are translated again
+        with open(genome_mapping_file, 'a') as o_handle:
+            o_handle.write('TR2\tCHR2\t20\t20M\t+\n')
+        plain_output_file = os.path.join(self.output_dir, 'plain.txt')
+        translate_coordinates(genome_mapping_file, self.processing_file, plain_output_file, error_file=error_file)
+        with open(plain_output_file) as in_handle:
+            expected = in_handle.read()
+        with open(error_file) as in_handle:
+            expected_records = in_handle.read()
+        assert expected != self.expected and expected_records.count('\tPOSITION_BEFORE_START') == 1
+        assert carried_over() == (expected, expected_records, 7)
+        assert carried_over(grouped=True) == (expected, expected_records, 11)
+
+        # the output of a run with another error column is not carried over
+        translate_coordinates(genome_mapping_file, self.processing_file, plain_output_file, error_column=True)
+        with open(plain_output_file) as in_handle:
+            expected = in_handle.read()
+        assert carried_over(error_column=True) == (expected, expected_records, 0)
+
+    def test_columnar(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        queries = [line.rstrip('\n').split('\t') for line in open(self.processing_file)] + [['TR1', '4-13'],
+                                                                                            ['TR1', '1000']]
+        table = pa.table({'transcript': [query[0] for query in queries],
+                          'position': pa.array([int(query[1].split('-')[0]) for query in queries], pa.int64()),
+                          'end': pa.array([int(query[1].split('-')[1]) if '-' in query[1] else None
+                                           for query in queries], pa.int64()),
+                          'direction': [query[2] if len(query) == 3 else None for query in queries]})
+        self.processing_file = os.path.join(self.output_dir, 'processing.parquet')
+        pq.write_table(table, self.processing_file)
+        expected = self.expected + 'TR1\t4-13\tCHR1\tM:7-10,D:11-17,M:18-23\nTR1\t1000\tCHR1\tERROR\n'
+        assert self.translate() == expected
+        assert self.translate(grouped=True, workers=2, chunk_size=5) == expected
+
+        for output_file in ('output.parquet', 'output.arrow'):
+            self.output_file = os.path.join(self.output_dir, output_file)
+            translate_coordinates(self.genome_mapping_file, self.processing_file, self.output_file)
+            if output_file.endswith('.parquet'):
+                output = pq.read_table(self.output_file)
+            else:
+                output = pa.ipc.open_file(self.output_file).read_all()
+            assert output.schema.field('genomic_start').type == pa.int64()
+            records = output.to_pylist()
+            assert len(records) == 13
+            assert records[0] == {'transcript': 'TR1', 'transcript_start': 4, 'transcript_end': 4,
+                                  'chromosome': 'CHR1', 'genomic_start': 7, 'genomic_end': 7, 'blocks': None,
+                                  'status': 'OK'}
+            assert (records[4]['transcript_start'], records[4]['genomic_start']) == (4, 7)
+            assert (records[8]['genomic_start'], records[8]['genomic_end']) == (23, 24)
+            assert records[11]['blocks'] == 'M:7-10,D:11-17,M:18-23'
+            assert (records[11]['genomic_start'], records[11]['genomic_end']) == (7, 23)
+            assert records[12]['genomic_start'] is None and records[12]['status'] == 'POSITION_AFTER_END'
+
+    def test_stats(self):
+        for kwargs in ({}, {'grouped': True}, {'workers': 2, 'chunk_size': 3}):
+            stats = RunStats()
+            assert self.translate(stats=stats, **kwargs) == self.expected
+            counters = stats.as_dict()['counters']
+            assert counters['mapping_lines_read'] == 3
+            assert counters['processing_lines_read'] == 11
+            assert counters['queries_TRANSCRIPT'] == 7
+            assert counters['queries_GENOMIC'] == 4
+            assert counters['lookups'] == 11
+            assert 0 < counters['estimated_range_probes'] <= 11 * 8
+            assert counters['output_lines'] == 11
+            for phase in ('parse_mappings', 'cigar_validation', 'translation', 'mappings_construction', 'output',
+                          'total'):
+                assert stats.phases[phase] >= 0
+
+    def test_errors(self):
+        processing_file = os.path.join(self.output_dir, 'processing.txt')
+        with open(processing_file, 'w') as o_handle:
+            o_handle.write('TR1\t4\n')
+            o_handle.write('TR9\t3\n')  # unknown transcript
+            o_handle.write('TR1\t1000\n')  # after the end of the alignment
+            o_handle.write('TR1\n')  # too few columns
+            o_handle.write('TR2\t5\tGENOMIC\n')  # before the start of the alignment
+        self.processing_file = processing_file
+        error_file = os.path.join(self.output_dir, 'errors.txt')
+
+        expected_records = ['#SOURCE\tLINE\tTRANSCRIPT\tERROR\n',
+                            'PROCESSING\t2\tTR9\tUNKNOWN_TRANSCRIPT\n',
+                            'PROCESSING\t3\tTR1\tPOSITION_AFTER_END\n',
+                            'PROCESSING\t4\tTR1\tTOO_FEW_COLUMNS\n',
+                            'PROCESSING\t5\tTR2\tPOSITION_BEFORE_START\n']
+        expected = 'TR1\t4\tCHR1\t7\tOK\nTR1\t1000\tCHR1\tERROR\tPOSITION_AFTER_END\n' \
+                   'TR2\tERROR\tCHR2\t5\tPOSITION_BEFORE_START\n'
+
+        for kwargs in ({}, {'workers': 2, 'chunk_size': 2, 'output_buffer_size': 1}):
+            assert self.translate(error_file=error_file, error_column=True, **kwargs) == expected
+            with open(error_file) as in_handle:
+                assert in_handle.readlines() == expected_records
+
+
+class TestTranslationServer:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        test_dir = os.path.dirname(os.path.realpath(__file__))
+        self.genome_mapping_file = os.path.join(test_dir, 'file1.txt')
+        with open(os.path.join(test_dir, 'file2.txt')) as in_handle:
+            self.processing_lines = in_handle.read().splitlines()
+        with open(os.path.join(test_dir, 'output.txt')) as in_handle:
+            self.expected = [line + '\tOK' for line in in_handle.read().splitlines()]
+        self.output_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.output_dir, 'translate.sock')
+
+    def teardown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test(self):
+        import json
+        import asyncio
+
+        async def query(requests):
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            # pipelined requests are answered in order
+            writer.write(''.join(json.dumps(request) + '\n' for request in requests).encode())
+            writer.write_eof()
+            responses = [json.loads(line) for line in (await reader.read()).splitlines()]
+            writer.close()
+            return responses
+
+        async def session():
+            mappings = load_genome_mappings(self.genome_mapping_file)
+            batcher = TranslationBatcher(mappings, MappingsCache())
+            server_task = asyncio.ensure_future(run_server(batcher, self.socket_path))
+            while not os.path.exists(self.socket_path):
+                await asyncio.sleep(0.01)
+            try:
+                return await asyncio.gather(
+                    query([{'lines': self.processing_lines}]),
+                    query([{'line': line} for line in self.processing_lines] +
+                          [{'transcript': 'TR9', 'position': 3}, {'position': 3}]))
+            finally:
+                server_task.cancel()
+
+        bulk, single = asyncio.run(session())
+        assert bulk == [{'output': self.expected, 'errors': []}]
+        assert [response['output'][0] for response in single[:-2]] == self.expected
+        assert single[-2] == {'output': [], 'errors': [{'line': 1, 'transcript': 'TR9', 'error': 'UNKNOWN_TRANSCRIPT'}]}
+        assert 'error' in single[-1]
+
+    def test_http(self):
+        import json
+        import socket
+        import asyncio
+
+        with socket.socket() as free_port:
+            free_port.bind(('127.0.0.1', 0))
+            port = free_port.getsockname()[1]
+
+        async def post(content_length=None):
+            body = json.dumps({'line': self.processing_lines[0]})
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(('POST /translate HTTP/1.1\r\nContent-Length: ' + (content_length or str(len(body))) +
+                          '\r\n\r\n' + body).encode())
+            status_line = await reader.readline()
+            writer.close()
+            return status_line.split()[1]
+
+        async def session():
+            batcher = TranslationBatcher(load_genome_mappings(self.genome_mapping_file), MappingsCache())
+            server_task = asyncio.ensure_future(run_server(batcher, port=port))
+            try:
+                while True:
+                    try:
+                        (await asyncio.open_connection('127.0.0.1', port))[1].close()
+                        break
+                    except ConnectionRefusedError:
+                        await asyncio.sleep(0.01)
+                return await asyncio.gather(post(), post('two'), post('-2'))
+            finally:
+                server_task.cancel()
+
+        assert asyncio.run(session()) == [b'200', b'400', b'400']
+
+    def test_error_order(self):
+        batcher = TranslationBatcher(load_genome_mappings(self.genome_mapping_file), MappingsCache())
+        # grouped translation meets TR0 before TR1, the errors keep the order of the lines
+        response, = batcher.translate_batch([['TR1\t4', 'TR1\t100', 'TR0\t3']])
+        assert [(error['line'], error['transcript']) for error in response['errors']] == [(2, 'TR1'), (3, 'TR0')]
+
+
+class TestGenomeMappingIndex:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.genome_mapping_file = os.path.join(self.output_dir, 'mappings.txt')
+        with open(self.genome_mapping_file, 'w') as o_handle:
+            o_handle.write('TR1\tCHR1\t3\t8M7D6M2I2M11D7M\t+\n')
+            o_handle.write('TR2\tCHR2\t10\t20M\t+\n')
+            o_handle.write('TR1\tCHR1\t5\t10M\t+\n')  # last valid line of a transcript wins
+            o_handle.write('TR2\tCHR2\t10\t20Q\t+\n')  # invalid, TR2 keeps the line above
+
+    def teardown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test(self):
+        index = GenomeMappingIndex(self.genome_mapping_file)
+        assert os.path.isfile(self.genome_mapping_file + '.idx')
+        assert index['TR1'].pos == 5
+        assert index['TR2'].cigar_string == '20M'
+        assert 'TR3' not in index
+        index.close()
+
+        # stale index is rebuilt
+        with open(self.genome_mapping_file, 'a') as o_handle:
+            o_handle.write('TR3\tCHR3\t1\t5M\t-\n')
+        index = GenomeMappingIndex(self.genome_mapping_file)
+        assert index['TR3'].orientation == '-'
+        index.close()
+
+
+class TestParallelLoading:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.genome_mapping_file = os.path.join(self.output_dir, 'mappings.txt')
+        with open(self.genome_mapping_file, 'w') as o_handle:
+            for i in range(40):
+                o_handle.write('TR%d\tCHR1\t%d\t10M\t+\n' % (i % 25, i + 1))  # TR0 to TR14 twice, last line wins
+            o_handle.write('TR3\tCHR1\t100\t10Q\t+\n')  # invalid, TR3 keeps its last valid line
+            o_handle.write('TR30\tCHR2\t5\t8M2I2M\t-\n')
+            o_handle.write('TR31\tCHR2\tx\t10M\t+\n')  # invalid position
+
+    def teardown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test(self):
+        serial_log = ErrorLog(buffer_size=None)
+        serial_stats = RunStats()
+        serial = load_genome_mappings(self.genome_mapping_file, serial_log, serial_stats)
+        for n_chunks in (1, 3, 7, 100):
+            error_log = ErrorLog(buffer_size=None)
+            stats = RunStats()
+            mappings = load_genome_mappings_parallel(self.genome_mapping_file, 2, error_log, stats, n_chunks=n_chunks)
+            assert list(mappings) == list(serial)
+            assert [GM.fingerprint() for GM in mappings.values()] == [GM.fingerprint() for GM in serial.values()]
+            assert error_log.take_records() == serial_log.records
+            assert stats.counters['mapping_lines_read'] == serial_stats.counters['mapping_lines_read'] == 43
+        assert serial['TR3'].pos == 29
+        assert serial['TR30'].orientation == '-'
+        assert [record[1] for record in serial_log.records] == [41, 43]
+
+
+class TestGenomicIntervalIndex:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        from interval_index import GenomicIntervalIndex
+
+        genome_mappings = []
+        for GM in (GenomicMapping('TR1', 'CHR1', '3', '8M7D6M2I2M11D7M', '+'),
+                   GenomicMapping('TR2', 'CHR2', '10', '20M', '+'),
+                   GenomicMapping('TR3', 'CHR1', '3', '8M7D6M2I2M11D7M', '-'),
+                   GenomicMapping('TR5', 'CHR1', '40', '10M', '+')):
+            genome_mappings.append((GM, Mappings(GM.cigar_string, GM.chromosome, GM.pos, GM.orientation)))
+        self.index = GenomicIntervalIndex(genome_mappings)
+
+    def test(self):
+        def find(chromosome, position):
+            return [(GM.transcript_name, coord) for GM, coord in self.index.genomic_to_transcript_pos(chromosome, position)]
+
+        assert find('CHR1', 15) == [('TR1', (7,8)), ('TR3', (16,17))]
+        assert find('CHR1', 42) == [('TR1', (23,23)), ('TR3', (1,1)), ('TR5', (2,2))]
+        assert find('CHR1', 49) == [('TR5', (9,9))]
+        assert find('CHR1', 2) == []
+        assert find('CHR2', 12) == [('TR2', (2,2))]
+        assert find('CHR3', 12) == []
+
+
+class TestParseCigar:
+
+    def __init__ (self):
+        self.initialized = True
+
+    def test(self):
+        from mappings import parse_cigar
+
+        operations, op_lengths = parse_cigar('8M7D6M2I')
+        assert operations.tobytes() == b'MDMI'
+        assert op_lengths.tolist() == [8, 7, 6, 2]
+
+        # identical cigars are parsed once and share their arrays
+        assert parse_cigar('8M7D6M2I')[0] is operations
+        assert Mappings('8M7D6M2I2M', 'CHR1', 3, '+').operations is Mappings('8M7D6M2I2M', 'CHR2', 9, '-').operations
+
+        for cigar, message in (('10Q', 'Invalid cigar operation: Q at position 2'),
+                               ('10M5', 'Cigar length without an operation at position 3'),
+                               ('M10', 'Cigar operation M without a length at position 0'),
+                               ('10m', "Unexpected character 'm' at position 2"),
+                               ('5M2S3M', 'Clipping operations H and S can only be at the ends'),
+                               ('2S2H5M', 'Clipping operations H and S can only be at the ends'),
+                               ('5H', 'Cigar 5H has no operation'),
+                               ('', 'Cigar string is empty')):
+            try:
+                parse_cigar(cigar)
+                assert False, cigar
+            except ValueError as e:
+                assert str(e).startswith(message), str(e)
+
+        # invalid cigar strings are recorded in the error log instead of stderr
+        from genome_mapping import is_valid_cigar
+        error_log = ErrorLog(buffer_size=None)
+        assert is_valid_cigar('8M7D6M2I', error_log)
+        assert not is_valid_cigar('10Q', error_log, 3, 'TR2')
+        assert error_log.records == [('GENOME_MAPPING', 3, 'TR2', 'INVALID_CIGAR')]
+
+
+class TestSamCigarOperations:
+    mappings={}
+
+    def __init__ (self):
+        self.initialized = True
+
+    def setup(self):
+        # soft and hard clips, sequence matches and mismatches, and a 100 kb intron
+        cigar = '2H3S4=1X2M100000N5M2I3M3S'
+        self.mappings['TR1'] = Mappings(cigar, 'CHR1', 1000, '+')
+        self.mappings['TR3'] = Mappings(cigar, 'CHR1', 1000, '-')
+
+    def test(self):
+        from mappings import parse_cigar
+        operations, op_lengths = parse_cigar('2H3S4=1X2M100000N5M2I3M3S')
+        assert operations.tobytes() == b'S=XMNMIMS'
+        assert op_lengths.tolist() == [3, 4, 1, 2, 100000, 5, 2, 3, 3]
+
+        TR1 = self.mappings['TR1']
+        # one range per operation, whatever the length of the intron
+        assert len(TR1.reference_starts) == 9
+        assert TR1.reference_starts[5] == 101007
+
+        coords = [Mappings.transcript_to_genomic_pos(pos, TR1) for pos in (0, 3, 7, 9, 10, 15, 20)]
+        assert coords == [(999, 1000), (1000, 1000), (1004, 1004), (1006, 1006), (101007, 101007), (101011, 101012),
+                          (101014, 101015)], coords
+
+        coords = [Mappings.genomic_to_transcript_pos(pos, TR1) for pos in (999, 1000, 1007, 51000, 101007)]
+        assert coords == [None, (3, 3), (9, 10), (9, 10), (10, 10)], coords
+
+        TR3 = self.mappings['TR3']
+        coords = [Mappings.genomic_to_transcript_pos(pos, TR3) for pos in (1000, 1004, 1005, 1007, 101014)]
+        assert coords == [(19, 19), (15, 15), (14, 14), (12, 13), (3, 3)], coords
+
+        coords = [Mappings.transcript_to_genomic_pos(pos, TR3) for pos in (0, 15, 22)]
+        assert coords == [(101014, 101015), (1004, 1004), (999, 1000)], coords
+
 @nottest
 class TestInvalidInput:
     mappings={}
@@ -1,214 +1,1386 @@
 import os
 import sys
-import re
+import cProfile
 from argparse import ArgumentParser
-from mappings import Mappings
+from collections import OrderedDict
+from itertools import islice
+from multiprocessing import Pool
+from time import perf_counter
+from mappings import Mappings, DenseTableBudget, DENSE_TABLE_BUDGET, DENSE_TABLE_MAX_SPAN, DENSE_TABLE_MIN_HITS, \
+    POS_OK, POS_MESSAGES, POS_ERROR_CODES
+from genome_mapping import GenomicMapping, GenomeMappingIndex, SAM_SKIP_FLAGS, is_valid_cigar, load_genome_mappings
+from mapping_db import MappingDatabase, compile_mapping_database, is_mapping_database
+from interval_index import GenomicIntervalIndex
+from error_log import ErrorLog, GENOME_MAPPING_FILE, PROCESSING_FILE, report_error
+from run_stats import RunStats
+from run_state import RunState, RunStateWriter, chunk_digest, mapping_fingerprint, state_file_name
+from file_io import STDIO, input_exists, is_compressed, open_input, open_output, output_directory_exists
+from columnar_io import ColumnarQueryReader, ColumnarWriter, columnar_output_format, is_columnar_file
 
+# eviction policies of a ResultCache: least recently used, or first in first out
+RESULT_CACHE_POLICIES = ("lru", "fifo")
 
-class GenomicMapping:
+# separates the mappings of a chain in the transcript column of the processing file, e.g. TR1>CHR1: the mapping named
+# after a chromosome translates positions on that chromosome, e.g. to another assembly
+CHAIN_SEPARATOR = ">"
+
+
+def build_mappings(genome_mapping_info):
     """
-    Class to hold the input information about the mappings (contents from inputfile1.txt)
-    :param transcriptName: string, transcript name
-    :param: chromosome: string, genomic chromsome
-    :param: pos: int, genomic mapping position (presumably from the sam/bam file). According to spec, this represents the
-                position of the first match.
-    :param: cigar: string, cigar string of alignment of transcript to genome.
-    :param: orientation: string (+/-) which represents if transcript maps 5'->3' or 3'->5'
+    :param genome_mapping_info: GenomicMapping object of a transcript
+    :return: Mappings object built from its cigar string
     """
+    return Mappings(genome_mapping_info.cigar_string, genome_mapping_info.chromosome, genome_mapping_info.pos,
+                    genome_mapping_info.orientation)
 
-    def __init__(self, transcript_name, chromosome, pos, cigar, orientation):
-        self.transcript_name = transcript_name
-        self.chromosome = chromosome
 
-        try:
-            self.pos = int(pos)
-        except:
-            raise ValueError("Invalid alignment position for "+transcript_name+" "+chromosome+" "+pos+"\n")
+class OutputWriter:
+    """
+    Write output lines in batches: lines are joined and written once buffer_size of them are pending, instead of one
+    write per line.
+    :param o_handle: open file the lines are written to
+    :param buffer_size: int, number of lines kept before they are written
+    """
+
+    def __init__(self, o_handle, buffer_size=10000):
+        if buffer_size < 1:
+            raise ValueError("Output buffer size must be at least 1: " + str(buffer_size))
+        self.o_handle = o_handle
+        self.buffer_size = buffer_size
+        self.lines = []
 
-        if pos < 0:
-            raise ValueError("Alignment position is negative for "+transcript_name+" "+chromosome+" "+pos+"\n")
+    def write(self, line):
+        """
+        :param line: string, output line without new line
+        """
+        self.lines.append(line)
+        if len(self.lines) >= self.buffer_size:
+            self.flush()
 
-        self.cigar_string = cigar
-        if orientation != "+" and orientation != "-":
-            raise ValueError("Invalid alignment orientation " + str(orientation))
-        self.orientation = orientation
+    def write_lines(self, lines):
+        for line in lines:
+            self.write(line)
 
+    def flush(self):
+        if self.lines:
+            self.o_handle.write("\n".join(self.lines) + "\n")
+            self.lines = []
 
 
-def is_valid_cigar(cigar_string):
+class MappingsCache:
     """
-    :param cigar_string, string: Input cigar string
-    :return: boolean if valid or not
+    Least recently used cache of Mappings objects keyed by transcript name.  Building a Mappings object parses the
+    cigar string and allocates every range, so it is done once per transcript instead of once per query.
+    :param max_size: int, maximum number of Mappings objects to keep.  None means the cache is never evicted.
+    :param build: function building the Mappings object of a GenomicMapping on a miss.  Default is build_mappings.
+    :param dense_tables: DenseTableBudget object.  If provided, the dense lookup tables of a Mappings object (see
+    Mappings.build_dense_tables) are built within this budget once it has been found in the cache
+    DENSE_TABLE_MIN_HITS times: building them costs as much as hundreds of range searches, which transcripts queried a
+    few times do not repay.
     """
 
-    matches = re.findall(r'(\d+)([A-Z]{1})', cigar_string)
-    matches_2 = re.findall(r'([A-Z]{1})', cigar_string)
-    is_valid = True
+    def __init__(self, max_size=None, build=build_mappings, dense_tables=None):
+        if max_size is not None and max_size < 1:
+            raise ValueError("Mappings cache size must be at least 1: " + str(max_size))
+        self.max_size = max_size
+        self.build = build
+        self.dense_tables = dense_tables
+        self.hits = 0
+        self.misses = 0
+        self._mappings = OrderedDict()
+        self._hits_before_dense_tables = {}  # transcript -> hits left before its dense tables are built
 
-    if len(matches) != len(matches_2):
-        # sanity check that we when we parse only the operations, we get the same number of elements
-        return False
+    def get(self, genome_mapping_info):
+        """
+        Return the Mappings object for a transcript, building it on a miss.
+        :param genome_mapping_info: GenomicMapping object of the transcript
+        :return: Mappings object.  Raises if the mapping cannot be built; failures are not cached.
+        """
+        return self._get(genome_mapping_info.transcript_name, self.build, genome_mapping_info)
 
-    for m in matches:
-        op_len = m[0]
-        operation = m[1]
-        try:
-            int_test = int(op_len)
-        except:
-            sys.stderr.write("Operation length is not an integer: "+m[0]+" "+m[1]+"\n")
-            is_valid = False
+    def get_chain(self, chain_name, genome_mapping_infos):
+        """
+        Return the composed Mappings object of a chain of mappings, composing it on a miss (see Mappings.compose).  The
+        mappings of the chain are taken from the cache too.
+        :param chain_name: string, name the composed mapping is cached under, e.g. TR1>CHR1
+        :param genome_mapping_infos: list of GenomicMapping objects.  The genomic positions of every mapping are the
+        transcript positions of the next one.
+        :return: Mappings object.  Raises if a mapping of the chain cannot be built or composed.
+        """
+        return self._get(chain_name, self.compose, genome_mapping_infos)
+
+    def compose(self, genome_mapping_infos):
+        query_mapping = self.get(genome_mapping_infos[0])
+        for genome_mapping_info in genome_mapping_infos[1:]:
+            query_mapping = Mappings.compose(query_mapping, self.get(genome_mapping_info))
+        return query_mapping
+
+    def _get(self, transcript, build, *build_args):
+        query_mapping = self._mappings.get(transcript)
+        if query_mapping is not None:
+            self.hits += 1
+            self._mappings.move_to_end(transcript)
+            hits_left = self._hits_before_dense_tables.get(transcript)
+            if hits_left is not None:
+                if hits_left > 1:
+                    self._hits_before_dense_tables[transcript] = hits_left - 1
+                else:
+                    del self._hits_before_dense_tables[transcript]
+                    query_mapping.build_dense_tables(self.dense_tables)
+            return query_mapping
+
+        self.misses += 1
+        query_mapping = build(*build_args)
+        self._mappings[transcript] = query_mapping
+        if self.dense_tables is not None:
+            self._hits_before_dense_tables[transcript] = DENSE_TABLE_MIN_HITS
+        if self.max_size is not None and len(self._mappings) > self.max_size:
+            # evict the least recently used transcript
+            evicted, _ = self._mappings.popitem(last=False)
+            self._hits_before_dense_tables.pop(evicted, None)
+        return query_mapping
 
-        if operation not in 'MID':
-            is_valid = False
-            sys.stderr.write("Invalid cigar operation: "+operation+".\n")
-    return is_valid
+    def summary(self):
+        return "Mappings cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses\n"
+
+
+class ResultCache:
+    """
+    Bounded cache of the output of translated queries keyed by (transcript, position, direction) as written in the
+    processing file, so repeated queries skip the lookup and the output formatting.  Failed translations (ERROR
+    output) are cached too.
+    :param max_size: int, maximum number of queries kept
+    :param policy: string, eviction policy, one of RESULT_CACHE_POLICIES: lru evicts the least recently used query,
+    fifo the first one cached
+    """
+
+    def __init__(self, max_size, policy="lru"):
+        if max_size < 1:
+            raise ValueError("Result cache size must be at least 1: " + str(max_size))
+        if policy not in RESULT_CACHE_POLICIES:
+            raise ValueError("Invalid result cache policy " + str(policy) + ", valid policies are " +
+                             ", ".join(RESULT_CACHE_POLICIES))
+        self.max_size = max_size
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._results = OrderedDict()
+
+    def get(self, key):
+        """
+        :param key: tuple (transcript, position, direction), see query_key
+        :return: tuple (output line without error column, POS_* code) of the query, None if it is not cached
+        """
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.policy == "lru":
+            self._results.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self._results[key] = result
+        if len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+            self.evictions += 1
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return "Result cache: %d hits, %d misses (%.1f%% hit rate), %d evictions\n" % (self.hits, self.misses, hit_rate,
+                                                                                   self.evictions)
+
+
+def build_result_cache(max_size, policy="lru"):
+    """
+    :return: ResultCache object, None if max_size is 0 (no result cache)
+    """
+    if max_size == 0:
+        return None
+    return ResultCache(max_size, policy)
 
 
 def validate_input(args):
     # TODO: at this stage can also verify format of the inputs
-    if not os.path.isfile( args.genome_mapping_file):
+    if not input_exists( args.genome_mapping_file):
         return (False, "Provided genome mapping file does not exist" )
 
-    if not os.path.isfile( args.transcript_processing_file):
+    if not input_exists( args.transcript_processing_file):
         # TODO: at this stage can also verify format of the inputs
         return (False, "Provided processing file does not exist" )
-    if not os.path.isdir(os.path.dirname(os.path.abspath(args.output_file))):
+    if args.genome_mapping_file == STDIO and args.transcript_processing_file == STDIO:
+        return (False, "Only one of the genome mapping file and the processing file can be read from stdin")
+    if args.use_index and (args.genome_mapping_file == STDIO or is_compressed(args.genome_mapping_file)):
+        return (False, "The genome mapping index (--index) needs an uncompressed genome mapping file")
+    if not output_directory_exists(args.output_file):
         return (False, "Specified parent directory for output file location does not exist")
+    if args.error_file is not None and not os.path.isdir(os.path.dirname(os.path.abspath(args.error_file))):
+        return (False, "Specified parent directory for error file location does not exist")
+    if args.output_buffer_size < 1:
+        return (False, "Output buffer size must be at least 1")
+    if args.mappings_cache_size is not None and args.mappings_cache_size < 1:
+        return (False, "Mappings cache size must be at least 1")
+    if args.workers < 1:
+        return (False, "Number of workers must be at least 1")
+    if args.chunk_size < 1:
+        return (False, "Chunk size must be at least 1")
+    if args.profile_file is not None and not os.path.isdir(os.path.dirname(os.path.abspath(args.profile_file))):
+        return (False, "Specified parent directory for profile file location does not exist")
+    if args.dense_table_max_span < 0 or args.dense_table_budget < 0:
+        return (False, "Dense table span and budget cannot be negative")
+    if args.result_cache_size < 0:
+        return (False, "Result cache size cannot be negative")
+    if args.incremental and (args.output_file == STDIO or args.workers > 1):
+        return (False, "Incremental runs (--incremental) need an output file and one worker")
+    if args.incremental and (is_columnar_file(args.transcript_processing_file) or
+                             columnar_output_format(args.output_file) is not None):
+        return (False, "Incremental runs (--incremental) cannot read or write Arrow and Parquet files")
 
     return (True, "")
 
 
-def translate_coordinates(genome_mapping_file, processing_file, output_file):
+def open_mappings(genome_mapping_file, use_index=False, error_log=None, stats=None, sam_skip_flags=SAM_SKIP_FLAGS,
+                  workers=1):
+    """
+    Open the mapping table of a genome mapping file, SAM file or compiled database.  See translate_coordinates.
+    :param genome_mapping_file, string: Name of file specifying alignment of transcript to genome, of a SAM file, or
+    of a database written by compile_mapping_database.
+    :param use_index, boolean: Read the lines of a genome mapping file on demand through a GenomeMappingIndex.
+    :param error_log: ErrorLog object invalid lines are recorded in.  Default reports them to stderr.
+    :param stats: RunStats object, see load_genome_mappings
+    :param sam_skip_flags: int, FLAG bits of the SAM records which are skipped, see parse_sam_line
+    :param workers: int, number of processes parsing a large genome mapping file, see load_genome_mappings
+    :return: tuple (mapping table, function building the Mappings object of one of its GenomicMapping objects)
+    """
+    if is_mapping_database(genome_mapping_file):
+        mappings = MappingDatabase(genome_mapping_file)
+        return mappings, mappings.get_mappings
+    if use_index:
+        return GenomeMappingIndex(genome_mapping_file, error_log=error_log, sam_skip_flags=sam_skip_flags), \
+               build_mappings
+    return load_genome_mappings(genome_mapping_file, error_log, stats, sam_skip_flags, workers), build_mappings
+
+
+def build_genomic_interval_index(mappings, build=build_mappings, error_log=None):
+    """
+    Build the Mappings of every transcript of a mapping table and index their genomic spans.
+    :param mappings: dict of transcript name -> GenomicMapping object, GenomeMappingIndex or MappingDatabase
+    :param build: function building the Mappings object of a GenomicMapping
+    :param error_log: ErrorLog object the transcripts which cannot be built are recorded in.  Default reports them to
+    stderr.
+    :return: GenomicIntervalIndex object
+    """
+    genome_mappings = []
+    for transcript in mappings:
+        genome_mapping_info = mappings.get(transcript)
+        if genome_mapping_info is None:
+            continue
+        try:
+            genome_mappings.append((genome_mapping_info, build(genome_mapping_info)))
+        except:
+            report_error(error_log, GENOME_MAPPING_FILE, None, transcript, "MAPPING_FAILED",
+                         "Could not process this mapping.  Excluding "+transcript+" from the genomic index.\n")
+    return GenomicIntervalIndex(genome_mappings)
+
+
+def build_dense_table_budget(max_span=DENSE_TABLE_MAX_SPAN, max_bytes=DENSE_TABLE_BUDGET):
+    """
+    :return: DenseTableBudget object, None if dense lookup tables are disabled (max_span or max_bytes is 0)
+    """
+    if max_span < 0 or max_bytes < 0:
+        raise ValueError("Dense table span and budget cannot be negative: " + str(max_span) + " " + str(max_bytes))
+    if max_span == 0 or max_bytes == 0:
+        return None
+    return DenseTableBudget(max_span, max_bytes)
+
+
+def has_dense_table(query_mapping, mapping_direction):
+    """
+    :return: boolean, True if positions of the query direction are looked up in a dense table of the Mappings object
+    """
+    if mapping_direction == "GENOMIC":
+        return query_mapping.genomic_table is not None
+    return query_mapping.transcript_table is not None
+
+
+def chain_genome_mapping(chain_name, query_mapping):
+    """
+    :param chain_name: string, transcript column of a chain in the processing file, e.g. TR1>CHR1
+    :param query_mapping: Mappings object composed from the mappings of the chain, see MappingsCache.get_chain
+    :return: GenomicMapping object of the composed alignment, named chain_name
+    """
+    return GenomicMapping(chain_name, query_mapping.genomic_chr, query_mapping.genomic_mapping_pos,
+                          query_mapping.cigar_string, "+" if query_mapping.is_transcript_forward else "-")
+
+
+def parse_query_position(field):
+    """
+    :param field: string, position column of the processing file: a position, or an interval START-END.  The int or
+    tuple (start, end) of a columnar processing file (see ColumnarQueryReader), None if the position is missing.
+    :return: int, or tuple (start, end) for an interval.  Raises ValueError if the column is not valid.
+    """
+    if not isinstance(field, str):
+        if field is None:
+            raise ValueError("Missing position")
+        return field
+    # a leading - is the sign of a (negative) position
+    separator = field.find("-", 1)
+    if separator < 0:
+        return int(field)
+    return int(field[:separator]), int(field[separator + 1:])
+
+
+def parse_processing_line(line, mappings, mappings_cache, interval_index=None, error_log=None, line_number=None):
+    """
+    Parse one line of the processing file.  Invalid lines are reported to error_log, or to stderr if there is none.
+    :param line, string: line of the processing file, or tuple (transcript, position, direction) of a columnar
+    processing file
+    :param mappings: dict of transcript name -> GenomicMapping object, or GenomeMappingIndex
+    :param mappings_cache: MappingsCache object the Mappings of the transcript is taken from
+    :param interval_index: GenomicIntervalIndex object, required for CHROMOSOME queries
+    :param error_log: ErrorLog object
+    :param line_number: int, number of the line in the processing file, for the error records
+    :return: tuple (GenomicMapping, query position, mapping direction, Mappings), None if the line is skipped.  The
+    query position is an int, or a tuple (start, end) for an interval.  For a CHROMOSOME query, which names a
+    chromosome instead of a transcript, the tuple is (chromosome, query position, "CHROMOSOME", None).
+    """
+    data = line if isinstance(line, tuple) else line.rstrip().split("\t")
+
+    if len(data)<2:
+        report_error(error_log, PROCESSING_FILE, line_number, data[0], "TOO_FEW_COLUMNS",
+                     "Line in processing file does have atleast 2 columns\n" + line)
+        return None
+
+    transcript = data[0]
+    try:
+        query_position = parse_query_position(data[1])
+    except ValueError:
+        report_error(error_log, PROCESSING_FILE, line_number, transcript, "INVALID_POSITION",
+                     "Position in processing file is not a position or an interval START-END. Skipping " +
+                     str(data[1]) + "\n")
+        return None
+
+    # default mapping is from transcript -> genome
+    mapping_direction = "TRANSCRIPT"
+
+    if len(data) == 3:
+        mapping_direction = data[2]
+
+    if mapping_direction == "CHROMOSOME":
+        if interval_index is None:
+            report_error(error_log, PROCESSING_FILE, line_number, transcript, "NO_GENOMIC_INDEX",
+                         "CHROMOSOME queries need the genomic index (--genomic-index). Skipping\n")
+            return None
+        if isinstance(query_position, tuple):
+            report_error(error_log, PROCESSING_FILE, line_number, transcript, "UNSUPPORTED_INTERVAL",
+                         "CHROMOSOME queries cannot be intervals. Skipping\n")
+            return None
+        return data[0], query_position, mapping_direction, None
+
+    chain = None
+    if transcript not in mappings and CHAIN_SEPARATOR in transcript:
+        chain = transcript.split(CHAIN_SEPARATOR)
+    for name in chain or [transcript]:
+        if name not in mappings:
+            report_error(error_log, PROCESSING_FILE, line_number, transcript, "UNKNOWN_TRANSCRIPT",
+                         "Can't find mappings for : " + name + "\n")
+            return None
+
+    # every mapping of a chain translates positions on the chromosome the previous one is on
+    for previous_name, name in zip(chain or [], (chain or [])[1:]):
+        if mappings[previous_name].chromosome != name:
+            report_error(error_log, PROCESSING_FILE, line_number, transcript, "INVALID_CHAIN",
+                         "Mapping " + previous_name + " is on chromosome " + mappings[previous_name].chromosome +
+                         ", not on " + name + ". Skipping\n")
+            return None
+
+    if mapping_direction != "TRANSCRIPT" and mapping_direction!="GENOMIC":
+        report_error(error_log, PROCESSING_FILE, line_number, transcript, "INVALID_DIRECTION",
+                     "Specification of mapping direction is not TRANSCRIPT or GENOMIC.Skipping\n")
+        return None
+
+    try:
+        if chain is None:
+            genome_mapping_info = mappings[transcript]
+            query_mapping = mappings_cache.get(genome_mapping_info)
+        else:
+            query_mapping = mappings_cache.get_chain(transcript, [mappings[name] for name in chain])
+            genome_mapping_info = chain_genome_mapping(transcript, query_mapping)
+    except:
+        report_error(error_log, PROCESSING_FILE, line_number, transcript, "MAPPING_FAILED",
+                     "Could not process this mapping.  Skipping "+transcript+".\n")
+        return None
+
+    return genome_mapping_info, query_position, mapping_direction, query_mapping
+
+
+def format_coordinate(coordinate):
+    """
+    :param coordinate: tuple (min_pos, max_pos)
+    :return: string, min_pos, or min_pos-max_pos if they differ
+    """
+    if coordinate[0] != coordinate[1]:
+        return str(coordinate[0]) + "-" + str(coordinate[1])
+    return str(coordinate[0])
+
+
+def format_output_coordinate(output_coordinate):
+    """
+    :param output_coordinate: tuple (min_pos, max_pos) of a translated position, or list of blocks of a translated
+    interval (see Mappings.get_interval_status), None if it could not be translated
+    :return: string.  Blocks are comma separated OPERATION:COORDINATES, with the translated coordinates of aligned (M)
+    blocks and of the bases of deletions (transcript query) or insertions (genomic query), and the coordinates
+    immediately before and after the other gaps.
+    """
+    if output_coordinate is None:
+        return "ERROR"
+    if isinstance(output_coordinate, list):
+        return ",".join(operation + ":" + format_coordinate((other_start, other_stop))
+                        for operation, start, stop, other_start, other_stop in output_coordinate)
+    return format_coordinate(output_coordinate)
+
+
+def format_output_line(genome_mapping_info, query_position, mapping_direction, output_coordinate, error_code=None):
+    """
+    Build the output line of a translated query.
+    :param genome_mapping_info: GenomicMapping object of the transcript
+    :param query_position: int, the queried position, or tuple (start, end) of the queried interval
+    :param mapping_direction: string, TRANSCRIPT or GENOMIC
+    :param output_coordinate: tuple (min_pos, max_pos) of the translated position, list of blocks of the translated
+    interval, None if it could not be translated.  See format_output_coordinate.
+    :param error_code: string, appended as a last column if provided (OK or the error code of the translation)
+    :return: string, tab separated output line (without new line)
+    """
+    if isinstance(query_position, tuple):
+        query_position = format_coordinate(query_position)
+
+    print_array = []
+    print_array.append(genome_mapping_info.transcript_name)
+    print_array.append(query_position)
+    print_array.append(genome_mapping_info.chromosome)
+    print_array.append(None) # placeholder for position
+    genome_position = genome_mapping_info.pos
+    transcript_position = query_position
+
+    if mapping_direction == "GENOMIC":
+        transcript_position = format_output_coordinate(output_coordinate)
+        genome_position = query_position
+    else:
+        genome_position = format_output_coordinate(output_coordinate)
+
+    print_array[1] = transcript_position
+    print_array[3] = genome_position
+    if error_code is not None:
+        print_array.append(error_code)
+
+    # map all to string
+    return "\t".join(map(str,print_array))
+
+
+def output_record(genome_mapping_info, query_position, mapping_direction, output_coordinate, error_code=None):
+    """
+    Build the output record of a translated query for a columnar output file: format_output_line with typed columns
+    (see columnar_io.OUTPUT_COLUMNS).  Positions which could not be translated are None, and a translated interval is
+    spanned by the start and end of its blocks.  See format_output_line for the parameters.
+    :return: tuple (transcript, transcript start, transcript end, chromosome, genomic start, genomic end, text of the
+    blocks of an interval or None), with the error code as last item if provided
+    """
+    if isinstance(query_position, tuple):
+        query_start, query_end = query_position
+    else:
+        query_start = query_end = query_position
+
+    blocks = None
+    if output_coordinate is None:
+        start = end = None
+    elif isinstance(output_coordinate, list):
+        blocks = format_output_coordinate(output_coordinate)
+        coordinates = [coordinate for block in output_coordinate for coordinate in block[3:]]
+        start, end = min(coordinates), max(coordinates)
+    else:
+        start, end = output_coordinate
+
+    if mapping_direction == "GENOMIC":
+        record = (genome_mapping_info.transcript_name, start, end, genome_mapping_info.chromosome, query_start,
+                  query_end, blocks)
+    else:
+        record = (genome_mapping_info.transcript_name, query_start, query_end, genome_mapping_info.chromosome, start,
+                  end, blocks)
+    if error_code is not None:
+        return record + (error_code,)
+    return record
+
+
+def report_translation(genome_mapping_info, query_position, mapping_direction, output_coordinate, status,
+                       error_log=None, line_number=None, error_column=False, format_output=format_output_line):
+    """
+    Report a failed translation and build the output line of a query.
+    :param status: int, POS_* code of the translation, see Mappings.get_pos_status
+    :param error_column, boolean: Append the error code of the translation (OK if it succeeded) to the output line.
+    :param format_output: function building the output line, format_output_line or output_record
+    See format_output_line for the other parameters.
+    :return: string, output line (without new line), or record returned by format_output
+    """
+    error_code = "OK"
+    if status != POS_OK:
+        error_code = POS_ERROR_CODES[status]
+        report_error(error_log, PROCESSING_FILE, line_number, genome_mapping_info.transcript_name, error_code,
+                     POS_MESSAGES[status])
+    if not error_column:
+        error_code = None
+    return format_output(genome_mapping_info, query_position, mapping_direction, output_coordinate, error_code)
+
+
+def query_key(line):
+    """
+    :param line: string, line of the processing file, or tuple (transcript, position, direction) of a columnar
+    processing file
+    :return: tuple (transcript, position, direction) of the query as written in the line, the key of its result in a
+    ResultCache.  None if the line does not have the columns of a query, or is a CHROMOSOME query.
+    """
+    if isinstance(line, tuple):
+        return line if line[2] != "CHROMOSOME" else None
+    data = line.rstrip().split("\t")
+    if len(data) < 2:
+        return None
+    # as in parse_processing_line, the direction is only read from lines with 3 columns
+    mapping_direction = data[2] if len(data) == 3 else "TRANSCRIPT"
+    if mapping_direction == "CHROMOSOME":
+        # translated on every transcript overlapping the position, not cached
+        return None
+    return data[0], data[1], mapping_direction
+
+
+def query_transcripts(transcript):
+    """
+    :param transcript: string, transcript column of a line of the processing file
+    :return: list of the names of the mappings the translation of a query of the transcript depends on: the transcript
+    column and, for a chain, every mapping of the chain
+    """
+    transcript = transcript.rstrip()
+    if CHAIN_SEPARATOR in transcript:
+        return [transcript] + transcript.split(CHAIN_SEPARATOR)
+    return [transcript]
+
+
+def translation_result(genome_mapping_info, query_position, mapping_direction, output_coordinate, status,
+                       format_output=format_output_line):
+    """
+    :return: tuple (output line without error column, POS_* code of the translation), as kept in a ResultCache.  See
+    report_translation for the parameters.
+    """
+    return format_output(genome_mapping_info, query_position, mapping_direction, output_coordinate), status
+
+
+def report_result(transcript, result, error_log=None, line_number=None, error_column=False):
+    """
+    report_translation for a translation result, e.g. taken from a ResultCache.
+    :param transcript: string, transcript column of the query
+    :param result: tuple (output line without error column, POS_* code), see translation_result
+    :return: string, output line (without new line), or output record (see output_record)
+    """
+    output_line, status = result
+    error_code = "OK"
+    if status != POS_OK:
+        error_code = POS_ERROR_CODES[status]
+        report_error(error_log, PROCESSING_FILE, line_number, transcript, error_code, POS_MESSAGES[status])
+    if error_column:
+        if isinstance(output_line, tuple):
+            return output_line + (error_code,)
+        return output_line + "\t" + error_code
+    return output_line
+
+
+def translate_chromosome_query(chromosome, query_position, interval_index, error_log=None, line_number=None,
+                               error_column=False, format_output=format_output_line):
+    """
+    Translate a genomic position on every transcript overlapping it.
+    :return: list of output lines (without new line), one per transcript
+    """
+    output_lines = []
+    for genome_mapping_info, (output_coordinate, status) in interval_index.genomic_to_transcript_pos(
+            chromosome, query_position, with_status=True):
+        output_lines.append(report_translation(genome_mapping_info, query_position, "GENOMIC", output_coordinate,
+                                               status, error_log, line_number, error_column, format_output))
+
+    if not output_lines:
+        report_error(error_log, PROCESSING_FILE, line_number, chromosome, "NO_OVERLAP",
+                     "No transcript overlaps : " + chromosome + " " + str(query_position) + "\n")
+    return output_lines
+
+
+def translate_query(query_position, mapping_direction, query_mapping, with_status=False):
+    """
+    Translate one parsed query.  See parse_processing_line.
+    :param with_status: boolean, return the POS_* code of the translation instead of reporting failures to stderr
+    :return: tuple (min_pos, max_pos), None if the position could not be translated.  List of blocks if the query is
+    an interval, see Mappings.get_interval_status.  With with_status, tuple (translation, status), see
+    Mappings.get_pos_status.
+    """
+    if isinstance(query_position, tuple):
+        if mapping_direction == "GENOMIC":
+            return Mappings.genomic_interval_to_transcript(query_position[0], query_position[1], query_mapping,
+                                                           with_status)
+        return Mappings.transcript_interval_to_genomic(query_position[0], query_position[1], query_mapping,
+                                                       with_status)
+    if mapping_direction == "GENOMIC":
+        return Mappings.genomic_to_transcript_pos(query_position, query_mapping, with_status)
+    return Mappings.transcript_to_genomic_pos(query_position, query_mapping, with_status)
+
+
+def estimated_range_probes(query_mapping, blocks=None):
+    """
+    Estimate the number of ranges a lookup compared its position with: the steps of a binary search over the ranges
+    expanded so far (see Mappings.expand_through), plus one range walked per block of an interval.  The binary search
+    runs in bisect, so its probes are not counted one by one.
+    :param query_mapping: Mappings object the lookup was made on
+    :param blocks: list of blocks of a translated interval, see Mappings.get_interval_status
+    :return: int
+    """
+    return query_mapping.expanded_range_count().bit_length() + (len(blocks) if blocks else 0)
+
+
+def translate_queries_grouped(queries, with_status=False, stats=None):
+    """
+    Translate parsed processing file queries grouped by transcript and direction.  The positions of each group are
+    sorted and resolved with a single sweep over the ranges of the transcript.
+    :param queries: list of tuples as returned by parse_processing_line
+    :param with_status: boolean, also return the POS_* code of every translation instead of reporting failures to
+    stderr
+    :param stats: RunStats object the number of lookups and of ranges swept are added to
+    :return: list of translated coordinates (blocks for intervals), in the order of queries.  None for CHROMOSOME
+    queries.  With with_status, tuple (translated coordinates, POS_* codes).
+    """
+    output_coordinates = [None] * len(queries)
+    statuses = [POS_OK] * len(queries)
+
+    groups = {}
+    for query_index, (genome_mapping_info, query_position, mapping_direction, query_mapping) in enumerate(queries):
+        if mapping_direction == "CHROMOSOME":
+            continue
+        if isinstance(query_position, tuple):
+            # intervals are walked from their start, one at a time
+            output_coordinates[query_index] = translate_query(query_position, mapping_direction, query_mapping,
+                                                              with_status)
+            if with_status:
+                output_coordinates[query_index], statuses[query_index] = output_coordinates[query_index]
+            if stats is not None:
+                stats.count("interval_lookups")
+                stats.count("estimated_range_probes", estimated_range_probes(query_mapping,
+                                                                             output_coordinates[query_index]))
+            continue
+        key = (genome_mapping_info.transcript_name, mapping_direction)
+        groups.setdefault(key, []).append(query_index)
+    for (transcript, mapping_direction), query_indices in groups.items():
+        query_indices.sort(key=lambda query_index: queries[query_index][1])
+        query_mapping = queries[query_indices[0]][3]
+        query_positions = [queries[query_index][1] for query_index in query_indices]
+
+        if mapping_direction == "GENOMIC":
+            group_coordinates = Mappings.genomic_to_transcript_sweep(query_positions, query_mapping, with_status)
+        else:
+            group_coordinates = Mappings.transcript_to_genomic_sweep(query_positions, query_mapping, with_status)
+
+        if stats is not None and has_dense_table(query_mapping, mapping_direction):
+            stats.count("lookups", len(query_positions))
+            stats.count("dense_lookups", len(query_positions))
+        elif stats is not None:
+            # a sweep goes over the expanded ranges at most once for the whole group
+            stats.count("lookups", len(query_positions))
+            stats.count("estimated_range_probes", query_mapping.expanded_range_count())
+
+        group_statuses = statuses
+        if with_status:
+            group_coordinates, group_statuses = group_coordinates
+        for i, query_index in enumerate(query_indices):
+            output_coordinates[query_index] = group_coordinates[i]
+            if with_status:
+                statuses[query_index] = group_statuses[i]
+
+    if with_status:
+        return output_coordinates, statuses
+    return output_coordinates
+
+
+def translate_numbered_lines(lines, mappings, mappings_cache, grouped=False, interval_index=None, error_log=None,
+                             first_line_number=1, error_column=False, stats=None, result_cache=None, line_numbers=None,
+                             format_output=format_output_line):
+    """
+    translate_lines, with the number of the input line every output line comes from.  See translate_lines for the
+    parameters.
+    :param line_numbers: list of the numbers of lines in the processing file, if they are not consecutive from
+    first_line_number
+    :return: generator of tuples (number of the input line, output line without new line), in the order of the input
+    lines
+    """
+    queries = []
+    query_keys = []  # grouped: result cache key of every query, None if it is not cached
+    # grouped: (line number, index of the query in queries, result cache key, cached result) in the order of the lines
+    entries = []
+    batch_queries = {}  # grouped: result cache key -> index in queries of the first query with the key
+    line_number = first_line_number - 1
+    numbered_lines = enumerate(lines, first_line_number) if line_numbers is None else zip(line_numbers, lines)
+    for line_number, line in numbered_lines:
+        key = None
+        if result_cache is not None:
+            key = query_key(line)
+        if key is not None:
+            if grouped and key in batch_queries:
+                # repeated in the batch: translated once, with the first query
+                result_cache.hits += 1
+                if stats is not None:
+                    stats.count("queries_" + key[2])
+                entries.append((line_number, batch_queries[key], key, None))
+                continue
+            result = result_cache.get(key)
+            if result is not None:
+                if stats is not None:
+                    stats.count("queries_" + key[2])
+                if grouped:
+                    entries.append((line_number, None, key, result))
+                else:
+                    yield line_number, report_result(key[0], result, error_log, line_number, error_column)
+                continue
+
+        query = parse_processing_line(line, mappings, mappings_cache, interval_index, error_log, line_number)
+        if query is None:
+            continue
+        if stats is not None:
+            stats.count("queries_" + query[2])
+        if grouped:
+            if key is not None:
+                batch_queries[key] = len(queries)
+            entries.append((line_number, len(queries), key, None))
+            queries.append(query)
+            query_keys.append(key)
+            continue
+
+        genome_mapping_info, query_position, mapping_direction, query_mapping = query
+        if mapping_direction == "CHROMOSOME":
+            for output_line in translate_chromosome_query(genome_mapping_info, query_position, interval_index,
+                                                          error_log, line_number, error_column, format_output):
+                yield line_number, output_line
+            continue
+        output_coordinate, status = translate_query(query_position, mapping_direction, query_mapping, True)
+        if stats is not None and isinstance(query_position, tuple):
+            stats.count("interval_lookups")
+            stats.count("estimated_range_probes", estimated_range_probes(query_mapping, output_coordinate))
+        elif stats is not None and has_dense_table(query_mapping, mapping_direction):
+            stats.count("lookups")
+            stats.count("dense_lookups")
+        elif stats is not None:
+            stats.count("lookups")
+            stats.count("estimated_range_probes", estimated_range_probes(query_mapping))
+        result = translation_result(genome_mapping_info, query_position, mapping_direction, output_coordinate, status,
+                                    format_output)
+        if key is not None:
+            result_cache.put(key, result)
+        yield line_number, report_result(genome_mapping_info.transcript_name, result, error_log, line_number,
+                                         error_column)
+
+    if stats is not None:
+        stats.count("processing_lines_read", line_number - first_line_number + 1 if line_numbers is None
+                    else len(line_numbers))
+
+    if grouped:
+        output_coordinates, statuses = translate_queries_grouped(queries, True, stats)
+        results = [None] * len(queries)
+        for line_number, query_index, key, result in entries:
+            if result is None:
+                genome_mapping_info, query_position, mapping_direction, query_mapping = queries[query_index]
+                if mapping_direction == "CHROMOSOME":
+                    for output_line in translate_chromosome_query(genome_mapping_info, query_position,
+                                                                  interval_index, error_log, line_number,
+                                                                  error_column, format_output):
+                        yield line_number, output_line
+                    continue
+                result = results[query_index]
+                if result is None:
+                    result = translation_result(genome_mapping_info, query_position, mapping_direction,
+                                                output_coordinates[query_index], statuses[query_index],
+                                                format_output)
+                    results[query_index] = result
+                    if query_keys[query_index] is not None:
+                        result_cache.put(query_keys[query_index], result)
+            yield line_number, report_result(key[0] if key is not None else genome_mapping_info.transcript_name,
+                                             result, error_log, line_number, error_column)
+
+
+def translate_lines(lines, mappings, mappings_cache, grouped=False, interval_index=None, error_log=None,
+                    first_line_number=1, error_column=False, stats=None, result_cache=None,
+                    format_output=format_output_line):
+    """
+    Translate lines of the processing file.  Lines which cannot be parsed are reported and skipped; positions which
+    cannot be translated are reported and written as ERROR.
+    :param lines: iterable of processing file lines
+    :param mappings: dict of transcript name -> GenomicMapping object
+    :param mappings_cache: MappingsCache object
+    :param grouped, boolean: Translate the lines grouped by transcript and direction.  See translate_queries_grouped.
+    :param interval_index: GenomicIntervalIndex object, required for CHROMOSOME queries
+    :param error_log: ErrorLog object errors are recorded in.  Default reports them to stderr.
+    :param first_line_number: int, number of the first of lines in the processing file, for the error records
+    :param error_column, boolean: Append the error code of every translation (OK if it succeeded) to its output line.
+    :param stats: RunStats object the number of lines, queries per direction, lookups and ranges scanned are added to
+    :param result_cache: ResultCache object the output of repeated queries is taken from.  In grouped mode, a query
+    repeated within lines is also translated once.
+    :param format_output: function building the output lines: format_output_line, or output_record for the records of
+    a columnar output file
+    :return: generator of output lines (without new line), in the order of the input lines
+    """
+    for line_number, output_line in translate_numbered_lines(lines, mappings, mappings_cache, grouped, interval_index,
+                                                             error_log, first_line_number, error_column, stats,
+                                                             result_cache, format_output=format_output):
+        yield output_line
+
+
+def is_chromosome_query(line):
+    """
+    :param line: string, line of the processing file
+    :return: boolean, True if the line may be a CHROMOSOME query, translated on every transcript overlapping it
+    """
+    return line.rstrip().endswith("\tCHROMOSOME")
+
+
+def translate_lines_incremental(lines, mappings, mappings_cache, previous_run, previous_output, run_state_writer,
+                                error_log, grouped=False, interval_index=None, error_column=False, stats=None,
+                                result_cache=None, chunk_size=10000):
+    """
+    translate_lines, carrying over output lines of the previous run over the processing file.  Lines are compared by
+    chunks of chunk_size lines: in a chunk with the same lines as in that run, the output lines of the lines whose
+    mappings (see query_transcripts) have the same fingerprint are carried over, and the error records of these lines
+    recorded again.  Other lines, and CHROMOSOME queries, are translated again.
+    :param previous_run: RunState object of the previous run, None to translate every line
+    :param previous_output: iterable of the output lines of the previous run
+    :param run_state_writer: RunStateWriter object the state of this run is written to
+    :param error_log: ErrorLog object errors are recorded in
+    :param chunk_size: int, number of lines compared at a time.  The lines of a chunk which are translated again are
+    translated together (grouped if enabled).
+    See translate_lines for the other parameters.
+    :return: generator of output lines (without new line), in the order of the input lines
+    """
+    fingerprints = run_state_writer.fingerprints
+    changed_transcripts = set()  # transcripts whose mapping changed since the previous run
+    previous_chunks = iter(())
+    if previous_run is not None:
+        previous_chunks = previous_run.chunk_records()
+        for transcript, fingerprint in previous_run.fingerprints.items():
+            fingerprints[transcript] = mapping_fingerprint(mappings.get(transcript))
+            if fingerprints[transcript] != fingerprint:
+                changed_transcripts.add(transcript)
+    previous_output = iter(previous_output)
+    affected_transcripts = {}  # transcript column -> True if a mapping it names changed since the previous run
+    # records of the lines translated again, attributed to their lines before they are added to error_log
+    lines_error_log = ErrorLog(buffer_size=None)
+
+    for first_line_number, chunk in read_chunks(lines, chunk_size):
+        digest = chunk_digest(chunk)
+        previous_chunk = next(previous_chunks, None)
+        previous_lines = None  # output lines of the previous run, per line of the chunk if its lines are the same
+        if previous_chunk is not None:
+            previous_digest, output_line_counts, errors, chromosome_offsets = previous_chunk
+            output_lines = [output_line.rstrip("\n") for output_line in islice(previous_output,
+                                                                               sum(output_line_counts))]
+            if previous_digest == digest and not changed_transcripts and not chromosome_offsets:
+                # nothing this chunk depends on changed
+                for offset, error_code in errors:
+                    error_log.add(PROCESSING_FILE, first_line_number + offset,
+                                  chunk[offset].rstrip().split("\t")[0], error_code)
+                run_state_writer.add_chunk(digest, output_line_counts, errors, chromosome_offsets, len(chunk))
+                if stats is not None:
+                    stats.count("processing_lines_read", len(chunk))
+                    stats.count("lines_carried_over", len(chunk))
+                for output_line in output_lines:
+                    yield output_line
+                continue
+            if previous_digest == digest:
+                previous_lines = []
+                previous_errors = {}  # offset -> error codes
+                for offset, error_code in errors:
+                    previous_errors.setdefault(offset, []).append(error_code)
+                start = 0
+                for n_output_lines in output_line_counts:
+                    previous_lines.append(output_lines[start:start + n_output_lines])
+                    start += n_output_lines
+
+        retranslated_lines = []
+        retranslated_line_numbers = []
+        carried = set()  # offsets of the lines carried over
+        for offset, line in enumerate(chunk):
+            transcript = line.split("\t", 1)[0]
+            affected = affected_transcripts.get(transcript)
+            if affected is None:
+                affected = False
+                for name in query_transcripts(transcript):
+                    if name not in fingerprints:
+                        fingerprints[name] = mapping_fingerprint(mappings.get(name))
+                    affected = affected or name in changed_transcripts
+                affected_transcripts[transcript] = affected
+            if previous_lines is not None and not affected and not is_chromosome_query(line):
+                carried.add(offset)
+            else:
+                retranslated_lines.append(line)
+                retranslated_line_numbers.append(first_line_number + offset)
+
+        translated = {}  # line number -> output lines
+        if retranslated_lines:
+            for line_number, output_line in translate_numbered_lines(retranslated_lines, mappings, mappings_cache,
+                                                                     grouped, interval_index, lines_error_log,
+                                                                     first_line_number, error_column, stats,
+                                                                     result_cache, retranslated_line_numbers):
+                translated.setdefault(line_number, []).append(output_line)
+        line_errors = {}  # line number -> error records
+        for error_record in lines_error_log.take_records():
+            line_errors.setdefault(error_record[1], []).append(error_record)
+        # records without line number, e.g. of genome mapping file lines
+        error_log.extend(line_errors.pop(None, ()))
+        if stats is not None:
+            stats.count("processing_lines_read", len(carried))
+            stats.count("lines_carried_over", len(carried))
+
+        output_line_counts = []
+        errors = []
+        chromosome_offsets = []
+        for offset, line in enumerate(chunk):
+            if offset in carried:
+                output_lines = previous_lines[offset]
+                for error_code in previous_errors.get(offset, ()):
+                    error_log.add(PROCESSING_FILE, first_line_number + offset, line.rstrip().split("\t")[0],
+                                  error_code)
+                    errors.append((offset, error_code))
+            else:
+                output_lines = translated.get(first_line_number + offset, ())
+                for error_record in line_errors.get(first_line_number + offset, ()):
+                    error_log.add(*error_record)
+                    errors.append((offset, error_record[3]))
+                if is_chromosome_query(line):
+                    chromosome_offsets.append(offset)
+            output_line_counts.append(len(output_lines))
+            for output_line in output_lines:
+                yield output_line
+        run_state_writer.add_chunk(digest, output_line_counts, errors, chromosome_offsets, len(carried))
+
+
+# state of a translation worker process, set once per process by init_translation_worker
+_worker_mappings = None
+_worker_mappings_cache = None
+_worker_grouped = False
+_worker_interval_index = None
+_worker_error_log = None
+_worker_error_column = False
+_worker_stats = None
+_worker_result_cache = None
+_worker_format_output = format_output_line
+
+
+def init_translation_worker(mappings, mappings_cache_size, build, grouped, interval_index, error_column=False,
+                            collect_stats=False, dense_tables=None, result_cache_size=0, result_cache_policy="lru",
+                            format_output=format_output_line):
+    """
+    Pool initializer: keep the mapping table in the worker so it is sent once per process, not once per chunk.  Every
+    worker has its own copy of the dense table budget, and its own result cache.
+    """
+    global _worker_mappings, _worker_mappings_cache, _worker_grouped, _worker_interval_index, _worker_error_log, \
+        _worker_error_column, _worker_stats, _worker_result_cache, _worker_format_output
+    _worker_stats = None
+    if collect_stats:
+        # stats are sent back with the results of every chunk
+        _worker_stats = RunStats()
+        build = _worker_stats.timed("mappings_construction", build)
+    _worker_mappings = mappings
+    _worker_mappings_cache = MappingsCache(mappings_cache_size, build, dense_tables)
+    _worker_grouped = grouped
+    _worker_interval_index = interval_index
+    # error records are sent back with the results of every chunk
+    _worker_error_log = ErrorLog(buffer_size=None)
+    _worker_error_column = error_column
+    _worker_result_cache = build_result_cache(result_cache_size, result_cache_policy)
+    _worker_format_output = format_output
+    if isinstance(mappings, GenomeMappingIndex):
+        mappings.error_log = _worker_error_log
+
+
+def translate_chunk(chunk):
+    """
+    Translate a chunk of processing file lines in a worker process.
+    :param chunk: tuple (number of the first line in the processing file, list of processing file lines)
+    :return: tuple (list of output lines, mappings cache hits, mappings cache misses, list of error records, stats as
+    returned by RunStats.as_dict or None if they are not collected, result cache hits, result cache misses, result
+    cache evictions) for this chunk
+    """
+    first_line_number, lines = chunk
+    hits = _worker_mappings_cache.hits
+    misses = _worker_mappings_cache.misses
+    result_cache_counts = (0, 0, 0)
+    if _worker_result_cache is not None:
+        result_cache_counts = (_worker_result_cache.hits, _worker_result_cache.misses, _worker_result_cache.evictions)
+    dense_tables = _worker_mappings_cache.dense_tables
+    if dense_tables is not None:
+        tables_built, tables_refused = dense_tables.tables_built, dense_tables.tables_refused
+    start = perf_counter()
+    output_lines = list(translate_lines(lines, _worker_mappings, _worker_mappings_cache, _worker_grouped,
+                                        _worker_interval_index, _worker_error_log, first_line_number,
+                                        _worker_error_column, _worker_stats, _worker_result_cache,
+                                        _worker_format_output))
+    chunk_stats = None
+    if _worker_stats is not None:
+        _worker_stats.add_time("translation", perf_counter() - start)
+        if dense_tables is not None:
+            _worker_stats.count("dense_tables_built", dense_tables.tables_built - tables_built)
+            _worker_stats.count("dense_tables_refused", dense_tables.tables_refused - tables_refused)
+        chunk_stats = _worker_stats.take()
+    if _worker_result_cache is not None:
+        result_cache_counts = (_worker_result_cache.hits - result_cache_counts[0],
+                               _worker_result_cache.misses - result_cache_counts[1],
+                               _worker_result_cache.evictions - result_cache_counts[2])
+    return ((output_lines, _worker_mappings_cache.hits - hits, _worker_mappings_cache.misses - misses,
+             _worker_error_log.take_records(), chunk_stats) + result_cache_counts)
+
+
+def read_chunks(in_handle, chunk_size):
+    """
+    Split an open file into lists of at most chunk_size lines.
+    :return: generator of tuples (number of the first line of the chunk, list of lines)
+    """
+    first_line_number = 1
+    while True:
+        chunk = list(islice(in_handle, chunk_size))
+        if not chunk:
+            return
+        yield first_line_number, chunk
+        first_line_number += len(chunk)
+
+
+def translate_coordinates(genome_mapping_file, processing_file, output_file, mappings_cache_size=None, grouped=False,
+                          workers=1, chunk_size=10000, use_index=False, genomic_index=False, error_file=None,
+                          error_column=False, output_buffer_size=10000, stats=None, sam_skip_flags=SAM_SKIP_FLAGS,
+                          dense_table_max_span=DENSE_TABLE_MAX_SPAN, dense_table_budget=DENSE_TABLE_BUDGET,
+                          result_cache_size=0, result_cache_policy="lru", incremental=False):
     """
     Translate coordinates specified in processing_file based on alignments specified in genome_mapping_file. 
     Write translations to output_file
     
     :param genome_mapping_file, string: Name of file specifying alignment of transcript to genome.  See documentation 
-    for file spec.
+    for file spec.  Can also be a SAM file (see is_sam_file), read one record at a time, or a compiled database.
     :param processing_file, string: Name of file specifying transcripts and positions to process.  See documentation 
-    for file spec.
-    :param output_file, string:  Name of output file translations will be written t..
+    for file spec.  Can also be an Arrow IPC or Parquet file with typed columns (see ColumnarQueryReader).
+    Input files can be gzip or bgzip compressed (see open_input), and "-" (STDIO) reads one of them from stdin.
+    :param output_file, string:  Name of output file translations will be written t..  Compressed if its name ends
+    with .gz or .bgz; "-" writes to stdout.  Written as an Arrow IPC or Parquet file with typed columns and a status
+    column if its name ends with one of ARROW_EXTENSIONS or PARQUET_EXTENSIONS (see ColumnarWriter).
+    :param mappings_cache_size, int: Maximum number of transcripts whose Mappings objects are kept between queries.
+    None (default) keeps all of them.
+    :param grouped, boolean: Read the whole processing file and translate its queries grouped by transcript and
+    direction, one sweep over sorted positions per group, instead of one lookup per line.  Output is written in the
+    order of the processing file either way.
+    :param workers, int: Number of processes translating the processing file.  With more than one, the file is split
+    in chunks of chunk_size lines (grouping, if enabled, happens within each chunk) and the output keeps the line order.
+    An uncompressed genome mapping file of at least PARALLEL_LOAD_MIN_BYTES is also parsed by the workers, in byte
+    ranges of whole lines (see load_genome_mappings_parallel).
+    :param chunk_size, int: Number of processing file lines sent to a worker at a time.
+    :param use_index, boolean: Look transcripts up through a sidecar index of the genome mapping file (see
+    GenomeMappingIndex) and only read the lines of the transcripts which are queried, instead of loading the whole file.
+    Ignored if genome_mapping_file is a compiled database (see compile_mapping_database), which is always memory-mapped
+    and read on demand.
+    :param genomic_index, boolean: Build the Mappings of every transcript and index their genomic spans by chromosome
+    (see GenomicIntervalIndex), so CHROMOSOME queries (chromosome, genomic position) are translated on every transcript
+    overlapping the position, one output line per transcript.
+    :param error_file, string: Name of a file the lines which could not be used are written to, one tab separated
+    record (source file, line number, transcript, error code) per line.  Errors are not reported line by line to
+    stderr; a count per error code is written at the end of the run.
+    :param error_column, boolean: Append the error code of every translation (OK if it succeeded) to its output line.
+    Columnar output files always have it, as the status column.
+    :param output_buffer_size, int: Number of output lines written at a time.
+    :param stats: RunStats object the wall time of every phase of the run and its counters are added to.  With more
+    than one worker, the translation, mappings construction and cigar validation times are summed over the workers.
+    :param sam_skip_flags: int, FLAG bits of the records skipped if genome_mapping_file is a SAM file.  Default skips
+    unmapped, secondary and supplementary records.
+    :param dense_table_max_span, int: Transcripts (and genomic spans) of at most this many positions, looked up often
+    enough, get dense lookup tables translating a position by indexing instead of a range search (see MappingsCache).  0
+    disables the tables.
+    :param dense_table_budget, int: Maximum bytes of dense lookup tables in memory at a time, per process.  Tables of
+    transcripts evicted from the mappings cache are freed.
+    :param result_cache_size, int: Maximum number of (transcript, position, direction) queries whose output is kept,
+    so repeated queries are not translated again (see ResultCache).  0 (default) disables the result cache.  Every
+    worker has its own.
+    :param result_cache_policy, string: Eviction policy of the result cache, one of RESULT_CACHE_POLICIES.
+    :param incremental, boolean: Keep the state of the run next to output_file (see RunState), and only translate the
+    lines of the chunks of chunk_size lines which changed since the previous incremental run writing output_file, and
+    the lines whose mappings changed; the output lines of the other lines are carried over from the previous output
+    file (see translate_lines_incremental).  Needs an output file and one worker.
     :return: void
     """
 
-    #TODO : needs to be refactored and broken into smaller methods
-    mappings = {}
-    with open(genome_mapping_file) as in_handle:
-        for line in in_handle:
-            data = line.rstrip().split("\t")
-
-            if len(data) < 4:
-                sys.stderr.write("Line in genome mapping file does have atleast 4 columns. Skipping.\n")
-                sys.stderr.write(line)
-                continue
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1: " + str(workers))
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be at least 1: " + str(chunk_size))
+    if incremental and (workers > 1 or output_file == STDIO):
+        raise ValueError("Incremental runs need an output file and one worker")
+    output_format = columnar_output_format(output_file)
+    columnar_input = is_columnar_file(processing_file)
+    if incremental and (output_format is not None or columnar_input):
+        raise ValueError("Incremental runs cannot read or write Arrow and Parquet files")
+    format_output = format_output_line
+    if output_format is not None:
+        # the error code of every translation is the status column
+        format_output = output_record
+        error_column = True
 
-            # if not specified in the input file, assume the mapping orientation is 5'=>3'
+    start = perf_counter()
+    error_log = ErrorLog(error_file)
+    mappings, build = open_mappings(genome_mapping_file, use_index, error_log, stats, sam_skip_flags, workers)
+    if stats is not None:
+        stats.add_time("parse_mappings", perf_counter() - start)
 
-            mapping_orientation = "+"
-            if len(data) == 5:
-                mapping_orientation = data[4]
+    cache_build = build
+    if stats is not None:
+        cache_build = stats.timed("mappings_construction", build)
+    dense_tables = build_dense_table_budget(dense_table_max_span, dense_table_budget)
+    mappings_cache = MappingsCache(mappings_cache_size, cache_build, dense_tables)
+    # with workers, only the counts of the caches of the workers are added to this one
+    result_cache = build_result_cache(result_cache_size, result_cache_policy)
+    interval_index = None
+    if genomic_index:
+        index_start = perf_counter()
+        interval_index = build_genomic_interval_index(mappings, build, error_log)
+        if stats is not None:
+            stats.add_time("interval_index", perf_counter() - index_start)
 
-            if not is_valid_cigar(data[3]):
-                sys.stderr.write("Input cigar string is not valid. Skipping "+data[0]+" "+data[3])
-                continue
+    written_output_file = output_file
+    if incremental:
+        state_file = state_file_name(output_file)
+        previous_run = RunState.read(state_file, output_file, error_column, chunk_size)
+        previous_output = open_input(output_file) if previous_run is not None else None
+        run_state_writer = RunStateWriter(state_file, error_column, chunk_size)
+        # the output of the previous run is read while this one is written, keeping the name of the output file
+        # (and its compression) until it is complete
+        written_output_file = os.path.join(os.path.dirname(output_file), ".incremental." +
+                                           os.path.basename(output_file))
 
+    if output_format is None:
+        o_handle = open_output(written_output_file)
+        output_writer = OutputWriter(o_handle, output_buffer_size)
+    else:
+        output_writer = o_handle = ColumnarWriter(output_file, output_format, output_buffer_size)
+    with (ColumnarQueryReader if columnar_input else open_input)(processing_file) as in_handle:
+        if workers == 1:
+            if incremental:
+                output_lines = translate_lines_incremental(in_handle, mappings, mappings_cache, previous_run,
+                                                           previous_output or (), run_state_writer, error_log,
+                                                           grouped, interval_index, error_column, stats,
+                                                           result_cache, chunk_size)
+            else:
+                output_lines = translate_lines(in_handle, mappings, mappings_cache, grouped, interval_index,
+                                               error_log, error_column=error_column, stats=stats,
+                                               result_cache=result_cache, format_output=format_output)
+            if stats is None:
+                output_writer.write_lines(output_lines)
+            else:
+                write_lines_timed(output_writer, output_lines, stats)
+        else:
+            pool = Pool(workers, initializer=init_translation_worker,
+                        initargs=(mappings, mappings_cache_size, build, grouped, interval_index, error_column,
+                                  stats is not None, dense_tables, result_cache_size, result_cache_policy,
+                                  format_output))
             try:
-                GM = GenomicMapping(data[0], data[1], data[2], data[3], mapping_orientation)
-            except:
-                sys.stderr.write("Excluding: "+data[0]+" from analysis - invalid input data.\n")
-                continue
-            mappings[data[0]] = GM
+                # imap returns the chunk results in submission order
+                for (output_lines, hits, misses, error_records, chunk_stats, result_hits, result_misses,
+                     result_evictions) in pool.imap(translate_chunk, read_chunks(in_handle, chunk_size)):
+                    mappings_cache.hits += hits
+                    mappings_cache.misses += misses
+                    if result_cache is not None:
+                        result_cache.hits += result_hits
+                        result_cache.misses += result_misses
+                        result_cache.evictions += result_evictions
+                    error_log.extend(error_records)
+                    if stats is None:
+                        output_writer.write_lines(output_lines)
+                    else:
+                        stats.merge(chunk_stats)
+                        with stats.phase("output"):
+                            output_writer.write_lines(output_lines)
+                        stats.count("output_lines", len(output_lines))
+            finally:
+                pool.terminate()
+                pool.join()
 
+    output_start = perf_counter()
+    output_writer.flush()
+    o_handle.close()
+    if incremental:
+        if previous_output is not None:
+            previous_output.close()
+        os.replace(written_output_file, output_file)
+        run_state_writer.close(output_file)
+    error_log.close()
+    if hasattr(mappings, "close"):
+        mappings.close()
 
-    o_handle = open(output_file,'w')
-    with open(processing_file) as in_handle:
-        for line in in_handle:
-            data = line.rstrip().split("\t")
+    if stats is not None:
+        stats.add_time("output", perf_counter() - output_start)
+        stats.add_time("total", perf_counter() - start)
+        stats.count("mappings_cache_hits", mappings_cache.hits)
+        stats.count("mappings_cache_misses", mappings_cache.misses)
+        if dense_tables is not None and workers == 1:
+            stats.count("dense_tables_built", dense_tables.tables_built)
+            stats.count("dense_tables_refused", dense_tables.tables_refused)
+        if result_cache is not None:
+            stats.count("result_cache_hits", result_cache.hits)
+            stats.count("result_cache_misses", result_cache.misses)
+            stats.count("result_cache_evictions", result_cache.evictions)
+        for error_code, n in error_log.counts.items():
+            stats.count("errors_" + error_code, n)
+    sys.stderr.write(error_log.summary())
+    sys.stderr.write(mappings_cache.summary())
+    if result_cache is not None:
+        sys.stderr.write(result_cache.summary())
+    if incremental:
+        sys.stderr.write(run_state_writer.summary())
 
-            if len(data)<2:
-                sys.stderr.write("Line in processing file does have atleast 2 columns\n")
-                sys.stderr.write(line)
-                continue
 
-            # TODO: check types of input
-            transcript = data[0]
-            query_position = int(data[1])
+def write_lines_timed(output_writer, output_lines, stats):
+    """
+    Write output lines, adding the time spent producing them to the translation phase and the time spent writing them
+    to the output phase.
+    :param output_writer: OutputWriter object
+    :param output_lines: iterable of output lines, e.g. the generator returned by translate_lines
+    :param stats: RunStats object
+    """
+    translation = 0.0
+    output = 0.0
+    n_lines = 0
+    start = perf_counter()
+    for output_line in output_lines:
+        produced = perf_counter()
+        output_writer.write(output_line)
+        written = perf_counter()
+        translation += produced - start
+        output += written - produced
+        start = written
+        n_lines += 1
+    # the lines skipped at the end of the input
+    translation += perf_counter() - start
+    stats.add_time("translation", translation)
+    stats.add_time("output", output)
+    stats.count("output_lines", n_lines)
 
-            # default mapping is from transcript -> genome
-            mapping_direction = "TRANSCRIPT"
 
-            if len(data) == 3:
-                mapping_direction = data[2]
+def add_dense_table_arguments(parser):
+    parser.add_argument("--dense-table-max-span", dest="dense_table_max_span", required=False,
+                        default=DENSE_TABLE_MAX_SPAN, type=int,
+                        help="Translate positions of transcripts (and genomic spans) of at most this many bases through "
+                             "a table of every position instead of a range search.  0 disables the tables.  Default is "
+                             + str(DENSE_TABLE_MAX_SPAN))
+    parser.add_argument("--dense-table-budget", dest="dense_table_budget", required=False,
+                        default=DENSE_TABLE_BUDGET // 2 ** 20, type=int,
+                        help="Maximum megabytes of dense tables in memory at a time, per process.  Default is " +
+                             str(DENSE_TABLE_BUDGET // 2 ** 20))
 
-            if transcript not in mappings:
-                sys.stderr.write("Can't find mappings for : " + data[0] + "\n")
-                continue
 
-            genome_mapping_info = mappings[transcript]
+def add_result_cache_arguments(parser):
+    parser.add_argument("--result-cache-size", dest="result_cache_size", required=False, default=0, type=int,
+                        help="Maximum number of (transcript, position, direction) queries whose output is kept, so "
+                             "repeated queries are not translated again.  Default is 0 (no result cache)")
+    parser.add_argument("--result-cache-policy", dest="result_cache_policy", required=False, default="lru",
+                        choices=RESULT_CACHE_POLICIES,
+                        help="Result cache eviction policy: lru (least recently used) or fifo (first in first out).  "
+                             "Default is lru")
 
-            if mapping_direction != "TRANSCRIPT" and mapping_direction!="GENOMIC":
-                sys.stderr.write ("Specification of mapping direction is not TRANSCRIPT or GENOMIC.Skipping\n")
-                continue
 
-            try:
-                query_mapping = Mappings(genome_mapping_info.cigar_string, genome_mapping_info.chromosome,
-                                    genome_mapping_info.pos, genome_mapping_info.orientation)
-            except:
-                sys.stderr.write("Could not process this mapping.  Skipping "+transcript+".\n")
-                continue
+def add_sam_skip_flags_argument(parser):
+    parser.add_argument("--sam-skip-flags", dest="sam_skip_flags", required=False, default=SAM_SKIP_FLAGS,
+                        type=lambda value: int(value, 0),
+                        help="If the genome mapping file is a SAM file, skip the records whose FLAG has any of these "
+                             "bits set.  Default is " + hex(SAM_SKIP_FLAGS) + " (unmapped, secondary and "
+                             "supplementary records)")
 
-            #TODO: move printing to it's own method
-            output_line = None
-            print_array = []
-            print_array.append(genome_mapping_info.transcript_name)
-            print_array.append(query_position)
-            print_array.append(genome_mapping_info.chromosome)
-            print_array.append(None) # placeholder for position
-            genome_position = genome_mapping_info.pos
-            transcript_position = query_position
-
-            if mapping_direction == "GENOMIC":
-                output_coordinate = Mappings.genomic_to_transcript_pos(query_position, query_mapping )
-
-                #TODO : handle this better
-                if output_coordinate is None:
-                     transcript_position = "ERROR"
-                else:
-                    transcript_position = output_coordinate[0]
 
-                    if output_coordinate[0] != output_coordinate[1]:
-                        transcript_position = str(output_coordinate[0]) + "-" + str(output_coordinate[1])
-                genome_position = query_position
+def compile_main(argv):
+    parser = ArgumentParser(
+        "Compile a genome mapping file into a binary database which translate_coordinates memory-maps instead of "
+        "parsing the genome mapping file on every run")
 
-            else:
-                output_coordinate = Mappings.transcript_to_genomic_pos(query_position, query_mapping )
-                if output_coordinate is None:
-                    genome_position = "ERROR"
-                else:
-                    genome_position = output_coordinate[0]
-                    if output_coordinate[0] != output_coordinate[1]:
-                        genome_position = str(output_coordinate[0]) + "-" + str(output_coordinate[1])
+    parser.add_argument("--genome-mapping-file", required=True, dest="genome_mapping_file", help="File specifying mappings (inputfile1.txt in exercise specifications) ")
+    parser.add_argument("--database-file", required=True, dest="database_file",
+                        help="Name of the database file to write.  Pass it as --genome-mapping-file to translate")
+    add_sam_skip_flags_argument(parser)
+
+    args = parser.parse_args(argv)
 
-            print_array[1] = transcript_position
-            print_array[3] = genome_position
+    if not input_exists(args.genome_mapping_file):
+        sys.stderr.write("Provided genome mapping file does not exist\n")
+        sys.exit(-1)
 
-            # map all to string
-            output_line = "\t".join(map(str,print_array))
-            #print(output_line)
-            o_handle.write(output_line+"\n")
+    error_log = ErrorLog()
+    n_transcripts = compile_mapping_database(args.genome_mapping_file, args.database_file, error_log,
+                                             args.sam_skip_flags)
+    sys.stderr.write(error_log.summary())
+    sys.stderr.write("Compiled " + str(n_transcripts) + " transcripts into " + args.database_file + "\n")
 
 
 ######## MAIN ###############
 
 if __name__ == "__main__":
 
+    if len(sys.argv) > 1 and sys.argv[1] == "compile":
+        compile_main(sys.argv[2:])
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        from translation_server import serve_main
+        serve_main(sys.argv[2:])
+        sys.exit(0)
+
     parser = ArgumentParser(
         "Translate coordinates from transcripts->genome (or vice versa) based on input mapping information")
 
-    parser.add_argument("--genome-mapping-file", required=True, dest="genome_mapping_file", help="File specifying mappings (inputfile1.txt in exercise specifications) ")
-    parser.add_argument("--transcript-processing-file", required=True, dest="transcript_processing_file", help="File specifying transcripts to process (inputfile2.txt in exercise specifications) ")
+    parser.add_argument("--genome-mapping-file", required=True, dest="genome_mapping_file", help="File specifying mappings (inputfile1.txt in exercise specifications).  May be gzip/bgzip compressed; - reads stdin")
+    parser.add_argument("--transcript-processing-file", required=True, dest="transcript_processing_file", help="File specifying transcripts to process (inputfile2.txt in exercise specifications).  May be gzip/bgzip compressed, or an Arrow IPC or Parquet file with transcript, position, end and direction columns; - reads stdin")
     parser.add_argument("--output_file", dest="output_file", required=False, default='output.txt',
-                        help="Name of output file to write results to.  Default is output.txt)")
+                        help="Name of output file to write results to.  Default is output.txt).  Compressed if the "
+                             "name ends with .gz or .bgz; an Arrow IPC file (.arrow, .feather, .ipc) or Parquet file "
+                             "(.parquet) with typed columns and a status column; - writes to stdout")
+    parser.add_argument("--mappings-cache-size", dest="mappings_cache_size", required=False, default=None, type=int,
+                        help="Maximum number of transcripts whose parsed mappings are kept in memory.  Default is no limit")
+    parser.add_argument("--grouped", dest="grouped", required=False, default=False, action="store_true",
+                        help="Translate queries grouped by transcript and direction with one sweep over sorted positions "
+                             "per group.  Reads the whole processing file into memory; output keeps the input order")
+    parser.add_argument("--workers", dest="workers", required=False, default=1, type=int,
+                        help="Number of processes translating the processing file in chunks, and parsing a large "
+                             "genome mapping file.  Output keeps the input order.  Default is 1")
+    parser.add_argument("--chunk-size", dest="chunk_size", required=False, default=10000, type=int,
+                        help="Number of processing file lines per chunk sent to a worker.  Default is 10000")
+    parser.add_argument("--index", dest="use_index", required=False, default=False, action="store_true",
+                        help="Only read the genome mapping file lines of queried transcripts, through a sidecar index "
+                             "(GENOME_MAPPING_FILE.idx) built on first use and rebuilt when the file changes")
+    parser.add_argument("--genomic-index", dest="genomic_index", required=False, default=False, action="store_true",
+                        help="Index the genomic span of every transcript so processing file lines of the form "
+                             "CHROMOSOME<tab>POSITION<tab>CHROMOSOME are translated on all transcripts overlapping the "
+                             "position")
+    parser.add_argument("--error-file", dest="error_file", required=False, default=None,
+                        help="Name of a file the lines which could not be used are written to as tab separated records "
+                             "(source file, line number, transcript, error code).  Default only reports the number of "
+                             "errors of every code")
+    parser.add_argument("--error-column", dest="error_column", required=False, default=False, action="store_true",
+                        help="Append the error code of every translation (OK if it succeeded) to its output line")
+    parser.add_argument("--output-buffer-size", dest="output_buffer_size", required=False, default=10000, type=int,
+                        help="Number of output lines written at a time.  Default is 10000")
+    parser.add_argument("--stats", dest="stats", required=False, default=False, action="store_true",
+                        help="Report the wall time of every phase of the run and counters of what it processed on "
+                             "stderr")
+    parser.add_argument("--profile", dest="profile_file", required=False, default=None,
+                        help="Run under cProfile and write the profile to PROFILE_FILE (worker processes are not "
+                             "profiled)")
+    add_sam_skip_flags_argument(parser)
+    add_dense_table_arguments(parser)
+    add_result_cache_arguments(parser)
+    parser.add_argument("--incremental", dest="incremental", required=False, default=False, action="store_true",
+                        help="Keep the state of the run in OUTPUT_FILE.state, and only translate the lines which "
+                             "changed since the previous incremental run, or whose mappings changed.  Output lines of "
+                             "the other lines are carried over from OUTPUT_FILE")
 
     args = parser.parse_args()
 
@@ -217,4 +1389,23 @@ if __name__ == "__main__":
         sys.stderr.write(msg + "\n")
         sys.exit(-1)
 
-    translate_coordinates(args.genome_mapping_file, args.transcript_processing_file, args.output_file)
+    stats = None
+    if args.stats:
+        stats = RunStats()
+
+    profile = None
+    if args.profile_file is not None:
+        profile = cProfile.Profile()
+        profile.enable()
+
+    translate_coordinates(args.genome_mapping_file, args.transcript_processing_file, args.output_file,
+                          args.mappings_cache_size, args.grouped, args.workers, args.chunk_size, args.use_index,
+                          args.genomic_index, args.error_file, args.error_column, args.output_buffer_size, stats,
+                          args.sam_skip_flags, args.dense_table_max_span, args.dense_table_budget * 2 ** 20,
+                          args.result_cache_size, args.result_cache_policy, args.incremental)
+
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(args.profile_file)
+    if stats is not None:
+        sys.stderr.write(stats.summary())
@@ -0,0 +1,363 @@
+import os
+import sys
+import json
+import asyncio
+from argparse import ArgumentParser
+from bisect import bisect_right
+from urllib.parse import urlsplit, parse_qsl
+from error_log import ErrorLog, PROCESSING_FILE
+from file_io import input_exists
+from translate_coordinate import MappingsCache, add_dense_table_arguments, add_result_cache_arguments, \
+    add_sam_skip_flags_argument, build_dense_table_budget, build_genomic_interval_index, build_result_cache, \
+    open_mappings, translate_numbered_lines
+
+# largest request line (socket protocol) or request body (HTTP) accepted, in bytes
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+
+
+def request_lines(request):
+    """
+    Processing file lines of a translation request.
+    :param request: dict with one of the keys
+        "lines": list of processing file lines (bulk request)
+        "line": one processing file line
+        "transcript", "position" and optionally "direction": the columns of one processing file line
+    :return: list of strings.  Raises ValueError if the request is malformed.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("Request must be a JSON object")
+
+    if "lines" in request:
+        lines = request["lines"]
+        if not isinstance(lines, list):
+            raise ValueError("lines must be a list of processing file lines")
+    elif "line" in request:
+        lines = [request["line"]]
+    elif "transcript" in request and "position" in request:
+        lines = [str(request["transcript"]) + "\t" + str(request["position"]) + "\t" +
+                 str(request.get("direction", "TRANSCRIPT"))]
+    else:
+        raise ValueError("Request needs lines, line, or transcript and position")
+
+    for line in lines:
+        if not isinstance(line, str):
+            raise ValueError("Processing file lines must be strings: " + repr(line))
+    return lines
+
+
+class TranslationBatcher:
+    """
+    Translate the requests of all connections in batches.  Requests arriving while a batch is translated are queued
+    and translated together in the next one, grouped by transcript and direction (see translate_queries_grouped), in a
+    thread so the event loop keeps accepting requests.  Batches are translated one at a time, so the mapping table
+    and Mappings cache are never used concurrently.
+    :param mappings: mapping table, see open_mappings
+    :param mappings_cache: MappingsCache object
+    :param interval_index: GenomicIntervalIndex object, required for CHROMOSOME queries
+    :param max_batch_size: int, number of processing file lines after which no more requests are added to a batch
+    :param result_cache: ResultCache object the output of queries repeated across requests is taken from
+    """
+
+    def __init__(self, mappings, mappings_cache, interval_index=None, max_batch_size=10000, result_cache=None):
+        if max_batch_size < 1:
+            raise ValueError("Maximum batch size must be at least 1: " + str(max_batch_size))
+        self.mappings = mappings
+        self.mappings_cache = mappings_cache
+        self.interval_index = interval_index
+        self.max_batch_size = max_batch_size
+        self.result_cache = result_cache
+        self.batches = 0
+        self.requests = 0
+        self._queue = asyncio.Queue()
+
+    def submit(self, lines):
+        """
+        :param lines: list of processing file lines
+        :return: asyncio future of the response to the request, see translate_batch
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((lines, future))
+        return future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self._queue.get()]
+            n_lines = len(requests[0][0])
+            while not self._queue.empty() and n_lines < self.max_batch_size:
+                requests.append(self._queue.get_nowait())
+                n_lines += len(requests[-1][0])
+
+            try:
+                responses = await loop.run_in_executor(None, self.translate_batch,
+                                                       [lines for lines, future in requests])
+            except Exception as e:
+                responses = [{"error": "Translation failed: " + str(e)}] * len(requests)
+
+            self.batches += 1
+            self.requests += len(requests)
+            for (lines, future), response in zip(requests, responses):
+                # the connection of a request may have been closed while it was translated
+                if not future.done():
+                    future.set_result(response)
+
+    def translate_batch(self, requests):
+        """
+        :param requests: list of lists of processing file lines
+        :return: list of responses, one per request: dict with
+            "output": list of output lines, with the error code of the translation (OK if it succeeded) as last column
+            "errors": list of {"line": number of the line in the request, "transcript", "error": error code} for the
+            lines which could not be used
+        """
+        first_line_numbers = []
+        batch_lines = []
+        for lines in requests:
+            first_line_numbers.append(len(batch_lines) + 1)
+            batch_lines.extend(lines)
+
+        responses = [{"output": [], "errors": []} for lines in requests]
+        error_log = ErrorLog(buffer_size=None)
+        for line_number, output_line in translate_numbered_lines(batch_lines, self.mappings, self.mappings_cache, True,
+                                                                 self.interval_index, error_log, error_column=True,
+                                                                 result_cache=self.result_cache):
+            responses[bisect_right(first_line_numbers, line_number) - 1]["output"].append(output_line)
+
+        # grouped translation records the errors by transcript, they are listed in the order of the lines
+        records = sorted((record for record in error_log.take_records() if record[0] == PROCESSING_FILE),
+                         key=lambda record: record[1])
+        for source, line_number, transcript, error_code in records:
+            i = bisect_right(first_line_numbers, line_number) - 1
+            responses[i]["errors"].append({"line": line_number - first_line_numbers[i] + 1, "transcript": transcript,
+                                           "error": error_code})
+        return responses
+
+
+class TranslationServer:
+    """
+    Answer translation requests over a Unix socket or localhost HTTP with mappings loaded once.
+
+    Unix socket protocol: one JSON request per line (see request_lines), answered by one JSON response per line (see
+    TranslationBatcher.translate_batch) in the order of the requests.  Requests may be pipelined.
+
+    HTTP: POST /translate with a JSON request as body, or GET /translate?transcript=TR1&position=4&direction=GENOMIC.
+    Connections are kept alive unless the client asks otherwise.
+    :param batcher: TranslationBatcher object
+    """
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    def respond(self, data):
+        """
+        :param data: bytes, JSON request
+        :return: asyncio future of the response
+        """
+        try:
+            lines = request_lines(json.loads(data))
+        except ValueError as e:
+            return self.error_future(str(e))
+        return self.batcher.submit(lines)
+
+    def error_future(self, message):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result({"error": message})
+        return future
+
+    async def handle_socket(self, reader, writer):
+        # responses are written by a separate task so requests pipelined on the connection are batched together
+        pending = asyncio.Queue()
+
+        async def write_responses():
+            while True:
+                future = await pending.get()
+                if future is None:
+                    return
+                writer.write(json.dumps(await future).encode() + b"\n")
+                await writer.drain()
+
+        write_task = asyncio.ensure_future(write_responses())
+        try:
+            while True:
+                try:
+                    data = await reader.readuntil(b"\n")
+                except asyncio.IncompleteReadError as e:
+                    data = e.partial
+                except asyncio.LimitOverrunError:
+                    pending.put_nowait(self.error_future("Request is larger than " + str(MAX_REQUEST_SIZE) + " bytes"))
+                    break
+                if data.strip():
+                    pending.put_nowait(self.respond(data))
+                if not data.endswith(b"\n"):
+                    break
+            pending.put_nowait(None)
+            await write_task
+        except ConnectionError:
+            pass
+        finally:
+            write_task.cancel()
+            writer.close()
+
+    async def handle_http(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, separator, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                fields = request_line.decode("latin-1").split()
+                keep_alive = len(fields) == 3 and fields[2] == "HTTP/1.1" and \
+                    headers.get("connection", "").lower() != "close"
+                try:
+                    content_length = int(headers.get("content-length", 0))
+                except ValueError:
+                    content_length = -1
+                if len(fields) != 3:
+                    status, response = 400, {"error": "Malformed request line"}
+                elif content_length < 0:
+                    # the end of the body is not known, nor the start of the next request
+                    status, response = 400, {"error": "Invalid Content-Length: " + headers["content-length"]}
+                    keep_alive = False
+                elif content_length > MAX_REQUEST_SIZE:
+                    status, response = 413, {"error": "Request is larger than " + str(MAX_REQUEST_SIZE) + " bytes"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(content_length)
+                    status, response = await self.http_response(fields[0], fields[1], body)
+
+                payload = json.dumps(response).encode()
+                writer.write(("HTTP/1.1 " + str(status) + " " + HTTP_REASONS[status] + "\r\n"
+                              "Content-Type: application/json\r\n"
+                              "Content-Length: " + str(len(payload)) + "\r\n"
+                              "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n\r\n").encode() +
+                             payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def http_response(self, method, target, body):
+        """
+        :return: tuple (HTTP status, JSON response)
+        """
+        url = urlsplit(target)
+        if url.path != "/translate":
+            return 404, {"error": "Not found: " + url.path}
+        if method == "GET":
+            request = dict(parse_qsl(url.query))
+        elif method == "POST":
+            try:
+                request = json.loads(body)
+            except ValueError as e:
+                return 400, {"error": str(e)}
+        else:
+            return 405, {"error": "Method not allowed: " + method}
+
+        try:
+            lines = request_lines(request)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        return 200, await self.batcher.submit(lines)
+
+
+async def run_server(batcher, socket_path=None, host="127.0.0.1", port=None):
+    """
+    Serve translation requests until cancelled.  See TranslationServer.
+    :param batcher: TranslationBatcher object
+    :param socket_path: string, path of the Unix socket to listen on
+    :param host: string, address the HTTP server listens on
+    :param port: int, port of the HTTP server
+    """
+    server = TranslationServer(batcher)
+    batch_task = asyncio.ensure_future(batcher.run())
+    servers = []
+    try:
+        if socket_path is not None:
+            servers.append(await asyncio.start_unix_server(server.handle_socket, socket_path, limit=MAX_REQUEST_SIZE))
+            sys.stderr.write("Serving translations on " + socket_path + "\n")
+        if port is not None:
+            servers.append(await asyncio.start_server(server.handle_http, host, port))
+            sys.stderr.write("Serving translations on http://" + host + ":" + str(port) + "/translate\n")
+        await asyncio.gather(*[listener.serve_forever() for listener in servers])
+    finally:
+        for listener in servers:
+            listener.close()
+        batch_task.cancel()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def serve_main(argv):
+    parser = ArgumentParser(
+        "Load the genome mappings once and answer translation requests over a Unix socket or localhost HTTP")
+
+    parser.add_argument("--genome-mapping-file", required=True, dest="genome_mapping_file",
+                        help="File specifying mappings (inputfile1.txt in exercise specifications), or compiled "
+                             "mapping database")
+    parser.add_argument("--socket", dest="socket_path", required=False, default=None,
+                        help="Path of a Unix socket to listen on")
+    parser.add_argument("--port", dest="port", required=False, default=None, type=int,
+                        help="Port to serve HTTP on")
+    parser.add_argument("--host", dest="host", required=False, default="127.0.0.1",
+                        help="Address to serve HTTP on.  Default is 127.0.0.1")
+    parser.add_argument("--mappings-cache-size", dest="mappings_cache_size", required=False, default=None, type=int,
+                        help="Maximum number of transcripts whose parsed mappings are kept in memory.  Default is no limit")
+    parser.add_argument("--max-batch-size", dest="max_batch_size", required=False, default=10000, type=int,
+                        help="Number of processing file lines after which no more requests are added to a batch.  "
+                             "Default is 10000")
+    parser.add_argument("--index", dest="use_index", required=False, default=False, action="store_true",
+                        help="Only read the genome mapping file lines of queried transcripts, through a sidecar index")
+    parser.add_argument("--genomic-index", dest="genomic_index", required=False, default=False, action="store_true",
+                        help="Index the genomic span of every transcript to answer CHROMOSOME queries")
+    add_sam_skip_flags_argument(parser)
+    add_dense_table_arguments(parser)
+    add_result_cache_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.socket_path is None and args.port is None:
+        sys.stderr.write("Specify a Unix socket (--socket) or an HTTP port (--port) to serve on\n")
+        sys.exit(-1)
+    if not input_exists(args.genome_mapping_file):
+        sys.stderr.write("Provided genome mapping file does not exist\n")
+        sys.exit(-1)
+    if args.result_cache_size < 0:
+        sys.stderr.write("Result cache size cannot be negative\n")
+        sys.exit(-1)
+
+    error_log = ErrorLog()
+    mappings, build = open_mappings(args.genome_mapping_file, args.use_index, error_log,
+                                    sam_skip_flags=args.sam_skip_flags)
+    interval_index = None
+    if args.genomic_index:
+        interval_index = build_genomic_interval_index(mappings, build, error_log)
+    sys.stderr.write(error_log.summary())
+
+    result_cache = build_result_cache(args.result_cache_size, args.result_cache_policy)
+
+    async def serve():
+        dense_tables = build_dense_table_budget(args.dense_table_max_span, args.dense_table_budget * 2 ** 20)
+        batcher = TranslationBatcher(mappings, MappingsCache(args.mappings_cache_size, build, dense_tables),
+                                     interval_index, args.max_batch_size, result_cache)
+        await run_server(batcher, args.socket_path, args.host, args.port)
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if hasattr(mappings, "close"):
+            mappings.close()
+        if result_cache is not None:
+            sys.stderr.write(result_cache.summary())